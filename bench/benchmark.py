@@ -0,0 +1,441 @@
+'''
+传输吞吐量和指令延迟的基准测试
+
+在本机回环地址上用临时目录启动一个服务端子进程，用脚本驱动客户端，测量：
+1. 不同大小文件的get/put吞吐量
+2. ls的延迟与目录项数的关系
+3. 断点续传的代价（续传一半与完整传输的耗时对比）
+4. 多个客户端同时下载时的总吞吐量
+结果输出为JSON，可以用--compare比较两次运行的结果
+
+用法：
+    python3 bench/benchmark.py --quick -o before.json
+    python3 bench/benchmark.py --quick -o after.json
+    python3 bench/benchmark.py --compare before.json after.json
+'''
+import contextlib
+import io
+import json
+import optparse
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(BASE_DIR, 'server')
+CLIENT_DIR = os.path.join(BASE_DIR, 'client')
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+DEFAULT_SIZES = '1K,64K,1M,16M,256M,1G'
+QUICK_SIZES = '1K,64K,1M,16M'
+
+
+def parse_size(text):
+    '''把1K、16M、1G这样的大小转换为字节数'''
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return '%s%s' % (size // SIZE_UNITS[unit], unit)
+    return str(size)
+
+
+def write_random_file(path, size, chunk_size=4 * 1024 * 1024):
+    '''写入随机数据，不可压缩，结果不受压缩设置影响'''
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(chunk_size, remaining))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(config_file):
+    '''在子进程中按config_file的配置运行服务端'''
+    with open(config_file) as f:
+        config = json.load(f)
+    sys.path.insert(0, SERVER_DIR)
+    sys.path.insert(0, BASE_DIR)
+    from conf import settings
+    for key, value in config.items():
+        setattr(settings, key, value)
+    from core import main
+    main.FTPserver(None).run_forever()
+
+
+class BenchServer(object):
+    '''在临时目录中启动服务端子进程，用户根目录和账户文件都在临时目录中'''
+
+    def __init__(self, workdir, mode):
+        sys.path.insert(0, SERVER_DIR)
+        sys.path.insert(0, BASE_DIR)
+        from core import accounts
+        self.port = free_port()
+        self.home = os.path.join(workdir, 'home', USERNAME)
+        os.makedirs(self.home)
+        account_file = os.path.join(workdir, 'accounts.ini')
+        config = accounts.read_config(account_file)
+        config.add_section(USERNAME)
+        config.set(USERNAME, 'name', USERNAME)
+        config.set(USERNAME, 'password', accounts.hash_password(PASSWORD))
+        accounts.write_config(config, account_file)
+        # 被动端口范围避开系统分配临时端口的区间
+        passive = 20000 + self.port % 20000
+        settings = {
+            'HOST': '127.0.0.1',
+            'PORT': self.port,
+            'MIN_PASSITVE_PORT': passive,
+            'MAX_PASSITVE_PORT': passive + 500,
+            'SERVER_MODE': mode,
+            'USER_HOME_BASE_DIR': os.path.join(workdir, 'home'),
+            'ACCOUNT_FILE': account_file,
+            'LOG_FILE': os.path.join(workdir, 'server.log'),
+            'ACCESS_LOG_FILE': None,
+            'METRICS_PORT': 0,
+        }
+        config_file = os.path.join(workdir, 'server.json')
+        with open(config_file, 'w') as f:
+            json.dump(settings, f)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve', config_file],
+            stdout=subprocess.DEVNULL, cwd=workdir)
+        self.wait_ready()
+
+    def wait_ready(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('服务端启动失败')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('等待服务端启动超时')
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class BenchClient(object):
+    '''在独立的工作目录中创建已登录的客户端，屏蔽客户端的进度输出'''
+
+    def __init__(self, port, workdir, compress='off'):
+        sys.path.insert(0, CLIENT_DIR)
+        import JMclient
+        self.workdir = workdir
+        os.makedirs(workdir, exist_ok=True)
+        with self.in_workdir():
+            self.client = JMclient.FTPclient(
+                ['-s', '127.0.0.1', '-P', str(port), '-u', USERNAME, '-p', PASSWORD, '-z', compress])
+            if not self.client.auth():
+                raise RuntimeError('登录失败')
+
+    @contextlib.contextmanager
+    def in_workdir(self):
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+        finally:
+            os.chdir(cwd)
+
+    def timed(self, cmd):
+        '''执行一条命令，返回耗时（秒）'''
+        with self.in_workdir():
+            start = time.perf_counter()
+            self.client.run_command(cmd)
+            return time.perf_counter() - start
+
+    def close(self):
+        with self.in_workdir():
+            self.client.close()
+
+
+def summarize(samples):
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'samples': len(samples),
+    }
+
+
+def bench_throughput(server, client, sizes, repeat):
+    '''不同大小文件的get/put吞吐量'''
+    results = {}
+    for size in sizes:
+        name = 'f_%s.bin' % format_size(size)
+        write_random_file(os.path.join(server.home, name), size)
+        local = os.path.join(client.workdir, name)
+        get_times, put_times = [], []
+        for _ in range(repeat):
+            get_times.append(client.timed('get %s' % name))
+            if os.path.getsize(local) != size:
+                raise RuntimeError('下载的文件%s大小不正确' % name)
+            os.remove(os.path.join(server.home, name))
+            put_times.append(client.timed('put %s' % name))
+            if os.path.getsize(os.path.join(server.home, name)) != size:
+                raise RuntimeError('上传的文件%s大小不正确' % name)
+            os.remove(local)
+        os.remove(os.path.join(server.home, name))
+        results[format_size(size)] = {
+            'bytes': size,
+            'get_seconds': summarize(get_times),
+            'put_seconds': summarize(put_times),
+            'get_mb_per_s': size / statistics.median(get_times) / SIZE_UNITS['M'],
+            'put_mb_per_s': size / statistics.median(put_times) / SIZE_UNITS['M'],
+        }
+        print('  %-6s get %8.2fMB/s  put %8.2fMB/s' % (
+            format_size(size), results[format_size(size)]['get_mb_per_s'],
+            results[format_size(size)]['put_mb_per_s']))
+    return results
+
+
+def bench_ls(server, client, entry_counts, repeat):
+    '''ls的延迟与目录项数的关系，第一次为冷缓存，之后为热缓存'''
+    results = {}
+    for count in entry_counts:
+        dirname = 'ls_%s' % count
+        path = os.path.join(server.home, dirname)
+        os.makedirs(path)
+        for i in range(count):
+            open(os.path.join(path, 'entry_%06d.txt' % i), 'wb').close()
+        client.timed('cd /%s' % dirname)
+        cold = client.timed('ls')
+        warm = [client.timed('ls') for _ in range(repeat)]
+        client.timed('cd /')
+        results[str(count)] = {'cold_seconds': cold, 'warm_seconds': summarize(warm)}
+        print('  %-6s 冷 %8.2fms  热 %8.2fms' % (count, cold * 1000, statistics.median(warm) * 1000))
+    return results
+
+
+def bench_resume(server, client, size):
+    '''
+    断点续传的代价：把一半数据预先放在服务器的.part文件或本地的.download文件中，
+    测量续传的耗时，与完整传输和只传一半数据的理想耗时对比
+    '''
+    sys.path.insert(0, BASE_DIR)
+    from common import checksum
+    import jmftp
+    name = 'resume_%s.bin' % format_size(size)
+    half = size // 2 // checksum.BLOCK_SIZE * checksum.BLOCK_SIZE or size // 2
+    local = os.path.join(client.workdir, name)
+    remote = os.path.join(server.home, name)
+    write_random_file(local, size)
+    results = {'bytes': size, 'resumed_from': half}
+
+    # 上传续传：服务器上已有前一半的.part文件
+    full_put = client.timed('put %s' % name)
+    os.remove(remote)
+    with open(local, 'rb') as src, open(remote + '.part', 'wb') as dst:
+        dst.write(src.read(half))
+    with client.in_workdir():
+        client.client.upload_record[os.path.abspath(name)] = jmftp.make_upload_record(
+            name, os.stat(name))
+    resumed_put = client.timed('put %s' % name)
+    results['put'] = {'full_seconds': full_put, 'resume_seconds': resumed_put,
+                      'resume_ratio': resumed_put / full_put}
+
+    # 下载续传：本地已有前一半的.download文件和下载记录
+    os.remove(local)
+    full_get = client.timed('get %s' % name)
+    os.remove(local)
+    with open(remote, 'rb') as src, open(local + '.download', 'wb') as dst:
+        dst.write(src.read(half))
+        dst.truncate(size)
+    with client.in_workdir():
+        algorithm = checksum.choose_algorithm(checksum.supported_algorithms())
+        client.client.shelve_obj[name] = jmftp.new_record(
+            size, name + '.download', {'algorithm': algorithm, 'block_size': checksum.BLOCK_SIZE},
+            [[0, size, half]])
+        start = time.perf_counter()
+        client.client.resume_download(name)
+        resumed_get = time.perf_counter() - start
+    if os.path.getsize(local) != size:
+        raise RuntimeError('续传下载的文件大小不正确')
+    results['get'] = {'full_seconds': full_get, 'resume_seconds': resumed_get,
+                      'resume_ratio': resumed_get / full_get}
+    os.remove(local)
+    os.remove(remote)
+    print('  put 完整 %.3fs 续传 %.3fs   get 完整 %.3fs 续传 %.3fs' % (
+        full_put, resumed_put, full_get, resumed_get))
+    return results
+
+
+def worker(config_json):
+    '''并发测试的子进程：登录后下载同一个文件repeat次，输出每次的起止时间'''
+    config = json.loads(config_json)
+    client = BenchClient(config['port'], config['workdir'], config['compress'])
+    spans = []
+    for _ in range(config['repeat']):
+        start = time.time()
+        client.timed('get %s' % config['filename'])
+        spans.append((start, time.time()))
+        os.remove(os.path.join(config['workdir'], config['filename']))
+    client.close()
+    print(json.dumps(spans))
+
+
+def bench_concurrency(server, workdir, client_counts, size, repeat, compress):
+    '''多个客户端（各自一个进程）同时下载时的总吞吐量'''
+    name = 'concurrent_%s.bin' % format_size(size)
+    write_random_file(os.path.join(server.home, name), size)
+    results = {}
+    for count in client_counts:
+        processes = []
+        for i in range(count):
+            config = {'port': server.port, 'workdir': os.path.join(workdir, 'c%s_%s' % (count, i)),
+                      'filename': name, 'repeat': repeat, 'compress': compress}
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(config)],
+                stdout=subprocess.PIPE))
+        spans = []
+        for process in processes:
+            out, _ = process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError('并发测试的客户端进程出错')
+            spans.extend(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+        wall = max(end for _, end in spans) - min(start for start, _ in spans)
+        total = size * count * repeat
+        results[str(count)] = {
+            'clients': count,
+            'bytes': total,
+            'wall_seconds': wall,
+            'aggregate_mb_per_s': total / wall / SIZE_UNITS['M'],
+            'per_transfer_seconds': summarize([end - start for start, end in spans]),
+        }
+        print('  %-3s个客户端 总吞吐量 %8.2fMB/s' % (count, results[str(count)]['aggregate_mb_per_s']))
+    os.remove(os.path.join(server.home, name))
+    return results
+
+
+def run(options):
+    sizes = [parse_size(size) for size in (options.sizes or (QUICK_SIZES if options.quick else DEFAULT_SIZES)).split(',')]
+    ls_counts = [int(count) for count in options.ls_sizes.split(',')]
+    client_counts = [int(count) for count in options.clients.split(',')]
+    only = set(options.only.split(',')) if options.only else {'throughput', 'ls', 'resume', 'concurrency'}
+    workdir = tempfile.mkdtemp(prefix='jmftp-bench-')
+    server = BenchServer(os.path.join(workdir, 'server'), options.mode)
+    client = BenchClient(server.port, os.path.join(workdir, 'client'), options.compress)
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': options.mode,
+            'compress': options.compress,
+            'repeat': options.repeat,
+        },
+    }
+    try:
+        if 'throughput' in only:
+            print('get/put吞吐量：')
+            results['throughput'] = bench_throughput(server, client, sizes, options.repeat)
+        if 'ls' in only:
+            print('ls延迟：')
+            results['ls'] = bench_ls(server, client, ls_counts, options.repeat)
+        if 'resume' in only:
+            print('断点续传：')
+            results['resume'] = bench_resume(server, client, parse_size(options.resume_size))
+        if 'concurrency' in only:
+            print('并发下载：')
+            results['concurrency'] = bench_concurrency(
+                server, os.path.join(workdir, 'workers'), client_counts,
+                parse_size(options.concurrent_size), options.repeat, options.compress)
+    finally:
+        client.close()
+        server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+        print('结果已保存到%s' % options.output)
+    else:
+        print(text)
+
+
+def flatten(results, prefix=''):
+    '''把嵌套的结果展开为{路径: 数值}，用于比较'''
+    items = {}
+    for key, value in results.items():
+        if key == 'meta':
+            continue
+        path = '%s.%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            items.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not path.endswith(('.samples', '.bytes', '.clients', '.resumed_from')):
+            items[path] = value
+    return items
+
+
+def compare(old_file, new_file):
+    '''比较两次运行的结果，吞吐量越大越好，耗时越小越好'''
+    with open(old_file) as f:
+        old = flatten(json.load(f))
+    with open(new_file) as f:
+        new = flatten(json.load(f))
+    print('%-60s%14s%14s%10s' % ('指标', '旧', '新', '变化'))
+    for path in sorted(set(old) & set(new)):
+        if not old[path]:
+            continue
+        change = (new[path] - old[path]) / old[path] * 100
+        better = change > 0 if 'mb_per_s' in path else change < 0
+        print('%-60s%14.4f%14.4f%9.1f%%%s' % (path, old[path], new[path], change,
+                                              '' if abs(change) < 5 else (' +' if better else ' -')))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] | --compare OLD.json NEW.json')
+    parser.add_option('--sizes', help='get/put测试的文件大小，默认%s' % DEFAULT_SIZES)
+    parser.add_option('--quick', action='store_true', help='只测试%s的文件' % QUICK_SIZES)
+    parser.add_option('--repeat', type='int', default=3, help='每项测试重复的次数')
+    parser.add_option('--ls-sizes', default='10,100,1000,10000', help='ls测试的目录项数')
+    parser.add_option('--resume-size', default='64M', help='续传测试的文件大小')
+    parser.add_option('--clients', default='1,2,4,8', help='并发测试的客户端数')
+    parser.add_option('--concurrent-size', default='16M', help='并发测试中每个客户端下载的文件大小')
+    parser.add_option('--mode', default='threadpool', help='服务端并发模式：threadpool/asyncio')
+    parser.add_option('-z', '--compress', default='off', help='客户端的压缩设置')
+    parser.add_option('--only', help='只运行部分测试：throughput,ls,resume,concurrency')
+    parser.add_option('-o', '--output', help='把JSON结果写入文件')
+    parser.add_option('--compare', action='store_true', help='比较两个结果文件')
+    parser.add_option('--serve', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--worker', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.serve:
+        serve(options.serve)
+    elif options.worker:
+        worker(options.worker)
+    elif options.compare:
+        if len(args) != 2:
+            parser.error('--compare需要两个结果文件')
+        compare(*args)
+    else:
+        run(options)
+
+
+if __name__ == '__main__':
+    main()
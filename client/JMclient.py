@@ -1,23 +1,28 @@
 import optparse
-import socket
-import json
 import os
+import sys
 import shelve
+import tarfile
 import getpass
+import glob
 import time
 
+# 客户端与服务端共用的模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import compression
+import jmftp
+from jmftp import Connection, FTPError, AuthError, TransferError
+
 
 class FTPclient():
-    '''ftp客户端'''
-    MSG_SIZE = 1024
-
-    def __init__(self):
-        # 客户端用户名
-        self.username = None
-        # 当前服务器文件夹
-        self.current_dir = ''
+    '''ftp客户端的命令行界面，协议的收发、分段下载和断点续传都由jmftp.Connection完成，这里只负责解析命令和打印结果'''
+
+    def __init__(self, argv=None):
+        '''argv为命令行参数列表，None时读取sys.argv，脚本可以传入参数直接创建客户端'''
         # 文件下载记录
-        self.shelve_obj = shelve.open('download_record')
+        self.shelve_obj = shelve.open(jmftp.RECORD_FILE)
+        # 文件上传记录，键为本地文件的绝对路径
+        self.upload_record = shelve.open('upload_record')
         # 实例化一个语法解析对象
         parser = optparse.OptionParser()
         # 添加语法解析规则
@@ -28,8 +33,10 @@ class FTPclient():
                           dest='username', help='username info')
         parser.add_option('-p', '--password',
                           dest='password', help='password info')
+        parser.add_option('-z', '--compress', dest='compress', default='off',
+                          help='transfer compression: off/auto/zlib/zstd')
         # 语法检测
-        self.options, self.args = parser.parse_args()
+        self.options, self.args = parser.parse_args(argv)
         self.args_verification()
         # 建立连接
         self.make_connection()
@@ -39,18 +46,29 @@ class FTPclient():
         # 必须同时提供主机信息和端口信息
         if not self.options.server or not self.options.port:
             exit('错误: 必须提供端口和主机信息')
+        if self.options.compress not in ['off', 'auto'] + compression.supported_compressions():
+            exit('错误: 不支持的压缩方式%s' % self.options.compress)
         
 
     def make_connection(self):
-        '''建立socket链接'''
-        # 向服务器发起连接请求
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        '''建立控制连接'''
         try:
-            self.sock.connect((self.options.server, int(self.options.port)))
-        except:
+            # 本会话传输时请求的压缩算法，None表示不压缩，'auto'表示由服务器在双方都支持的算法中选择
+            self.conn = Connection(self.options.server, self.options.port,
+                                   compression=None if self.options.compress == 'off' else self.options.compress)
+        except (OSError, ValueError):
             exit('无法连接服务器，请检查服务器是否启动或已被占用')
         print('到%s:%s的控制连接建立成功' % (self.options.server, self.options.port))
-        
+
+    @property
+    def username(self):
+        '''登录的用户名'''
+        return self.conn.username
+
+    @property
+    def current_dir(self):
+        '''服务器上的当前目录'''
+        return self.conn.current_dir
 
     def interactive(self):
         '''处理client与server之间的所有交互'''
@@ -58,24 +76,40 @@ class FTPclient():
         if self.auth():
             # 检查是否有上次没有下载完的文件
             self.unfinished_check()
+            # 检查是否有上次没有上传完的文件
+            self.unfinished_upload_check()
             while True:
                 cmd = input('[%s %s]>>: ' %
                             (self.username, self.current_dir)).strip()
-                # 没有输入时，不执行任何操作
-                if not cmd:
-                    continue
                 # 判断命令是否为exit，如果是，则退出程序
                 if cmd == 'exit':
                     break
-                # 读取指令类型
-                cmd_list = cmd.split()
-                action_type = cmd_list[0]
-                # 使用反射调用响应的函数
-                if hasattr(self, '_%s' % action_type):
-                    func = getattr(self, '_%s' % action_type)
-                    func(cmd_list[1:])
-                else:
-                    print('命令错误')
+                self.run_command(cmd)
+
+    def run_command(self, cmd):
+        '''执行一条命令，如'get a.txt'，供交互循环和脚本调用，命令不存在时返回False'''
+        cmd_list = cmd.split()
+        # 没有输入时，不执行任何操作
+        if not cmd_list:
+            return True
+        # 读取指令类型
+        action_type = cmd_list[0]
+        # 使用反射调用响应的函数
+        if hasattr(self, '_%s' % action_type):
+            func = getattr(self, '_%s' % action_type)
+            try:
+                func(cmd_list[1:])
+            except ConnectionError:
+                exit('与服务器的连接已断开')
+            return True
+        print('命令错误')
+        return False
+
+    def close(self):
+        '''关闭控制连接和传输记录'''
+        self.conn.close()
+        self.shelve_obj.close()
+        self.upload_record.close()
 
     def parameter_check(self, args, min_args=None, max_args=None, exact_args=None):
         '''检查参数个数的合法性'''
@@ -99,204 +133,342 @@ class FTPclient():
     def _get(self, cmd_args):
         '''从FTP服务器中下载文件'''
         '''
+           用法：get [-n 段数] 文件名，get -r 目录名
            函数执行流程：
-           1. 获取文件名
-           2. 发送到FTP服务器
-           3. 等待服务器返回消息
-            3.1 如果文件存在，则拿到文件大小
-             3.1.1 循环接收文件
-            3.2 如果文件不存在，返回错误码
+           1. 下载到.download文件，边收边计算块摘要，进度保存在下载记录中，中断后可以续传
+           2. 指定了段数时把文件分成若干段，每段用一个独立的数据连接并行下载
+           3. 与服务器的块摘要逐块核对，不一致的块重新下载，全部一致后改名
         '''
         if self.parameter_check(cmd_args, min_args=1):
-            # 获取文件名
+            # get -r 目录：把整个目录打包下载
+            if cmd_args[0] == '-r':
+                if len(cmd_args) < 2:
+                    print('用法：get -r 目录名')
+                    return
+                return self.get_bundle(cmd_args[1:], recursive=True)
+            segments = 1
+            # get -n 段数 文件名：用多个连接分段下载
+            if cmd_args[0] == '-n':
+                if len(cmd_args) < 3 or not cmd_args[1].isdigit() or int(cmd_args[1]) < 1:
+                    print('用法：get [-n 段数] 文件名')
+                    return
+                segments = int(cmd_args[1])
+                cmd_args = cmd_args[2:]
             filename = cmd_args[0]
-            # 发送到FTP服务器
-            self.send_msg('get', filename=filename)
-            # 等待服务器返回消息
-            response = self.get_response()
-            # print(response)
-            if response.get('status_code') == 301:
-                # 文件存在，获取文件大小
-                file_size = response.get('file_size')
-                print('找到该文件，大小为'+str(file_size))
-                # 记录接收的文件
-                file_abs_path = os.path.join(self.current_dir, filename)
-                self.shelve_obj[file_abs_path] = [file_size, "%s.download" % filename]
-                # 循环接收文件
-                with open("%s.download" % filename, 'wb') as f:
-                    # 打印进度条
-                    progress_generator = self.progress_bar(file_size)
-                    progress_generator.__next__()
-                    
-                    recieved_size = 0
-                    while recieved_size < file_size:
-                        if file_size - recieved_size < 8192:
-                            data = self.sock.recv(
-                                file_size - recieved_size)
-                        else:
-                            data = self.sock.recv(8192)
-                        f.write(data)
-                        recieved_size += len(data)
-                        progress_generator.send(recieved_size)
-                    else:
-                        print()
-                        print('---文件 [%s] 接收完成, 文件大小为: %s' %
-                              (filename, recieved_size))
-                # 正常下载完则进行改名
-                os.rename("%s.download" % filename, filename)
-                # 文件正常接收完的话关闭shelve
-                del self.shelve_obj[file_abs_path]
+            message = '找到该文件' if segments == 1 else '找到该文件，分%s段下载' % segments
+            self.run_download(lambda progress: self.conn.download(
+                filename, filename, progress, self.shelve_obj, segments), message)
+
+    def resume_download(self, file_abs_path):
+        '''续传：先核对已下载部分的块摘要，再下载损坏的块和未完成的部分'''
+        return self.run_download(lambda progress: self.conn.resume(
+            file_abs_path, self.shelve_obj, progress), '续传文件')
+
+    def run_download(self, download, message):
+        '''执行一次下载并打印结果，返回是否成功；中断时进度已经保存在下载记录中'''
+        try:
+            result = download(self.progress_printer(message))
+        except KeyboardInterrupt:
+            print()
+            print('下载已中止，下次登录时可以续传')
+            return False
+        except TransferError as e:
+            print()
+            print(e)
+            return False
+        except FTPError:
+            print('文件不存在!')
+            return False
+        except OSError as e:
+            print()
+            print('下载中断（%s），下次登录时可以续传' % e)
+            return False
+        print()
+        if result['repaired']:
+            print('%s个数据块与服务器不一致，已重新下载' % result['repaired'])
+        print('---文件 [%s] 接收完成, 文件大小为: %s' % (result['filename'], result['size']))
+        print('文件校验通过，摘要为%s' % result['digest'])
+        return True
+
+    def _mget(self, cmd_args):
+        '''按文件名或通配符批量下载服务器当前目录下的文件：mget *.log *.csv'''
+        if self.parameter_check(cmd_args, min_args=1):
+            self.get_bundle(cmd_args, recursive=False)
+
+    def get_bundle(self, paths, recursive):
+        '''
+        批量下载：服务器把所有匹配的文件打包成一个tar流在一条数据连接上发送，
+        客户端边收边解包，大量小文件也只需要一次往返
+        '''
+        try:
+            result = self.conn.get_bundle(paths, recursive, progress=self.progress_printer('批量下载'))
+        except KeyboardInterrupt:
+            print()
+            print('批量下载已中止')
+            return
+        except FTPError:
+            print('没有匹配的文件!')
+            return
+        except (OSError, tarfile.TarError) as e:
+            print()
+            print('批量下载中断（%s）' % e)
+            return
+        print()
+        for name in result['skipped']:
+            print('跳过不安全的路径：%s' % name)
+        print('---共接收%s个文件, 大小为: %s' % (result['files'], result['size']))
+
+    def load_record(self, file_abs_path):
+        '''读取下载记录，旧版本的列表格式转换为字典格式'''
+        record = self.shelve_obj[file_abs_path]
+        if isinstance(record, dict):
+            return record
+        record = jmftp.upgrade_record(record)
+        self.shelve_obj[file_abs_path] = record
+        return record
+
+    def _compress(self, cmd_args):
+        '''设置本会话传输时是否压缩：compress [off|auto|zlib|zstd] [级别]'''
+        if self.parameter_check(cmd_args, max_args=2):
+            if not cmd_args:
+                print('当前压缩方式：%s，级别：%s，本地支持：%s' % (
+                    self.conn.compression or 'off', self.conn.compression_level or '默认',
+                    '/'.join(compression.supported_compressions())))
+                return
+            if cmd_args[0] not in ['off', 'auto'] + compression.supported_compressions():
+                print('用法：compress [off|auto|%s] [级别]' % '|'.join(compression.supported_compressions()))
+                return
+            if len(cmd_args) > 1 and not cmd_args[1].isdigit():
+                print('压缩级别必须是整数')
+                return
+            self.conn.compression = None if cmd_args[0] == 'off' else cmd_args[0]
+            self.conn.compression_level = int(cmd_args[1]) if len(cmd_args) > 1 else None
+
+    def abort_transfer(self, transfer_id):
+        '''通过控制连接中止服务器上正在进行的传输'''
+        print()
+        try:
+            response = self.conn.abort(transfer_id)
+        except FTPError:
+            print('传输已经结束')
+        else:
+            print('传输已中止，已传输%s字节，下次登录时可以续传' % response.get('done'))
+
+    def _status(self, cmd_args):
+        '''查看服务器上本会话正在进行的传输'''
+        if self.parameter_check(cmd_args, exact_args=0):
+            transfers = self.conn.status()
+            if not transfers:
+                print('没有正在进行的传输')
+            for transfer in transfers:
+                print('%s\t%s\t%s\t%s/%s\t%s' % (
+                    transfer['transfer_id'], transfer['direction'], transfer['filename'],
+                    transfer['done'], transfer['size'], transfer['state']))
+
+    def _abort(self, cmd_args):
+        '''中止服务器上正在进行的传输'''
+        if self.parameter_check(cmd_args, exact_args=1):
+            self.abort_transfer(cmd_args[0])
 
     def _put(self, cmd_args):
         '''上传文件到FTP服务器
         1. 确保本地文件存在
-        2. 发送文件名+文件大小到FTP服务器
-        3. 打开文件发送给服务器
+        2. 上次没有上传完且本地文件没有变化时，从服务器已经收到的位置继续上传
+        3. 打开文件发送给服务器，并核对服务器返回的摘要
         '''
         if self.parameter_check(cmd_args, exact_args=1):
             local_file = cmd_args[0]
             if os.path.isfile(local_file):
-                total_size = os.path.getsize(local_file)
-                self.send_msg('put', file_size=total_size,
-                              local_file=local_file)
-                # 打印进度条
-                progress_generator = self.progress_bar(total_size)
-                progress_generator.__next__()
-
-                upload_size = 0
-                with open(local_file, 'rb') as f:
-                    for line in f:
-                        self.sock.send(line)
-                        upload_size += len(line)
-                        progress_generator.send(upload_size)
-                    else:
-                        print()
-                        print('上传完成!'.center(50, '-'))
+                # 上传到服务器的当前目录，文件名与本地文件相同
+                self.upload_file(local_file)
             else:
                 print('文件不存在!')
 
+    def upload_file(self, local_file, abs_filename=None):
+        '''上传本地文件到服务器的abs_filename，默认为当前目录下的同名文件，返回是否成功'''
+        try:
+            result = self.conn.upload(local_file, abs_filename,
+                                      self.progress_printer('上传文件：%s' % local_file), self.upload_record)
+        except KeyboardInterrupt:
+            print()
+            print('上传已中止，再次上传该文件时会从断点继续')
+            return False
+        return self.print_upload(result)
+
+    def print_upload(self, result):
+        '''打印一个文件的上传结果，result为jmftp返回的结果或异常，返回是否成功'''
+        if isinstance(result, TransferError):
+            print()
+            print(('上传失败：%s' % result).center(50, '-'))
+            return False
+        if isinstance(result, FTPError):
+            print(result.status_msg)
+            return False
+        if isinstance(result, OSError):
+            print()
+            print('上传中断（%s），再次上传该文件时会从断点继续' % result)
+            return False
+        print()
+        if result['offset']:
+            print('服务器上已有%s字节，从断点继续上传' % result['offset'])
+        if result['reused']:
+            print('服务器已有%s块，没有重复发送' % result['reused'])
+        print('上传完成!'.center(50, '-'))
+        print('文件校验通过，摘要为%s，保存为%s' % (result['digest'], result['filename']))
+        return True
+
+    def _mput(self, cmd_args):
+        '''批量上传本地文件到服务器的当前目录，支持通配符：mput *.log data/*.csv
+        连续发出一批put请求后再读取响应，不必每个文件都等一次往返
+        '''
+        if self.parameter_check(cmd_args, min_args=1):
+            local_files = sorted(set(name for pattern in cmd_args for name in glob.glob(pattern)
+                                     if os.path.isfile(name)))
+            if not local_files:
+                print('没有匹配的文件!')
+                return
+            # 每个文件第一次报告进度时开始打印它的进度条
+            printers = {}
+
+            def progress(local_file, sent, size):
+                if local_file not in printers:
+                    printers[local_file] = self.progress_printer('上传文件：%s' % local_file)
+                printers[local_file](sent, size)
+
+            done = 0
+            try:
+                for local_file, result in self.conn.iter_put(local_files, progress, self.upload_record):
+                    if isinstance(result, FTPError) and not isinstance(result, TransferError):
+                        # 服务器拒绝了这个文件的put请求
+                        print('%s: %s' % (local_file, result.status_msg))
+                    else:
+                        done += self.print_upload(result)
+            except KeyboardInterrupt:
+                print()
+                print('批量上传已中止，再次上传这些文件时会从断点继续')
+                return
+            print('共上传%s/%s个文件' % (done, len(local_files)))
+
     def _ls(self, cmd_args):
         '''列出FTP服务器中的文件'''
         '''
+           用法：ls [-s name|size|mtime|none] [-r] [通配符]
            函数执行流程：
-           1. 发送到FTP服务器
+           1. 把排序方式和过滤条件发送到FTP服务器
            2. 等待服务器返回消息
-           3. 打印文件列表
+           3. 服务器分页返回已经排好序的文件列表，收到一页打印一页
         '''
-        # 判断参数个数是否小于2
-        if self.parameter_check(cmd_args, exact_args=0):
-            # 发送到FTP服务器
-            self.send_msg('ls')
-            # 等待服务器返回消息
-            response = self.get_response()
-            # print(response)
-            if response.get('status_code') == 400:
-                # 文件存在，打印文件列表
-                res = response.get('res')
-                print('文件名--------文件大小--------创建时间')
-                for file in sorted(res, key=lambda x: x['is_dir'], reverse=True):
-                    if file['is_dir']:
-                        print('%s\t\t<DIR>' % file['filename'])
-                    else:
-                        now = file['time']
-                        timeArray = time.localtime(now)
-                        otherStyleTime = time.strftime("%Y-%m-%d %H:%M:%S", timeArray)
-                        print('%s\t%s\t%s' % (file['filename'], file['size'],otherStyleTime))
+        if self.parameter_check(cmd_args, max_args=4):
+            sort, reverse, pattern = 'name', False, None
+            args = list(cmd_args)
+            while args:
+                arg = args.pop(0)
+                if arg == '-s' and args:
+                    sort = args.pop(0)
+                elif arg == '-r':
+                    reverse = True
+                else:
+                    pattern = arg
+            try:
+                # 服务器分页返回，收到一页打印一页
+                entries = self.conn.iter_ls(pattern, sort, reverse)
+                file = next(entries, None)
+            except FTPError:
+                print('列出目录失败')
+                return
+            print('文件名--------文件大小--------创建时间')
+            while file is not None:
+                if file['is_dir']:
+                    print('%s\t\t<DIR>' % file['filename'])
+                else:
+                    now = file['time']
+                    timeArray = time.localtime(now)
+                    otherStyleTime = time.strftime("%Y-%m-%d %H:%M:%S", timeArray)
+                    print('%s\t%s\t%s' % (file['filename'], file['size'],otherStyleTime))
+                file = next(entries, None)
 
     def _cd(self, cmd_args):
         '''改变当前目录文件夹'''
         if self.parameter_check(cmd_args, min_args=1):
             target_dir = cmd_args[0]
-            self.send_msg('cd', target_dir=target_dir)
-            response = self.get_response()
-            if response.get('status_code') == 350:
+            try:
+                self.conn.cd(target_dir)
                 print('改变当前目录文件夹成功')
-                self.current_dir = response.get('relative_dir')
-                # print('relative_dir:%s' % response.get('relative_dir'))
-                # print(response)
-            else:
+            except FTPError:
                 print('改变当前目录文件夹失败')
-                # print(response)
 
     def auth(self):
-        '''用户认证'''
+        '''用户认证，命令行中提供了用户名和密码时直接使用，不再提示输入'''
+        if self.options.username and self.options.password:
+            return self.login(self.options.username, self.options.password)
         count = 0
         # 认证三次，三次错误则退出程序
         while count < 3:
-            username = input('username: ').strip()
+            username = self.options.username or input('username: ').strip()
             if not username:
                 continue
             password = getpass.getpass('password: ').strip()
-            cmd = {
-                'action_type': 'auth',
-                'username': username,
-                'password': password
-            }
-            # 发送认证信息
-            self.sock.send(json.dumps(cmd).encode('utf-8'))
-            # 接收服务器的返回
-            response = self.get_response()
-            # print('response:', response)
-            if response.get('status_code') == 200:
-                self.username = username
-                print('登录成功')
+            if self.login(username, password):
                 return True
-            else:
-                print('登录失败')
-                count += 1
-
-    def get_response(self):
-        '''接收服务器的响应'''
-        data = self.sock.recv(self.MSG_SIZE).decode('utf-8')
-        return json.loads(data)
-
-    def send_msg(self, action_type, **kwargs):
-        '''打包并发送消息到服务器'''
-        msg_data = {
-            'action_type': action_type,
-        }
-        msg_data.update(kwargs)
-        msg_data['fill'] = ''
-
-        bytes_msg = json.dumps(msg_data).encode('utf-8')
-        if len(bytes_msg) < self.MSG_SIZE:
-            msg_data['fill'] = msg_data['fill'].zfill(
-                self.MSG_SIZE - len(bytes_msg))
-            bytes_msg = json.dumps(msg_data).encode('utf-8')
-        self.sock.send(bytes_msg)
+            count += 1
+        return False
+
+    def login(self, username, password):
+        '''发送认证信息，返回是否登录成功'''
+        try:
+            try:
+                self.conn.login(username, password)
+            except ConnectionError:
+                # 输入用户名和密码的时间超过了服务器的登录超时，重新连接后再试一次
+                self.conn.close()
+                self.make_connection()
+                self.conn.login(username, password)
+        except AuthError as e:
+            print('登录失败' if e.status_code == 201 else '登录失败：%s' % e)
+            return False
+        print('登录成功')
+        return True
 
     def _mkdir(self, cmd_args):
         '''创建目录'''
         if self.parameter_check(cmd_args, exact_args=1):
             dirname = cmd_args[0]
-            self.send_msg('mkdir', dirname=dirname)
-            response = self.get_response()
-            if response.get('status_code') == 500:
+            try:
+                self.conn.mkdir(dirname)
                 print('创建目录成功')
-            else:
+            except FTPError:
                 print('创建目录失败')
-            # print(response)
 
     def _rm(self, cmd_args):
         '''删除文件或目录'''
         if self.parameter_check(cmd_args, exact_args=1):
             filename = cmd_args[0]
-            self.send_msg('rm', filename=filename)
-            response = self.get_response()
-            if response.get('status_code') == 600:
-                print('删除文件成功')
-            elif response.get('status_code') == 601:
-                print('删除目录成功')
-            else:
+            try:
+                kind = self.conn.rm(filename)
+            except FTPError:
                 print('删除文件或目录失败')
-            # print(response) 
+                return
+            print('删除文件成功' if kind == 'file' else '删除目录成功')
+
+    def progress_printer(self, message):
+        '''返回供jmftp调用的progress(已完成的字节数, 总字节数)，第一次调用时打印message和总大小，之后更新进度条'''
+        progress_generator = None
+
+        def progress(done, total_size):
+            nonlocal progress_generator
+            if progress_generator is None:
+                print('%s，大小为%s' % (message, total_size))
+                progress_generator = self.progress_bar(total_size)
+                progress_generator.__next__()
+            progress_generator.send(done)
+        return progress
 
     def progress_bar(self, total_size, current_percent = 0):
         '''进度条打印'''
         last_percent = -1
         while True:
             recieved_size = yield current_percent
-            current_percent = int(recieved_size/total_size*100)
+            current_percent = int(recieved_size/max(total_size, 1)*100)
             if current_percent > last_percent:
                 print('#' * int(current_percent/2) +
                       '{percent}%'.format(percent=current_percent), end='\r', flush=True)
@@ -307,12 +479,13 @@ class FTPclient():
         if list(self.shelve_obj.keys()):
             print('检测到有未完成的文件，是否重传？')
             for index, abs_file in enumerate(self.shelve_obj.keys()):
-                recieved_size = os.path.getsize(self.shelve_obj[abs_file][1])
+                record = self.load_record(abs_file)
+                recieved_size = jmftp.record_progress(record)
                 print('%s. %s %s %s %s' % (index, 
                         abs_file,  
-                        self.shelve_obj[abs_file][0], 
+                        record['file_size'], 
                         recieved_size, 
-                        int(recieved_size/self.shelve_obj[abs_file][0]*100)
+                        int(recieved_size/max(record['file_size'], 1)*100)
                     ),end='%\n')
             while True:
                 choice = input("[select file to resend]").strip()
@@ -325,47 +498,37 @@ class FTPclient():
                     choice = int(choice)
                     if choice >=0 and choice <= index:
                         select_file = list(self.shelve_obj.keys())[choice]
-                        aready_received_size = os.path.getsize(self.shelve_obj[select_file][1])
                         print('重传文件：%s' % select_file)
-                        # 发送重传请求
-                        self.send_msg('resend', file_size=self.shelve_obj[select_file][0],
-                            recieved_size = aready_received_size,
-                            abs_filename=select_file)
-                        # 获得服务器响应
-                        response = self.get_response()
-                        if response.get('status_code') == 301:
-                            local_filename = self.shelve_obj[select_file][1]
-                            with open(local_filename,'ab') as f:
-                                total_size = self.shelve_obj[select_file][0]
-                                # 创建进度条
-                                progress_bar = self.progress_bar(total_size, aready_received_size)
-                                progress_bar.__next__()
-
-                                recv_size = aready_received_size
-                                while recv_size < total_size:
-                                    if total_size - recv_size < 8096:
-                                        data = self.sock.recv(total_size - recv_size)
-                                    else:
-                                        data = self.sock.recv(8096)
-                                    recv_size += len(data)
-                                    f.write(data)
-                                    progress_bar.send(recv_size)
-                                else:
-                                    print('file resend done!')
-                            # 删除
-                            del self.shelve_obj[select_file]
-                            # 改名字
-                            os.rename(local_filename, local_filename.replace('.download',''))
-                            break
-                        else:
-                            print(response.get('status_msg'))
+                        # 先核对已下载部分，再只下载损坏的块和未完成的部分
+                        self.resume_download(select_file)
+                        break
         if list(self.shelve_obj.keys()):
             self.unfinished_check()    
 
+    def unfinished_upload_check(self):
+        '''检查是否有没有上传完的文件，按照用户指令决定是否续传'''
+        while list(self.upload_record.keys()):
+            print('检测到有未完成的上传，是否续传？')
+            local_files = list(self.upload_record.keys())
+            for index, local_file in enumerate(local_files):
+                record = self.upload_record[local_file]
+                print('%s. %s -> %s %s' % (index, local_file, record['abs_filename'], record['file_size']))
+            choice = input("[select file to resume upload]").strip()
+            if choice == 'exit':
+                return
+            if choice.isdigit() and int(choice) < len(local_files):
+                local_file = local_files[int(choice)]
+                if not os.path.isfile(local_file):
+                    print('本地文件%s已不存在，删除上传记录' % local_file)
+                    del self.upload_record[local_file]
+                    continue
+                print('续传文件：%s' % local_file)
+                self.upload_file(local_file, self.upload_record[local_file]['abs_filename'])
+
 
 
 if __name__ == '__main__':
     client = FTPclient()
     client.interactive()    # 交互
     
-    # /usr/bin/python3 /Users/linjiemu/Desktop/FTP/JerryMuFTP/client/JMclient.py -s  180.76.187.225  -P 20000
\ No newline at end of file
+    # /usr/bin/python3 /Users/linjiemu/Desktop/FTP/JerryMuFTP/client/JMclient.py -s  180.76.187.225  -P 20000
@@ -0,0 +1,1004 @@
+'''
+FTP客户端库：不依赖命令行参数和终端输入，方法直接返回结果或抛出异常，供脚本和其他服务调用
+
+    from jmftp import Connection, ConnectionPool
+
+    with Connection('127.0.0.1', 20000, 'Root', 'abc123') as conn:
+        conn.put(b'hello', 'a.txt')
+        data = conn.get_bytes('a.txt')
+        for entry in conn.ls():
+            print(entry['filename'], entry['size'])
+
+    pool = ConnectionPool('127.0.0.1', 20000, 'Root', 'abc123', size=8)
+    pool.get('a.txt', '/tmp/a.txt')     # 多个线程可以同时使用，已登录的连接会被复用
+
+远程路径都相对于连接的当前目录，以'/'开头的cd路径从用户根目录开始
+'''
+import collections
+import contextlib
+import io
+import os
+import socket
+import sys
+import tarfile
+import threading
+import time
+
+# 客户端与服务端共用的模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import checksum
+from common import compression
+from common import protocol
+
+# 数据连接每次接收的最大字节数
+RECV_SIZE = 64 * 1024
+# 批量上传时连续发出的请求数
+PIPELINE_WINDOW = 16
+# 下载进度写入下载记录的间隔（秒）
+RECORD_SAVE_INTERVAL = 1
+
+
+class FTPError(Exception):
+    '''服务器返回了表示失败的状态码'''
+
+    def __init__(self, response, message=None):
+        self.response = response
+        self.status_code = response.get('status_code')
+        self.status_msg = response.get('status_msg')
+        super().__init__(message or '%s %s' % (self.status_code, self.status_msg))
+
+
+class AuthError(FTPError):
+    '''用户名或密码错误'''
+
+
+class TransferError(FTPError):
+    '''数据传输不完整，或者传输结果与服务器的摘要不一致'''
+
+
+def recv_chunks(data_sock, count, algorithm=None):
+    '''从数据连接接收count个字节，algorithm不为None时边收边解压，逐块返回解压后的数据'''
+    decompressor = compression.Decompressor(algorithm, count) if algorithm else None
+    received = 0
+    while received < count or (decompressor and not decompressor.eof):
+        data = data_sock.recv(RECV_SIZE if decompressor else min(RECV_SIZE, count - received))
+        if not data:
+            raise ConnectionError('数据连接中断')
+        if not decompressor:
+            received += len(data)
+            yield data
+            continue
+        # 按块解压，异常的压缩流不会一次解压出远超count的数据
+        try:
+            for chunk in decompressor.decompress(data):
+                received += len(chunk)
+                yield chunk
+        except ValueError:
+            raise ConnectionError('解压后的数据超过了请求的长度')
+
+
+def ordered_blocks(blocks):
+    '''把{块序号: 摘要}转换为按顺序排列的列表'''
+    return [blocks[index] for index in range(len(blocks))]
+
+
+# ---------- 下载记录 ----------
+# 未完成的下载记录在当前目录的shelve文件中，键为服务器上的文件路径，命令行客户端和异步客户端共用
+RECORD_FILE = 'download_record'
+
+
+def new_record(file_size, local_file, response, segments):
+    '''
+    生成下载记录
+    segments中每段为[起始位置, 结束位置, 已下载到的位置]，blocks保存已经算出的块摘要
+    '''
+    return {
+        'file_size': file_size,
+        'local_file': local_file,
+        'segments': segments,
+        'algorithm': response.get('algorithm'),
+        'block_size': response.get('block_size'),
+        'blocks': {},
+    }
+
+
+def upgrade_record(record):
+    '''旧版本的列表格式的下载记录转换为字典格式'''
+    if len(record) > 2:
+        # [文件大小, 本地文件名, 分段列表]
+        file_size, local_file, segments = record
+    else:
+        # [文件大小, 本地文件名]，本地文件的大小就是已下载的位置
+        file_size, local_file = record
+        received = os.path.getsize(local_file) if os.path.isfile(local_file) else 0
+        segments = [[0, file_size, min(received, file_size)]]
+    return new_record(file_size, local_file,
+                      {'algorithm': 'blake2b', 'block_size': checksum.BLOCK_SIZE}, segments)
+
+
+def record_progress(record):
+    '''根据下载记录计算已经收到的字节数'''
+    # 文件是预先分配好大小的，各段未下载的部分之外都已经收到
+    return record['file_size'] - sum(segment[1] - segment[2] for segment in record['segments'])
+
+
+def segment_hasher(fd, segment, record):
+    '''
+    为从segment[2]开始接收的数据创建块摘要对象
+    从块的中间开始接收时，先读出本地已有的前半块，块摘要总是从块边界开始计算
+    '''
+    block_size = record['block_size']
+    block_start = segment[2] - segment[2] % block_size
+    hasher = checksum.BlockHasher(record['algorithm'], block_size, block_start)
+    if block_start < segment[2]:
+        hasher.update(os.pread(fd, segment[2] - block_start, block_start))
+    return hasher
+
+
+def collect_blocks(record, hasher, segment):
+    '''把hasher中已经算完的块摘要存入下载记录，最后一段收到文件末尾时最后一个不满的块也已经完整'''
+    if segment[2] >= segment[1] and segment[1] == record['file_size']:
+        record['blocks'].update(hasher.finish())
+    elif hasher.blocks:
+        record['blocks'].update(hasher.blocks)
+        hasher.blocks = {}
+
+
+def fill_block_hashes(record):
+    '''已经完整下载但还没有摘要的块（例如旧版本的下载记录），从本地文件中读出来计算'''
+    block_size = record['block_size']
+    # 还没有下载的区间
+    missing = [(segment[2], segment[1]) for segment in record['segments'] if segment[2] < segment[1]]
+    fd = os.open(record['local_file'], os.O_RDONLY)
+    try:
+        for index in range(checksum.block_count(record['file_size'], block_size)):
+            if index in record['blocks']:
+                continue
+            start = index * block_size
+            end = min(start + block_size, record['file_size'])
+            if any(start < missing_end and missing_start < end
+                   for missing_start, missing_end in missing):
+                continue
+            record['blocks'][index] = checksum.hash_range(fd, record['algorithm'], start, end)
+    finally:
+        os.close(fd)
+
+
+def compare_blocks(record, remote_blocks):
+    '''找出本地已有摘要但与服务器不一致的块，把它们重新加入待下载的分段'''
+    bad_blocks = [index for index, block in record['blocks'].items()
+                  if index >= len(remote_blocks) or remote_blocks[index] != block]
+    block_size = record['block_size']
+    # 只保留还没有完成的分段
+    record['segments'] = [segment for segment in record['segments'] if segment[2] < segment[1]]
+    for index in sorted(bad_blocks):
+        del record['blocks'][index]
+        start = index * block_size
+        record['segments'].append([start, min(start + block_size, record['file_size']), start])
+    return bad_blocks
+
+
+def record_matches(record, response):
+    '''服务器返回的文件大小、摘要算法和块大小与下载记录一致时才能续传'''
+    return (response.get('file_size') == record['file_size'] and
+            response.get('algorithm') == record['algorithm'] and
+            response.get('block_size') == record['block_size'])
+
+
+def make_upload_record(abs_filename, st):
+    '''上传记录，本地文件的大小或修改时间变了就不能续传'''
+    return {'abs_filename': abs_filename, 'file_size': st.st_size, 'mtime': st.st_mtime}
+
+
+def bundle_local_path(name):
+    '''tar包内的路径转换为本地路径，绝对路径或越出当前目录的路径返回None'''
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == '..' or path.startswith('..' + os.sep):
+        return None
+    return path
+
+
+class Connection(object):
+    '''
+    一条已登录的控制连接
+    提供了用户名和密码时创建后立即登录；compression为None（不压缩）、'auto'或具体的算法名
+    '''
+
+    def __init__(self, host, port, username=None, password=None,
+                 compression=None, compression_level=None, timeout=None):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.username = None
+        # 登录后服务器签发的令牌
+        self.token = None
+        # 当前服务器目录，相对于用户根目录
+        self.current_dir = ''
+        # 服务器开启去重存储时的分块大小，上传前先发送块摘要列表
+        self.dedup_chunk_size = None
+        self.sock = socket.create_connection((self.host, self.port), timeout)
+        # 按帧收发控制消息
+        self.stream = protocol.MessageStream(self.sock)
+        self.closed = False
+        if username is not None:
+            self.login(username, password or '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''关闭控制连接'''
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+    # ---------- 控制消息 ----------
+
+    def send(self, action_type, **kwargs):
+        '''打包并发送消息到服务器，不等待响应'''
+        msg_data = {'action_type': action_type}
+        msg_data.update(kwargs)
+        self.stream.send_message(msg_data)
+
+    def recv(self):
+        '''接收服务器的一条响应'''
+        response = self.stream.recv_message()
+        if response is None:
+            self.closed = True
+            raise ConnectionError('与服务器的连接已断开')
+        return response
+
+    def request(self, action_type, expect=None, **kwargs):
+        '''发送请求并等待响应，expect为期望的状态码，收到其他状态码时抛出FTPError'''
+        self.send(action_type, **kwargs)
+        response = self.recv()
+        if expect is not None and response.get('status_code') not in expect:
+            raise FTPError(response)
+        return response
+
+    def open_data(self, response):
+        '''连接服务器为本次传输分配的数据端口，并发送票据'''
+        data_sock = socket.create_connection((self.host, response.get('data_port')), self.timeout)
+        data_sock.sendall(response.get('ticket').encode('ascii'))
+        return data_sock
+
+    def remote_path(self, filename):
+        '''相对于当前目录的文件名转换为相对于用户根目录的路径'''
+        return os.path.join(self.current_dir, filename)
+
+    def compression_args(self, name=None, sample=None):
+        '''
+        请求中附带的压缩参数，没有开启压缩时为空
+        上传时先按文件名name的扩展名和文件开头的采样判断是否值得压缩，没有给出sample时从文件name中读取
+        '''
+        if not self.compression:
+            return {}
+        if name is not None:
+            if sample is None:
+                with open(name, 'rb') as f:
+                    sample = f.read(compression.SAMPLE_SIZE)
+            if not compression.worth_compressing(name, sample):
+                return {}
+        offered = compression.supported_compressions() if self.compression == 'auto' else [self.compression]
+        return {'compression': offered, 'compression_level': self.compression_level}
+
+    # ---------- 会话 ----------
+
+    def login(self, username, password):
+        '''登录，失败时抛出AuthError'''
+        # 发送认证信息，同时告知服务器本端支持的编码方式
+        response = self.request('auth', username=username, password=password,
+                                protocol_version=protocol.PROTOCOL_VERSION,
+                                codecs=protocol.supported_codecs())
+        if response.get('status_code') != 200:
+            raise AuthError(response)
+        self.username = username
+        # 附加连接使用的令牌
+        self.token = response.get('token')
+        self.dedup_chunk_size = response.get('dedup_chunk_size')
+        # 切换到协商好的编码方式
+        self.stream.set_codec(response.get('codec', 'json'))
+        return response
+
+    def cd(self, target_dir):
+        '''切换目录，返回新的当前目录'''
+        response = self.request('cd', expect=(350,), target_dir=target_dir)
+        self.current_dir = response.get('relative_dir')
+        return self.current_dir
+
+    def iter_ls(self, pattern=None, sort='name', reverse=False):
+        '''
+        逐项返回当前目录的目录项，服务器分页发送，收到一页返回一页
+        没有迭代完就停止时读完剩下的页，控制连接可以继续使用
+        '''
+        self.request('ls', expect=(400,), sort=sort, reverse=reverse, pattern=pattern)
+        last = False
+        try:
+            while not last:
+                page = self.recv()
+                last = page.get('last')
+                for entry in page.get('res'):
+                    yield entry
+        except GeneratorExit:
+            while not last:
+                last = self.recv().get('last')
+            raise
+
+    def ls(self, pattern=None, sort='name', reverse=False):
+        '''返回当前目录的所有目录项，每项为{filename, size, time, is_dir}'''
+        return list(self.iter_ls(pattern, sort, reverse))
+
+    def mkdir(self, dirname):
+        '''在当前目录下创建目录'''
+        self.request('mkdir', expect=(500,), dirname=dirname)
+
+    def rm(self, filename):
+        '''删除当前目录下的文件或目录，返回'file'或'dir' '''
+        response = self.request('rm', expect=(600, 601), filename=filename)
+        return 'file' if response.get('status_code') == 600 else 'dir'
+
+    def stat(self, filename):
+        '''返回文件的大小、修改时间和是否为目录'''
+        return self.request('stat', expect=(303,), filename=filename,
+                            algorithms=checksum.supported_algorithms(), block_size=checksum.BLOCK_SIZE)
+
+    def checksum(self, filename, algorithm=None, block_size=None):
+        '''返回文件的块摘要和整个文件的摘要'''
+        algorithms = [algorithm] if algorithm else checksum.supported_algorithms()
+        return self.request('checksum', expect=(310,), abs_filename=self.remote_path(filename),
+                            algorithms=algorithms, block_size=block_size or checksum.BLOCK_SIZE)
+
+    def status(self):
+        '''返回本会话在服务器上正在进行的传输'''
+        return self.request('status').get('transfers')
+
+    def abort(self, transfer_id):
+        '''中止服务器上正在进行的传输，传输已经结束时抛出FTPError'''
+        return self.request('abort', expect=(305,), transfer_id=transfer_id)
+
+    # ---------- 下载 ----------
+
+    def iter_get(self, filename, progress=None):
+        '''
+        下载文件，逐块返回文件内容，全部收到后与服务器的摘要核对，不一致时抛出TransferError
+        progress(已收到的字节数)在每收到一块后调用
+        '''
+        response = self.request('get', expect=(301,), filename=filename,
+                                algorithms=checksum.supported_algorithms(),
+                                block_size=checksum.BLOCK_SIZE, **self.compression_args())
+        hasher = checksum.BlockHasher(response.get('algorithm'), response.get('block_size'))
+        received = 0
+        data_sock = self.open_data(response)
+        try:
+            for data in recv_chunks(data_sock, response.get('file_size'), response.get('compression')):
+                hasher.update(data)
+                received += len(data)
+                if progress:
+                    progress(received)
+                yield data
+        except BaseException:
+            # 没有收完就停止时中止服务器上的传输，控制连接可以继续使用
+            data_sock.close()
+            if received < response.get('file_size'):
+                with contextlib.suppress(FTPError):
+                    self.abort(response.get('transfer_id'))
+            raise
+        data_sock.close()
+        digest = checksum.file_digest(ordered_blocks(hasher.finish()))
+        remote = self.checksum(filename, response.get('algorithm'), response.get('block_size'))
+        if remote.get('digest') != digest:
+            raise TransferError(remote, '下载的文件%s与服务器上的摘要不一致' % filename)
+
+    def get(self, filename, local=None, progress=None):
+        '''
+        下载文件到local（文件名或可写的文件对象，默认为当前目录下的同名文件）
+        写到文件名时先写入.download文件，核对通过后再改名，返回{filename, size, digest}
+        '''
+        if local is not None and not isinstance(local, (str, os.PathLike)):
+            size = 0
+            for data in self.iter_get(filename, progress):
+                local.write(data)
+                size += len(data)
+            return {'filename': filename, 'size': size}
+        local = local if local is not None else os.path.basename(filename)
+        tmp_file = '%s.download' % local
+        size = 0
+        try:
+            with open(tmp_file, 'wb') as f:
+                for data in self.iter_get(filename, progress):
+                    f.write(data)
+                    size += len(data)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, local)
+        return {'filename': local, 'size': size}
+
+    def get_bytes(self, filename):
+        '''下载文件，返回文件内容'''
+        return b''.join(self.iter_get(filename))
+
+    # ---------- 可续传的下载 ----------
+
+    def download(self, filename, local=None, progress=None, records=None, segments=1, retries=3):
+        '''
+        下载文件到local（默认为当前目录下的同名文件），中断后可以用resume续传，返回{filename, size, digest, repaired}
+        1. 先写入.download文件，records（下载记录，通常是shelve）不为None时把进度保存在其中，键为服务器上的文件路径
+        2. segments大于1时把文件按块边界分成若干段，每段在独立的数据连接上并行接收
+        3. 收完后与服务器的块摘要逐块核对，只重新下载不一致的块（repaired为块数），全部一致后改名并删除记录
+        progress(已收到的字节数, 文件大小)在开始接收时和收到数据后调用，总是在调用download的线程中
+        '''
+        key = self.remote_path(filename)
+        tmp_file = '%s.download' % (local if local is not None else os.path.basename(filename))
+        records = records if records is not None else {}
+        if segments > 1:
+            response = self.stat(filename)
+            if response.get('is_dir'):
+                raise FTPError(response, '%s是目录' % filename)
+            file_size = response.get('file_size')
+            block_size = response.get('block_size')
+            # 每段的长度取块大小的整数倍，每个块只由一个分段计算摘要
+            segment_size = max(-(-file_size // segments), 1)
+            segment_size = -(-segment_size // block_size) * block_size
+            record = new_record(file_size, tmp_file, response,
+                                [[start, min(start + segment_size, file_size), start]
+                                 for start in range(0, file_size, segment_size)])
+            # 预先分配文件大小，各段直接写到自己的位置
+            with open(tmp_file, 'wb') as f:
+                f.truncate(file_size)
+            records[key] = record
+            self.recv_segments(key, record, records, progress)
+        else:
+            response = self.request('get', expect=(301,), filename=filename,
+                                    algorithms=checksum.supported_algorithms(),
+                                    block_size=checksum.BLOCK_SIZE, **self.compression_args())
+            file_size = response.get('file_size')
+            record = new_record(file_size, tmp_file, response, [[0, file_size, 0]])
+            records[key] = record
+            self.receive(key, record, records, [(response, record['segments'][0])], progress, os.O_TRUNC)
+        return self.finish_download(key, record, records, progress, retries)
+
+    def resume(self, key, records, progress=None, retries=3):
+        '''
+        续传下载记录records中键为key（服务器上的文件路径）的下载：
+        先核对已下载部分的块摘要，再下载损坏的块和未完成的部分，返回值同download
+        '''
+        record = records[key]
+        if not isinstance(record, dict):
+            record = upgrade_record(record)
+        if not os.path.isfile(record['local_file']):
+            # 本地文件已经不在了，从头下载
+            with open(record['local_file'], 'wb') as f:
+                f.truncate(record['file_size'])
+            record['segments'] = [[0, record['file_size'], 0]]
+            record['blocks'] = {}
+        records[key] = record
+        return self.finish_download(key, record, records, progress, retries)
+
+    def remote_blocks(self, key, record, records):
+        '''请求服务器上文件的块摘要，文件不存在或已被修改时删除下载记录并抛出TransferError'''
+        response = self.request('checksum', abs_filename=key, algorithms=[record['algorithm']],
+                                block_size=record['block_size'])
+        if response.get('status_code') != 310:
+            message = '服务器上的文件%s不存在，无法续传' % key
+        elif not record_matches(record, response):
+            message = '服务器上的文件%s已被修改，无法续传' % key
+        else:
+            return response
+        del records[key]
+        raise TransferError(response, message)
+
+    def finish_download(self, key, record, records, progress=None, retries=3):
+        '''与服务器的块摘要逐块核对，只重新下载不一致的块和未完成的部分，全部一致后改名并删除下载记录'''
+        repaired = 0
+        for _ in range(retries):
+            remote = self.remote_blocks(key, record, records)
+            fill_block_hashes(record)
+            repaired += len(compare_blocks(record, remote.get('blocks')))
+            records[key] = record
+            if not record['segments']:
+                local = record['local_file'][:-len('.download')]
+                os.replace(record['local_file'], local)
+                del records[key]
+                return {'filename': local, 'size': record['file_size'],
+                        'digest': remote.get('digest'), 'repaired': repaired}
+            self.recv_segments(key, record, records, progress)
+        raise TransferError(remote, '文件%s多次校验失败，可以稍后续传' % key)
+
+    def recv_segments(self, key, record, records, progress=None):
+        '''在控制连接上依次请求下载记录中所有未完成的分段，每段由服务器分配一个独立的数据连接'''
+        jobs = []
+        try:
+            for segment in record['segments']:
+                if segment[2] < segment[1]:
+                    response = self.request('range', expect=(301,), abs_filename=key,
+                                            file_size=record['file_size'], offset=segment[2],
+                                            length=segment[1] - segment[2], **self.compression_args())
+                    jobs.append((response, segment))
+        except BaseException:
+            # 已经分配的分段不会再来接收
+            for response, _ in jobs:
+                with contextlib.suppress(FTPError):
+                    self.abort(response.get('transfer_id'))
+            raise
+        self.receive(key, record, records, jobs, progress)
+
+    def receive(self, key, record, records, jobs, progress=None, flags=0):
+        '''
+        接收jobs中的各个分段[(服务器的响应, 分段)]，用pwrite写到本地文件中对应的位置，边收边计算块摘要
+        1. 只有一段时在调用线程中接收；多段时每段一个线程，调用线程等待各段的进度通知，
+           progress和下载记录的保存都只在调用线程中进行
+        2. 每隔RECORD_SAVE_INTERVAL秒和结束时（包括出错和被中断）把进度写入下载记录
+        3. 出错或被中断时通知服务器中止没有收完的分段；有分段失败时抛出ConnectionError
+        '''
+        fd = os.open(record['local_file'], os.O_RDWR | os.O_CREAT | flags)
+        # 某一段收到数据或结束时置位
+        changed = threading.Event()
+        finished = []
+        errors = []
+        threads = []
+        saved_at = time.monotonic()
+
+        def report():
+            nonlocal saved_at
+            if progress:
+                progress(record_progress(record), record['file_size'])
+            if time.monotonic() - saved_at >= RECORD_SAVE_INTERVAL:
+                saved_at = time.monotonic()
+                records[key] = record
+
+        def fetch(response, segment):
+            try:
+                self.recv_range(response, fd, segment, record, changed.set)
+            except OSError as e:
+                errors.append('分段%s-%s: %s' % (segment[0], segment[1], e))
+            finally:
+                finished.append(segment)
+                changed.set()
+
+        try:
+            report()
+            if len(jobs) == 1:
+                self.recv_range(jobs[0][0], fd, jobs[0][1], record, report)
+            else:
+                threads = [threading.Thread(target=fetch, args=job, daemon=True) for job in jobs]
+                for thread in threads:
+                    thread.start()
+                while len(finished) < len(threads):
+                    changed.wait()
+                    changed.clear()
+                    report()
+        except BaseException:
+            for response, segment in jobs:
+                if segment[2] < segment[1]:
+                    with contextlib.suppress(FTPError):
+                        self.abort(response.get('transfer_id'))
+            raise
+        finally:
+            # 分段线程都结束后才能关闭文件
+            for thread in threads:
+                thread.join()
+            os.close(fd)
+            records[key] = record
+        if errors:
+            raise ConnectionError('部分分段下载失败（%s）' % '; '.join(errors))
+
+    def recv_range(self, response, fd, segment, record, on_progress=None):
+        '''
+        在服务器为segment分配的数据连接上接收这一段数据，用pwrite写到文件中对应的位置
+        边收边计算块摘要，算出的块摘要存入record['blocks']，进度按解压后的字节计算
+        '''
+        hasher = segment_hasher(fd, segment, record)
+        data_sock = self.open_data(response)
+        try:
+            for data in recv_chunks(data_sock, segment[1] - segment[2], response.get('compression')):
+                os.pwrite(fd, data, segment[2])
+                segment[2] += len(data)
+                hasher.update(data)
+                collect_blocks(record, hasher, segment)
+                if on_progress:
+                    on_progress()
+        finally:
+            data_sock.close()
+
+    def get_bundle(self, paths, recursive=False, local_dir='.', progress=None):
+        '''
+        批量下载：服务器把所有匹配的文件（recursive为真时包括目录）打包成一个tar流在一条数据连接上发送，
+        边收边解包到local_dir，大量小文件也只需要一次往返；没有匹配的文件时抛出FTPError
+        返回{files, size, skipped}，skipped为不安全而没有解包的包内路径（绝对路径或越出local_dir）
+        progress(已收到的字节数, 文件总大小)在开始接收时和每写入一块后调用
+        '''
+        response = self.request('bundle', expect=(312,), paths=paths, recursive=recursive,
+                                **self.compression_args())
+        total_size = response.get('total_size')
+        result = {'files': 0, 'size': 0, 'skipped': []}
+        if progress:
+            progress(0, total_size)
+        finished = False
+        try:
+            data_sock = self.open_data(response)
+            try:
+                reader = compression.StreamReader(data_sock, response.get('compression'))
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    for member in tar:
+                        local_path = bundle_local_path(member.name)
+                        if local_path is None:
+                            result['skipped'].append(member.name)
+                            continue
+                        local_path = os.path.join(local_dir, local_path)
+                        if member.isdir():
+                            os.makedirs(local_path, exist_ok=True)
+                        elif member.isfile():
+                            os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+                            src = tar.extractfile(member)
+                            with open(local_path, 'wb') as f:
+                                while True:
+                                    data = src.read(RECV_SIZE)
+                                    if not data:
+                                        break
+                                    f.write(data)
+                                    result['size'] += len(data)
+                                    if progress:
+                                        progress(result['size'], total_size)
+                            os.utime(local_path, (member.mtime, member.mtime))
+                            result['files'] += 1
+                # 读完tar流之后的填充数据，让服务器正常结束发送
+                while reader.read(RECV_SIZE):
+                    pass
+                finished = True
+            finally:
+                data_sock.close()
+        except BaseException:
+            if not finished:
+                with contextlib.suppress(FTPError):
+                    self.abort(response.get('transfer_id'))
+            raise
+        return result
+
+    # ---------- 上传 ----------
+
+    def put_request(self, name, size, abs_filename, offset=0, sample=None, f=None):
+        '''
+        发送put请求，不等待响应，批量上传时可以连续发出多个请求
+        name为本地文件名，sample为文件开头的数据，用于判断是否值得压缩，没有给出时从文件name中读取
+        服务器开启了去重存储且从头上传时，先读一遍文件（f或文件name）算出块摘要列表一起发送，
+        服务器在响应中告诉客户端哪些块需要发送
+        '''
+        extra = {}
+        if self.dedup_chunk_size and not offset:
+            if f is None:
+                with open(name, 'rb') as local:
+                    chunks = checksum.chunk_hashes(local, self.dedup_chunk_size)
+            else:
+                chunks = checksum.chunk_hashes(f, self.dedup_chunk_size)
+            extra = {'chunks': chunks, 'chunk_size': self.dedup_chunk_size}
+        self.send('put', file_size=size, local_file=os.path.basename(name),
+                  abs_filename=abs_filename, offset=offset,
+                  algorithms=checksum.supported_algorithms(), block_size=checksum.BLOCK_SIZE,
+                  **extra, **self.compression_args(name, sample))
+
+    def send_upload(self, f, response, offset, data_sock=None, progress=None):
+        '''
+        在数据连接上从offset开始发送文件对象f的内容，返回(服务器的结果, 本地算出的摘要)
+        服务器的结果为None表示没有收到结果；progress(已发送到的位置)在每发送一块后调用
+        响应中有missing时服务器使用去重存储，只发送missing中的块，其余的块只参与计算摘要
+        '''
+        missing = response.get('missing')
+        read_size = RECV_SIZE
+        if missing is not None:
+            missing = set(missing)
+            read_size = response.get('chunk_size')
+        # 边发送边按服务器选定的算法计算块摘要，与服务器收到后算出的摘要核对
+        hasher = checksum.BlockHasher(response.get('algorithm'), response.get('block_size'))
+        # 服务器同意压缩时把要发送的部分压缩成一个流，进度仍按压缩前的字节计算
+        compressor = None
+        if response.get('compression'):
+            compressor = compression.new_compressor(response.get('compression'), response.get('compression_level'))
+        if data_sock is None:
+            data_sock = self.open_data(response)
+        try:
+            # 续传时已经上传的部分只参与计算摘要
+            f.seek(0)
+            while f.tell() < offset:
+                hasher.update(f.read(min(RECV_SIZE, offset - f.tell())))
+            index = 0
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+                hasher.update(data)
+                if missing is None or index in missing:
+                    if compressor:
+                        data = compressor.compress(data)
+                    data_sock.sendall(data)
+                index += 1
+                if progress:
+                    progress(f.tell())
+            if compressor:
+                data_sock.sendall(compressor.flush())
+            # 服务器收完后在数据连接上返回结果
+            result = protocol.MessageStream(data_sock).recv_message()
+        finally:
+            data_sock.close()
+        return result, checksum.file_digest(ordered_blocks(hasher.finish()))
+
+    def put(self, source, filename=None, offset=0, progress=None):
+        '''
+        上传文件到当前目录。source为本地文件名、bytes或可以seek的二进制文件对象
+        filename为服务器上的文件名，默认与本地文件同名；同名文件已存在时服务器会加上时间戳
+        offset为服务器上.part文件已经收到、可以跳过的字节数
+        返回{filename, size, digest}，filename为服务器实际保存的文件名
+        '''
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            if filename is None:
+                raise ValueError('上传bytes时必须指定文件名')
+            f, close = io.BytesIO(source), True
+        elif isinstance(source, (str, os.PathLike)):
+            f, close = open(source, 'rb'), True
+            filename = filename or os.path.basename(source)
+        else:
+            f, close = source, False
+            filename = filename or os.path.basename(getattr(source, 'name', '')) or None
+            if filename is None:
+                raise ValueError('上传文件对象时必须指定文件名')
+        try:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(0)
+            sample = f.read(compression.SAMPLE_SIZE)
+            self.put_request(filename, size, self.remote_path(filename), offset, sample, f)
+            response = self.recv()
+            if response.get('status_code') != 302:
+                raise FTPError(response)
+            result, digest = self.send_upload(f, response, offset, progress=progress)
+        finally:
+            if close:
+                f.close()
+        return self.upload_result(result, digest, filename, size)
+
+    @staticmethod
+    def upload_result(result, digest, filename, size):
+        '''核对服务器在数据连接上返回的结果，上传不完整或摘要不一致时抛出TransferError'''
+        if not result or result.get('status_code') != 308:
+            raise TransferError(result or {}, '上传的文件%s不完整' % filename)
+        if result.get('digest') != digest:
+            raise TransferError(result, '服务器上的文件%s与本地的摘要不一致' % filename)
+        return {'filename': result.get('filename'), 'size': size, 'digest': digest}
+
+    # ---------- 可续传的上传 ----------
+
+    def put_status(self, abs_filename):
+        '''服务器上abs_filename的.part文件已经收到的字节数'''
+        return self.request('put_status', abs_filename=abs_filename).get('offset') or 0
+
+    def upload(self, local_file, abs_filename=None, progress=None, records=None):
+        '''
+        上传本地文件到服务器的abs_filename（相对于用户根目录，默认为当前目录下的同名文件）
+        records（上传记录，通常是shelve）不为None时以本地文件的绝对路径为键记录上传，
+        同一文件上次没有上传完且本地文件没有变化时，先询问服务器已经收到多少字节，从那里继续上传
+        返回{filename, size, digest, offset, reused}，offset为续传的起点，reused为去重存储中已有、没有发送的块数
+        progress(已发送到的位置, 文件大小)在开始发送时和每发送一块后调用
+        '''
+        if abs_filename is None:
+            abs_filename = self.remote_path(os.path.basename(local_file))
+        records = records if records is not None else {}
+        st = os.stat(local_file)
+        offset = 0
+        if records.get(os.path.abspath(local_file)) == make_upload_record(abs_filename, st):
+            offset = min(self.put_status(abs_filename), st.st_size)
+        self.request_upload(local_file, abs_filename, offset, records)
+        response = self.recv()
+        if response.get('status_code') != 302:
+            raise FTPError(response)
+        return self.upload_file(local_file, response, offset, records, progress)
+
+    def iter_put(self, local_files, progress=None, records=None, window=PIPELINE_WINDOW):
+        '''
+        批量上传本地文件到当前目录，每批连续发出window个put请求后再读取响应，不必每个文件都等一次往返
+        按顺序逐个返回(本地文件名, 结果)，结果同upload，这个文件失败时为FTPError或OSError异常对象
+        progress(本地文件名, 已发送到的位置, 文件大小)；没有上传完就停止时中止这一批中还没有开始的传输
+        '''
+        for start in range(0, len(local_files), window):
+            batch = local_files[start:start + window]
+            # 连续发出这一批的put请求，不等待响应
+            for local_file in batch:
+                self.request_upload(local_file, self.remote_path(os.path.basename(local_file)), 0, records)
+            # 依次读取响应并立即连接数据端口，排在后面的传输不会因为等待而超时
+            ready = collections.deque()
+            for local_file in batch:
+                response = self.recv()
+                if response.get('status_code') != 302:
+                    ready.append((local_file, FTPError(response), None))
+                    continue
+                try:
+                    ready.append((local_file, response, self.open_data(response)))
+                except OSError as e:
+                    ready.append((local_file, e, None))
+            try:
+                while ready:
+                    local_file, response, data_sock = ready.popleft()
+                    if data_sock is None:
+                        yield local_file, response
+                        continue
+                    try:
+                        result = self.upload_file(
+                            local_file, response, 0, records,
+                            progress and (lambda sent, size, name=local_file: progress(name, sent, size)),
+                            data_sock)
+                    except (OSError, FTPError) as e:
+                        result = e
+                    yield local_file, result
+            finally:
+                for _, pending, data_sock in ready:
+                    if data_sock is not None:
+                        data_sock.close()
+                        with contextlib.suppress(FTPError):
+                            self.abort(pending.get('transfer_id'))
+
+    def request_upload(self, local_file, abs_filename, offset, records=None):
+        '''记录上传并发送put请求，不等待响应'''
+        st = os.stat(local_file)
+        if records is not None:
+            records[os.path.abspath(local_file)] = make_upload_record(abs_filename, st)
+        self.put_request(local_file, st.st_size, abs_filename, offset)
+
+    def upload_file(self, local_file, response, offset, records=None, progress=None, data_sock=None):
+        '''
+        在数据连接上从offset开始发送本地文件并核对结果，服务器收到完整的文件后删除上传记录
+        没有发送完就停止时中止服务器上的传输，上传记录保留，再次上传时从断点继续
+        '''
+        size = os.path.getsize(local_file)
+        missing = response.get('missing')
+        reused = 0
+        if missing is not None:
+            reused = checksum.block_count(size, response.get('chunk_size')) - len(missing)
+        if progress:
+            progress(offset, size)
+        try:
+            with open(local_file, 'rb') as f:
+                result, digest = self.send_upload(
+                    f, response, offset, data_sock, progress and (lambda sent: progress(sent, size)))
+        except BaseException:
+            with contextlib.suppress(FTPError):
+                self.abort(response.get('transfer_id'))
+            raise
+        if result and result.get('status_code') == 308 and records is not None:
+            # 服务器已经保存了完整的文件，摘要不一致时也不能续传
+            records.pop(os.path.abspath(local_file), None)
+        result = self.upload_result(result, digest, os.path.basename(local_file), size)
+        result.update(offset=offset, reused=reused)
+        return result
+
+
+class ConnectionPool(object):
+    '''
+    线程安全的连接池：复用已经登录的连接，省去每次建立TCP连接和认证的开销
+    最多同时存在size个连接，都在使用中时acquire等待；空闲超过max_idle秒的连接不再复用
+    连接归还时切换回用户根目录，出现网络错误的连接直接丢弃
+    '''
+
+    def __init__(self, host, port, username, password, size=4, max_idle=60, **kwargs):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_idle = max_idle
+        self.kwargs = kwargs
+        # 空闲连接，元素为(归还时间, 连接)，后归还的先取出
+        self.idle = collections.deque()
+        self.created = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        '''取出一个已登录的连接，没有空闲连接且已达到上限时最多等待timeout秒'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError('连接池已关闭')
+                while self.idle:
+                    released_at, conn = self.idle.pop()
+                    if time.monotonic() - released_at <= self.max_idle and not conn.closed:
+                        return conn
+                    conn.close()
+                    self.created -= 1
+                if self.created < self.size:
+                    self.created += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('等待空闲连接超时')
+                self.cond.wait(remaining)
+        # 建立连接和登录不占用锁
+        try:
+            return Connection(self.host, self.port, self.username, self.password, **self.kwargs)
+        except BaseException:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        '''归还连接，broken为True或连接已关闭时丢弃'''
+        if not broken and not conn.closed and conn.current_dir not in ('', '.'):
+            try:
+                conn.cd('/')
+            except (OSError, FTPError, protocol.ProtocolError):
+                broken = True
+        with self.cond:
+            if broken or conn.closed or self.closed:
+                conn.close()
+                self.created -= 1
+            else:
+                self.idle.append((time.monotonic(), conn))
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        '''with pool.connection() as conn: 用完自动归还，网络错误时丢弃该连接'''
+        conn = self.acquire(timeout)
+        broken = False
+        try:
+            yield conn
+        except (OSError, protocol.ProtocolError):
+            broken = True
+            raise
+        except BaseException:
+            # 迭代到一半的下载等情况下，控制连接上可能还有未读的响应，不再复用
+            broken = not isinstance(sys.exc_info()[1], FTPError)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        '''关闭所有空闲连接，使用中的连接归还时关闭'''
+        with self.cond:
+            self.closed = True
+            while self.idle:
+                self.idle.pop()[1].close()
+                self.created -= 1
+            self.cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # 常用操作，每次从池中取一个连接执行，路径相对于用户根目录
+
+    def ls(self, pattern=None, sort='name', reverse=False):
+        with self.connection() as conn:
+            return conn.ls(pattern, sort, reverse)
+
+    def mkdir(self, dirname):
+        with self.connection() as conn:
+            return conn.mkdir(dirname)
+
+    def rm(self, filename):
+        with self.connection() as conn:
+            return conn.rm(filename)
+
+    def stat(self, filename):
+        with self.connection() as conn:
+            return conn.stat(filename)
+
+    def get(self, filename, local=None, progress=None):
+        with self.connection() as conn:
+            return conn.get(filename, local, progress)
+
+    def get_bytes(self, filename):
+        with self.connection() as conn:
+            return conn.get_bytes(filename)
+
+    def put(self, source, filename=None, offset=0, progress=None):
+        with self.connection() as conn:
+            return conn.put(source, filename, offset, progress)
@@ -0,0 +1,582 @@
+'''
+基于asyncio的异步客户端：一个事件循环中同时进行大量传输，适合批量拉取或推送文件的任务
+
+    import asyncio
+    from jmftp_async import TransferQueue
+
+    def show(job):
+        print(job.remote, job.done, job.size)
+
+    async def main(names):
+        async with TransferQueue('127.0.0.1', 20000, 'Root', 'abc123', concurrency=16) as queue:
+            jobs = [await queue.get(name, progress=show) for name in names]
+        # 退出async with时等待所有任务结束
+        for job in jobs:
+            print(job.remote, job.state, job.error)
+
+    asyncio.run(main(['a.log', 'b.log']))
+
+下载中断或被取消时，进度保存在当前目录的下载记录中，格式与命令行客户端相同，
+两者都可以接着对方的记录续传
+'''
+import asyncio
+import contextlib
+import os
+import shelve
+import time
+
+import jmftp
+from jmftp import FTPError, AuthError, TransferError, RECV_SIZE, RECORD_SAVE_INTERVAL
+from common import checksum
+from common import compression
+from common import protocol
+
+# 被取消的传输通知服务器中止时，最多等待的秒数
+ABORT_TIMEOUT = 5
+
+
+async def recv_chunks(reader, count, algorithm=None):
+    '''jmftp.recv_chunks的异步版本：从数据连接接收count个字节，algorithm不为None时边收边解压'''
+    decompressor = compression.Decompressor(algorithm, count) if algorithm else None
+    received = 0
+    while received < count or (decompressor and not decompressor.eof):
+        data = await reader.read(RECV_SIZE if decompressor else min(RECV_SIZE, count - received))
+        if not data:
+            raise ConnectionError('数据连接中断')
+        if not decompressor:
+            received += len(data)
+            yield data
+            continue
+        # 按块解压，异常的压缩流不会一次解压出远超count的数据
+        try:
+            for chunk in decompressor.decompress(data):
+                received += len(chunk)
+                yield chunk
+        except ValueError:
+            raise ConnectionError('解压后的数据超过了请求的长度')
+
+
+class AsyncConnection(object):
+    '''
+    一条已登录的异步控制连接，用AsyncConnection.open创建
+    控制消息的收发由锁保护，同一连接上的请求依次进行；下载和上传期间控制连接会被占用，
+    需要并发传输时使用多条连接（TransferQueue为每个并发任务维护一条）
+    '''
+
+    # 与同步连接共用的路径和压缩参数处理
+    remote_path = jmftp.Connection.remote_path
+    compression_args = jmftp.Connection.compression_args
+
+    def __init__(self, host, port, reader, writer, compression=None, compression_level=None):
+        self.host = host
+        self.port = int(port)
+        self.reader = reader
+        self.writer = writer
+        self.compression = compression
+        self.compression_level = compression_level
+        self.username = None
+        self.token = None
+        self.current_dir = ''
+        # 认证完成前固定使用JSON
+        self.codec = protocol.JsonCodec
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+    @classmethod
+    async def open(cls, host, port, username=None, password=None, compression=None, compression_level=None):
+        '''建立连接，提供了用户名和密码时立即登录'''
+        reader, writer = await asyncio.open_connection(host, int(port))
+        conn = cls(host, port, reader, writer, compression, compression_level)
+        if username is not None:
+            try:
+                await conn.login(username, password or '')
+            except BaseException:
+                conn.close()
+                raise
+        return conn
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''关闭控制连接'''
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    # ---------- 控制消息 ----------
+
+    async def send(self, action_type, **kwargs):
+        '''打包并发送消息到服务器，调用方需持有self.lock'''
+        msg_data = {'action_type': action_type}
+        msg_data.update(kwargs)
+        self.writer.write(protocol.pack_message(msg_data, self.codec))
+        await self.writer.drain()
+
+    async def recv(self):
+        '''接收服务器的一条响应，调用方需持有self.lock'''
+        response = await protocol.read_message(self.reader)
+        if response is None:
+            raise ConnectionError('与服务器的连接已断开')
+        return response
+
+    @contextlib.asynccontextmanager
+    async def exchange(self):
+        '''
+        独占控制连接完成一次请求和响应
+        中途被取消或出错时连接上可能还有未读的响应，直接关闭连接，不能再使用
+        '''
+        async with self.lock:
+            try:
+                yield
+            except FTPError:
+                raise
+            except BaseException:
+                self.close()
+                raise
+
+    async def request(self, action_type, expect=None, **kwargs):
+        '''发送请求并等待响应，expect为期望的状态码，收到其他状态码时抛出FTPError'''
+        async with self.exchange():
+            await self.send(action_type, **kwargs)
+            response = await self.recv()
+        if expect is not None and response.get('status_code') not in expect:
+            raise FTPError(response)
+        return response
+
+    async def open_data(self, response):
+        '''连接服务器为本次传输分配的数据端口，并发送票据'''
+        reader, writer = await asyncio.open_connection(self.host, response.get('data_port'))
+        writer.write(response.get('ticket').encode('ascii'))
+        return reader, writer
+
+    async def abort(self, transfer_id):
+        '''中止服务器上正在进行的传输，传输已经结束时抛出FTPError'''
+        return await self.request('abort', expect=(305,), transfer_id=transfer_id)
+
+    async def abort_quietly(self, transfer_id):
+        '''传输被取消或出错后通知服务器中止，连接已断开或传输已经结束时忽略'''
+        if self.closed:
+            return
+        with contextlib.suppress(FTPError, OSError, protocol.ProtocolError, asyncio.TimeoutError):
+            await asyncio.wait_for(self.abort(transfer_id), ABORT_TIMEOUT)
+
+    # ---------- 会话 ----------
+
+    async def login(self, username, password):
+        '''登录，失败时抛出AuthError'''
+        response = await self.request('auth', username=username, password=password,
+                                      protocol_version=protocol.PROTOCOL_VERSION,
+                                      codecs=protocol.supported_codecs())
+        if response.get('status_code') != 200:
+            raise AuthError(response)
+        self.username = username
+        self.token = response.get('token')
+        # 切换到协商好的编码方式，收到的消息按帧头中的编码方式解码
+        self.codec = protocol.CODECS_BY_NAME[response.get('codec', 'json')]
+        return response
+
+    async def cd(self, target_dir):
+        '''切换目录，返回新的当前目录'''
+        response = await self.request('cd', expect=(350,), target_dir=target_dir)
+        self.current_dir = response.get('relative_dir')
+        return self.current_dir
+
+    async def ls(self, pattern=None, sort='name', reverse=False):
+        '''返回当前目录的所有目录项，每项为{filename, size, time, is_dir}'''
+        entries = []
+        async with self.exchange():
+            await self.send('ls', sort=sort, reverse=reverse, pattern=pattern)
+            response = await self.recv()
+            if response.get('status_code') != 400:
+                raise FTPError(response)
+            # 服务器分页发送，直到最后一页
+            while True:
+                page = await self.recv()
+                entries.extend(page.get('res'))
+                if page.get('last'):
+                    return entries
+
+    async def mkdir(self, dirname):
+        '''在当前目录下创建目录'''
+        await self.request('mkdir', expect=(500,), dirname=dirname)
+
+    async def rm(self, filename):
+        '''删除当前目录下的文件或目录，返回'file'或'dir' '''
+        response = await self.request('rm', expect=(600, 601), filename=filename)
+        return 'file' if response.get('status_code') == 600 else 'dir'
+
+    async def stat(self, filename):
+        '''返回文件的大小、修改时间和是否为目录'''
+        return await self.request('stat', expect=(303,), filename=filename,
+                                  algorithms=checksum.supported_algorithms(), block_size=checksum.BLOCK_SIZE)
+
+    async def checksum(self, filename, algorithm=None, block_size=None):
+        '''返回文件的块摘要和整个文件的摘要'''
+        algorithms = [algorithm] if algorithm else checksum.supported_algorithms()
+        return await self.request('checksum', expect=(310,), abs_filename=self.remote_path(filename),
+                                  algorithms=algorithms, block_size=block_size or checksum.BLOCK_SIZE)
+
+    # ---------- 下载 ----------
+
+    async def get(self, filename, local=None, progress=None, records=None, retries=3):
+        '''
+        下载文件到local（默认为当前目录下的同名文件），返回{filename, size, digest}
+        1. 先写入.download文件，records（下载记录，通常是shelve）不为None时把进度保存在其中，
+           键为服务器上的文件路径，已有同一目标的记录时只下载未完成的部分
+        2. 收完后与服务器的块摘要逐块核对，只重新下载不一致的块，全部一致后改名并删除记录
+        progress(已收到的字节数, 文件大小)在每收到一块后调用
+        '''
+        key = self.remote_path(filename)
+        local = local if local is not None else os.path.basename(filename)
+        tmp_file = '%s.download' % local
+        records = records if records is not None else {}
+        record = await self.resumable_record(records, key, tmp_file)
+        if record is None:
+            response = await self.request('get', expect=(301,), filename=filename,
+                                          algorithms=checksum.supported_algorithms(),
+                                          block_size=checksum.BLOCK_SIZE, **self.compression_args())
+            record = jmftp.new_record(response.get('file_size'), tmp_file, response,
+                                      [[0, response.get('file_size'), 0]])
+            records[key] = record
+            await self.recv_segment(response, record, record['segments'][0], records, key, progress,
+                                    os.O_TRUNC)
+        for _ in range(retries):
+            remote = await self.request('checksum', expect=(310,), abs_filename=key,
+                                        algorithms=[record['algorithm']], block_size=record['block_size'])
+            if not jmftp.record_matches(record, remote):
+                del records[key]
+                raise TransferError(remote, '服务器上的文件%s在下载期间被修改' % key)
+            # 计算摘要要读本地文件，放到线程中进行，不阻塞其他传输
+            await asyncio.to_thread(jmftp.fill_block_hashes, record)
+            jmftp.compare_blocks(record, remote.get('blocks'))
+            records[key] = record
+            if not record['segments']:
+                os.replace(tmp_file, local)
+                del records[key]
+                return {'filename': local, 'size': record['file_size'], 'digest': remote.get('digest')}
+            for segment in list(record['segments']):
+                response = await self.request('range', expect=(301,), abs_filename=key,
+                                              file_size=record['file_size'], offset=segment[2],
+                                              length=segment[1] - segment[2], **self.compression_args())
+                await self.recv_segment(response, record, segment, records, key, progress)
+        raise TransferError(remote, '文件%s多次校验失败，可以稍后续传' % key)
+
+    async def resumable_record(self, records, key, tmp_file):
+        '''
+        读取可以续传的下载记录：记录的本地文件与本次相同，且服务器上的文件没有变化
+        不能续传的记录直接删除，返回None表示从头下载
+        '''
+        record = records.get(key)
+        if record is None:
+            return None
+        if not isinstance(record, dict):
+            record = jmftp.upgrade_record(record)
+        if os.path.abspath(record['local_file']) != os.path.abspath(tmp_file):
+            del records[key]
+            return None
+        remote = await self.request('checksum', abs_filename=key, algorithms=[record['algorithm']],
+                                    block_size=record['block_size'])
+        if remote.get('status_code') != 310 or not jmftp.record_matches(record, remote):
+            del records[key]
+            return None
+        if not os.path.isfile(tmp_file):
+            # 本地文件已经不在了，整个文件重新下载
+            with open(tmp_file, 'wb') as f:
+                f.truncate(record['file_size'])
+            record['segments'] = [[0, record['file_size'], 0]]
+            record['blocks'] = {}
+        records[key] = record
+        return record
+
+    async def recv_segment(self, response, record, segment, records, key, progress=None, flags=0):
+        '''
+        在数据连接上接收segment这一段数据，用pwrite写到本地文件中对应的位置，边收边计算块摘要
+        每隔RECORD_SAVE_INTERVAL秒和结束时（包括出错和被取消）把进度写入下载记录；
+        没有收完就停止时通知服务器中止传输
+        '''
+        fd = os.open(record['local_file'], os.O_RDWR | os.O_CREAT | flags)
+        saved_at = time.monotonic()
+        try:
+            hasher = jmftp.segment_hasher(fd, segment, record)
+            reader, writer = await self.open_data(response)
+            try:
+                async for data in recv_chunks(reader, segment[1] - segment[2], response.get('compression')):
+                    os.pwrite(fd, data, segment[2])
+                    segment[2] += len(data)
+                    hasher.update(data)
+                    jmftp.collect_blocks(record, hasher, segment)
+                    if progress:
+                        progress(jmftp.record_progress(record), record['file_size'])
+                    if time.monotonic() - saved_at >= RECORD_SAVE_INTERVAL:
+                        saved_at = time.monotonic()
+                        records[key] = record
+            finally:
+                writer.close()
+        except BaseException:
+            if segment[2] < segment[1]:
+                await self.abort_quietly(response.get('transfer_id'))
+            raise
+        finally:
+            os.close(fd)
+            records[key] = record
+
+    # ---------- 上传 ----------
+
+    async def put(self, source, filename=None, offset=0, progress=None):
+        '''
+        上传文件到当前目录。source为本地文件名或bytes，filename为服务器上的文件名，默认与本地文件同名
+        offset为服务器上.part文件已经收到、可以跳过的字节数
+        返回{filename, size, digest}，filename为服务器实际保存的文件名
+        progress(已发送到的位置, 文件大小)在每发送一块后调用
+        '''
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            if filename is None:
+                raise ValueError('上传bytes时必须指定文件名')
+            data = bytes(source)
+            size = len(data)
+            sample = data[:compression.SAMPLE_SIZE]
+        else:
+            filename = filename or os.path.basename(source)
+            data = None
+            size = os.path.getsize(source)
+            with open(source, 'rb') as f:
+                sample = f.read(compression.SAMPLE_SIZE)
+        response = await self.request('put', expect=(302,), file_size=size, local_file=filename,
+                                      abs_filename=self.remote_path(filename), offset=offset,
+                                      algorithms=checksum.supported_algorithms(),
+                                      block_size=checksum.BLOCK_SIZE,
+                                      **self.compression_args(filename, sample))
+        hasher = checksum.BlockHasher(response.get('algorithm'), response.get('block_size'))
+        compressor = None
+        if response.get('compression'):
+            compressor = compression.new_compressor(response.get('compression'), response.get('compression_level'))
+        f = open(source, 'rb') if data is None else None
+        position = 0
+        try:
+            reader, writer = await self.open_data(response)
+            try:
+                while True:
+                    if f is not None:
+                        chunk = f.read(RECV_SIZE)
+                    else:
+                        chunk = data[position:position + RECV_SIZE]
+                    if not chunk:
+                        break
+                    # 续传时已经上传的部分只参与计算摘要
+                    hasher.update(chunk)
+                    skip = max(min(offset - position, len(chunk)), 0)
+                    position += len(chunk)
+                    chunk = chunk[skip:]
+                    if not chunk:
+                        continue
+                    writer.write(compressor.compress(chunk) if compressor else chunk)
+                    await writer.drain()
+                    if progress:
+                        progress(position, size)
+                if compressor:
+                    writer.write(compressor.flush())
+                    await writer.drain()
+                # 服务器收完后在数据连接上返回结果
+                result = await protocol.read_message(reader)
+            finally:
+                writer.close()
+        except BaseException:
+            if position < size:
+                await self.abort_quietly(response.get('transfer_id'))
+            raise
+        finally:
+            if f is not None:
+                f.close()
+        digest = checksum.file_digest(jmftp.ordered_blocks(hasher.finish()))
+        if not result or result.get('status_code') != 308:
+            raise TransferError(result or {}, '上传的文件%s不完整' % filename)
+        if result.get('digest') != digest:
+            raise TransferError(result, '服务器上的文件%s与本地的摘要不一致' % filename)
+        return {'filename': result.get('filename'), 'size': size, 'digest': digest}
+
+
+class Job(object):
+    '''
+    传输队列中的一个任务
+    state依次为pending、running，最后为done、failed或cancelled；size和done为文件大小和已传输的字节数
+    await job在任务结束后返回结果，失败时抛出任务的异常，被取消时抛出CancelledError
+    '''
+
+    def __init__(self, direction, remote, local, progress=None):
+        self.direction = direction
+        self.remote = remote
+        self.local = local
+        self.progress = progress
+        self.state = 'pending'
+        self.size = None
+        self.done = 0
+        self.result = None
+        self.error = None
+        # 正在执行任务的协程
+        self.task = None
+        self.finished = asyncio.Event()
+
+    def __repr__(self):
+        return '<Job %s %s %s %s/%s>' % (self.direction, self.remote, self.state, self.done, self.size)
+
+    def update(self, done, size):
+        '''传输进度的回调，更新进度后调用用户的progress(job)'''
+        self.done = done
+        self.size = size
+        if self.progress:
+            self.progress(self)
+
+    def cancel(self):
+        '''取消任务：还没开始的直接丢弃，正在进行的中止传输，已下载的部分保留在下载记录中'''
+        if self.state == 'pending':
+            self.finish('cancelled')
+        elif self.state == 'running' and self.task is not None:
+            self.task.cancel()
+
+    def finish(self, state, result=None, error=None):
+        self.state = state
+        self.result = result
+        self.error = error
+        self.finished.set()
+
+    async def wait(self):
+        await self.finished.wait()
+        if self.state == 'cancelled':
+            raise asyncio.CancelledError()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def __await__(self):
+        return self.wait().__await__()
+
+
+class TransferQueue(object):
+    '''
+    并发传输队列
+    1. 最多concurrency个任务同时传输，每个并发位置各自维护一条已登录的控制连接，出错或取消后重新连接
+    2. 排队的任务超过max_pending个时，get和put等待队列中有空位，调用方不会一次积压过多任务
+    3. 下载记录保存在record_file中，与命令行客户端的download_record格式相同
+    退出async with时等待所有任务结束；出现异常退出时取消剩余的任务
+    '''
+
+    def __init__(self, host, port, username, password, concurrency=8, max_pending=64,
+                 compression=None, compression_level=None, record_file=jmftp.RECORD_FILE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.concurrency = concurrency
+        self.compression = compression
+        self.compression_level = compression_level
+        self.record_file = record_file
+        self.pending = asyncio.Queue(max_pending)
+        self.records = None
+        self.workers = []
+        self.jobs = set()
+
+    async def start(self):
+        self.records = shelve.open(self.record_file)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.join()
+        else:
+            self.cancel_all()
+        await self.close()
+
+    async def get(self, remote, local=None, progress=None):
+        '''排入一个下载任务，返回Job；progress(job)在每收到一块数据后调用'''
+        return await self.submit(Job('get', remote, local, progress))
+
+    async def put(self, local, remote=None, progress=None):
+        '''排入一个上传任务，local为本地文件名或bytes，返回Job；progress(job)在每发送一块数据后调用'''
+        return await self.submit(Job('put', remote, local, progress))
+
+    async def submit(self, job):
+        if not self.workers:
+            raise RuntimeError('传输队列没有启动')
+        self.jobs.add(job)
+        await self.pending.put(job)
+        return job
+
+    async def join(self):
+        '''等待所有已排入的任务结束'''
+        await self.pending.join()
+
+    def cancel_all(self):
+        '''取消所有还没结束的任务'''
+        for job in list(self.jobs):
+            job.cancel()
+
+    async def close(self):
+        '''停止所有并发位置，关闭连接和下载记录'''
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.records is not None:
+            self.records.close()
+            self.records = None
+
+    async def connect(self):
+        return await AsyncConnection.open(self.host, self.port, self.username, self.password,
+                                          self.compression, self.compression_level)
+
+    async def worker(self):
+        '''一个并发位置：依次从队列中取出任务执行'''
+        conn = None
+        try:
+            while True:
+                job = await self.pending.get()
+                try:
+                    if job.state != 'pending':
+                        continue
+                    if conn is None or conn.closed:
+                        conn = None
+                        conn = await self.connect()
+                    await self.run_job(conn, job)
+                except (OSError, FTPError, protocol.ProtocolError) as e:
+                    # 建立连接或登录失败
+                    job.finish('failed', error=e)
+                finally:
+                    self.jobs.discard(job)
+                    self.pending.task_done()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    async def run_job(self, conn, job):
+        '''在单独的协程中执行任务，任务被取消时只结束这个协程，并发位置继续处理后面的任务'''
+        if job.state != 'pending':
+            # 等待连接期间已被取消
+            return
+        job.state = 'running'
+        if job.direction == 'get':
+            coro = conn.get(job.remote, job.local, job.update, self.records)
+        else:
+            coro = conn.put(job.local, job.remote, progress=job.update)
+        job.task = asyncio.ensure_future(coro)
+        try:
+            result = await asyncio.shield(job.task)
+        except asyncio.CancelledError:
+            if not job.task.cancelled():
+                # 整个队列被关闭，先取消任务再退出
+                job.task.cancel()
+                await asyncio.gather(job.task, return_exceptions=True)
+                job.finish('cancelled')
+                raise
+            job.finish('cancelled')
+        except Exception as e:
+            job.finish('failed', error=e)
+        else:
+            job.finish('done', result)
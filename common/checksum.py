@@ -0,0 +1,162 @@
+'''
+客户端与服务端共用的分块校验
+
+文件按固定大小切块，每块计算一个摘要；整个文件的摘要是所有块摘要拼接后的哈希。
+这样块摘要可以在分段、乱序下载的过程中流式计算，续传时只需要比较块摘要，
+就能找出本地与服务器不一致的块并只重新下载这些块。
+'''
+import hashlib
+import os
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 默认的块大小
+BLOCK_SIZE = 4 * 1024 * 1024
+# 去重存储中内容寻址的块摘要算法，要求抗碰撞，不参与协商
+CHUNK_ALGORITHM = 'sha256'
+# 对端可以请求的块大小范围
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def new_hash(algorithm):
+    '''创建一个块摘要对象'''
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == CHUNK_ALGORITHM:
+        return hashlib.sha256()
+    raise ValueError('不支持的校验算法：%s' % algorithm)
+
+
+# 本端支持的校验算法，按优先级从高到低排列，blake2b总是可用
+ALGORITHMS = (['xxh3_128'] if xxhash is not None else []) + ['blake2b']
+
+
+def supported_algorithms():
+    '''返回本端支持的校验算法列表，用于协商'''
+    return list(ALGORITHMS)
+
+
+def choose_algorithm(offered):
+    '''从对端提供的算法列表中按对端的优先级选出本端也支持的第一个'''
+    for algorithm in offered or []:
+        if algorithm in ALGORITHMS:
+            return algorithm
+    return 'blake2b'
+
+
+def choose_block_size(requested):
+    '''把对端请求的块大小限制在合理范围内'''
+    if not requested:
+        return BLOCK_SIZE
+    return max(MIN_BLOCK_SIZE, min(int(requested), MAX_BLOCK_SIZE))
+
+
+def block_count(file_size, block_size):
+    '''文件被切成的块数'''
+    return -(-file_size // block_size)
+
+
+def file_digest(blocks):
+    '''由按顺序排列的块摘要计算整个文件的摘要'''
+    return hashlib.blake2b(''.join(blocks).encode('ascii'), digest_size=32).hexdigest()
+
+
+class BlockHasher(object):
+    '''
+    流式分块哈希：从块边界offset开始接收连续的数据，每凑满一块就计算出该块的摘要
+    blocks中保存已经完成的块，键为块序号
+    '''
+
+    def __init__(self, algorithm, block_size, offset=0):
+        if offset % block_size:
+            raise ValueError('分块哈希必须从块边界开始')
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.index = offset // block_size
+        self.filled = 0
+        self.hash = new_hash(algorithm)
+        self.blocks = {}
+
+    def update(self, data):
+        '''追加数据'''
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.block_size - self.filled)
+            self.hash.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.block_size:
+                self._finish_block()
+
+    def finish(self):
+        '''数据到达文件末尾，最后一个不满的块也算作完成'''
+        if self.filled:
+            self._finish_block()
+        return self.blocks
+
+    def _finish_block(self):
+        self.blocks[self.index] = self.hash.hexdigest()
+        self.index += 1
+        self.filled = 0
+        self.hash = new_hash(self.algorithm)
+
+
+def hash_file(path, algorithm, block_size, chunk_size=1024 * 1024):
+    '''流式读取整个文件，返回按顺序排列的块摘要列表'''
+    hasher = BlockHasher(algorithm, block_size)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            hasher.update(view[:size])
+    blocks = hasher.finish()
+    return [blocks[index] for index in range(len(blocks))]
+
+
+def chunk_hashes(f, chunk_size):
+    '''从头读取文件对象f，返回去重存储使用的块摘要列表，读完后文件位置回到开头'''
+    hasher = BlockHasher(CHUNK_ALGORITHM, chunk_size)
+    f.seek(0)
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            break
+        hasher.update(data)
+    f.seek(0)
+    blocks = hasher.finish()
+    return [blocks[index] for index in range(len(blocks))]
+
+
+def valid_chunk_hashes(chunks):
+    '''客户端发来的块摘要列表是否合法：每一项都是CHUNK_ALGORITHM的小写十六进制摘要'''
+    length = hashlib.new(CHUNK_ALGORITHM).digest_size * 2
+    return isinstance(chunks, list) and all(
+        isinstance(chunk, str) and len(chunk) == length and not chunk.strip('0123456789abcdef')
+        for chunk in chunks)
+
+
+def object_id(chunks, chunk_size):
+    '''去重存储中整个文件的编号，由块大小和所有块摘要决定'''
+    return hashlib.sha256(('%s:%s' % (chunk_size, ''.join(chunks))).encode('ascii')).hexdigest()
+
+
+def hash_range(fd, algorithm, start, end, chunk_size=1024 * 1024):
+    '''读取文件描述符fd中[start, end)的数据，返回这一段数据的摘要'''
+    digest = new_hash(algorithm)
+    pos = start
+    while pos < end:
+        data = os.pread(fd, min(chunk_size, end - pos), pos)
+        if not data:
+            break
+        digest.update(data)
+        pos += len(data)
+    return digest.hexdigest()
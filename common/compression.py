@@ -0,0 +1,214 @@
+'''
+客户端与服务端共用的数据连接流式压缩
+
+压缩只作用于数据连接上的文件内容，控制消息不压缩。发送方把整个区间压缩成一个流，
+接收方解压到压缩流结束为止；进度统计和块摘要都按解压后的字节计算。
+'''
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 各算法的(默认级别, 最低级别, 最高级别)
+LEVELS = {
+    'zstd': (3, 1, 19),
+    'zlib': (6, 1, 9),
+}
+
+# 本端支持的压缩算法，按优先级从高到低排列，zlib总是可用
+ALGORITHMS = (['zstd'] if zstandard is not None else []) + ['zlib']
+
+# 已经压缩过的格式，再压缩只会浪费CPU
+SKIP_EXTENSIONS = frozenset([
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar', '.br',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov',
+    '.webm', '.flac', '.ogg', '.pdf', '.docx', '.xlsx', '.pptx', '.jar', '.whl',
+])
+
+# 用文件开头的这么多字节试压缩，判断是否值得压缩
+SAMPLE_SIZE = 64 * 1024
+# 试压缩后的大小超过原大小的这个比例时不压缩
+MIN_SAVING_RATIO = 0.9
+# 解压时每次最多取出的字节数
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+# zstd的解压对象不能限制输出，只能限制每次交给它的输入：一个块最多解压出128KB，块头至少3字节，
+# 这么多输入最多解压出约11MB
+ZSTD_FEED_SIZE = 256
+
+
+def supported_compressions():
+    '''返回本端支持的压缩算法列表，用于协商'''
+    return list(ALGORITHMS)
+
+
+def choose_compression(offered, level=None):
+    '''从对端提供的算法列表中选出本端也支持的第一个，返回(算法, 级别)，没有可用的算法时返回(None, None)'''
+    for algorithm in offered or []:
+        if algorithm in ALGORITHMS:
+            default, lowest, highest = LEVELS[algorithm]
+            try:
+                level = int(level)
+            except (TypeError, ValueError):
+                # 没有指定或不合法的级别使用默认值
+                return algorithm, default
+            return algorithm, max(lowest, min(level, highest))
+    return None, None
+
+
+def worth_compressing(filename, sample=None):
+    '''扩展名属于已压缩的格式，或者采样数据试压缩的效果不好时返回False'''
+    if os.path.splitext(filename)[1].lower() in SKIP_EXTENSIONS:
+        return False
+    if sample is None:
+        return True
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_SAVING_RATIO
+
+
+def new_compressor(algorithm, level):
+    '''创建流式压缩对象，compress()返回已经压缩好的数据，flush()结束压缩流'''
+    if algorithm == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if algorithm == 'zlib':
+        return zlib.compressobj(level)
+    raise ValueError('不支持的压缩算法：%s' % algorithm)
+
+
+def new_decompressor(algorithm):
+    '''创建流式解压对象，压缩流结束后eof为True'''
+    if algorithm == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    if algorithm == 'zlib':
+        return zlib.decompressobj()
+    raise ValueError('不支持的压缩算法：%s' % algorithm)
+
+
+class Decompressor(object):
+    '''
+    限制输出大小的流式解压，防止很小的压缩流解压成极大的数据（解压炸弹）
+    decompress(data)是生成器，逐块返回解压结果，zlib每块不超过DECOMPRESS_CHUNK_SIZE字节；
+    累计输出超过limit字节时抛出ValueError，limit为None时不限制总量
+    '''
+
+    def __init__(self, algorithm, limit=None):
+        self.algorithm = algorithm
+        self.limit = limit
+        self.total = 0
+        self.decompressor = new_decompressor(algorithm)
+
+    @property
+    def eof(self):
+        '''压缩流是否已经结束'''
+        return self.decompressor.eof
+
+    def decompress(self, data):
+        if self.algorithm == 'zlib':
+            while not self.decompressor.eof:
+                # 超出max_length的输入留在unconsumed_tail中，下一轮继续解压
+                chunk = self.decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+                data = self.decompressor.unconsumed_tail
+                if chunk:
+                    yield self._count(chunk)
+                # 输出没有填满时zlib内部不再有待输出的数据
+                if not data and len(chunk) < DECOMPRESS_CHUNK_SIZE:
+                    break
+            return
+        for start in range(0, len(data), ZSTD_FEED_SIZE):
+            if self.decompressor.eof:
+                break
+            chunk = self.decompressor.decompress(data[start:start + ZSTD_FEED_SIZE])
+            if chunk:
+                yield self._count(chunk)
+
+    def _count(self, chunk):
+        self.total += len(chunk)
+        if self.limit is not None and self.total > self.limit:
+            raise ValueError('解压后的数据超过了%s字节' % self.limit)
+        return chunk
+
+
+class StreamWriter(object):
+    '''
+    可写的文件对象：写入的数据（algorithm不为None时先压缩）发送到sock
+    供tarfile等按文件对象写入的模块直接输出到数据连接，progress按压缩前的字节数统计
+    '''
+
+    def __init__(self, sock, algorithm=None, level=None, progress=None):
+        self.sock = sock
+        self.compressor = new_compressor(algorithm, level) if algorithm else None
+        self.progress = progress
+        # 压缩前写入的字节数和实际发送的字节数
+        self.written = 0
+        self.sent = 0
+
+    def write(self, data):
+        size = len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self.sock.sendall(data)
+            self.sent += len(data)
+        self.written += size
+        if self.progress:
+            self.progress(size)
+        return size
+
+    def close(self):
+        '''结束压缩流，不关闭sock'''
+        if self.compressor:
+            data = self.compressor.flush()
+            self.sock.sendall(data)
+            self.sent += len(data)
+            self.compressor = None
+
+
+class StreamReader(object):
+    '''
+    可读的文件对象：从sock接收数据，algorithm不为None时边收边解压
+    解压按块进行，缓冲区只保存满足当前read所需的数据；解压后的总量超过limit字节时抛出ValueError
+    '''
+
+    def __init__(self, sock, algorithm=None, chunk_size=64 * 1024, limit=None):
+        self.sock = sock
+        self.decompressor = Decompressor(algorithm, limit) if algorithm else None
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        # 上次收到的数据还没有取完的解压结果
+        self.pending = iter(())
+        self.finished = False
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.pending, None)
+            if chunk is not None:
+                self.buffer += chunk
+                continue
+            if self.finished:
+                break
+            data = self.sock.recv(self.chunk_size)
+            if not data:
+                self.finished = True
+                break
+            if self.decompressor:
+                self.pending = self.decompressor.decompress(data)
+            else:
+                self.buffer += data
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def finish(self):
+        '''读完压缩流的结尾，丢弃剩余的数据，对端关闭连接时提前返回'''
+        while self.decompressor and not self.decompressor.eof:
+            if next(self.pending, None) is not None:
+                continue
+            data = self.sock.recv(self.chunk_size)
+            if not data:
+                break
+            self.pending = self.decompressor.decompress(data)
@@ -0,0 +1,296 @@
+'''
+客户端与服务端共用的控制消息分帧协议
+
+每条控制消息由固定8字节的帧头和消息体组成：
+    magic(2字节 b'JM') + 协议版本(1字节) + 编码方式(1字节) + 消息体长度(4字节，网络字节序)
+消息体是按帧头中的编码方式序列化的字典。帧头自带长度，接收方按长度读取，
+不需要再把消息填充到固定大小，也不会和紧随其后的文件数据混在一起。
+'''
+import asyncio
+import json
+import socket
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'JM'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBI')
+# 单条控制消息的最大长度，防止异常帧头导致分配过大的内存
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# 登录成功之前服务端接受的单条消息的最大长度，未认证的连接不能让服务端分配大块内存
+MAX_AUTH_MESSAGE_SIZE = 16 * 1024
+
+
+class ProtocolError(Exception):
+    '''收到的数据不符合分帧协议'''
+
+
+class JsonCodec(object):
+    '''JSON编码，所有客户端都必须支持，认证完成前固定使用'''
+    name = 'json'
+    codec_id = 0
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+class BinaryCodec(object):
+    '''
+    不依赖第三方库的紧凑二进制编码
+    每个值以1字节类型标记开头，整数、浮点数用定长的二进制表示，字符串和容器带长度前缀
+    '''
+    name = 'jmbin'
+    codec_id = 1
+
+    INT = struct.Struct('!q')
+    FLOAT = struct.Struct('!d')
+    LENGTH = struct.Struct('!I')
+
+    @classmethod
+    def encode(cls, data):
+        out = bytearray()
+        cls._encode_value(data, out)
+        return bytes(out)
+
+    @classmethod
+    def _encode_value(cls, value, out):
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif isinstance(value, int):
+            if -2 ** 63 <= value < 2 ** 63:
+                out += b'i' + cls.INT.pack(value)
+            else:
+                raw = str(value).encode('ascii')
+                out += b'I' + cls.LENGTH.pack(len(raw)) + raw
+        elif isinstance(value, float):
+            out += b'd' + cls.FLOAT.pack(value)
+        elif isinstance(value, str):
+            raw = value.encode('utf-8')
+            out += b's' + cls.LENGTH.pack(len(raw)) + raw
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            raw = bytes(value)
+            out += b'b' + cls.LENGTH.pack(len(raw)) + raw
+        elif isinstance(value, (list, tuple)):
+            out += b'l' + cls.LENGTH.pack(len(value))
+            for item in value:
+                cls._encode_value(item, out)
+        elif isinstance(value, dict):
+            out += b'm' + cls.LENGTH.pack(len(value))
+            for key, item in value.items():
+                cls._encode_value(key, out)
+                cls._encode_value(item, out)
+        else:
+            raise TypeError('无法编码的类型：%s' % type(value).__name__)
+
+    @classmethod
+    def decode(cls, payload):
+        value, pos = cls._decode_value(memoryview(payload), 0)
+        if pos != len(payload):
+            raise ProtocolError('消息体末尾有多余的数据')
+        return value
+
+    @classmethod
+    def _decode_value(cls, view, pos):
+        try:
+            tag = bytes(view[pos:pos + 1])
+            pos += 1
+            if tag == b'N':
+                return None, pos
+            if tag == b'T':
+                return True, pos
+            if tag == b'F':
+                return False, pos
+            if tag == b'i':
+                return cls.INT.unpack_from(view, pos)[0], pos + cls.INT.size
+            if tag == b'd':
+                return cls.FLOAT.unpack_from(view, pos)[0], pos + cls.FLOAT.size
+            if tag in (b's', b'b', b'I'):
+                length = cls.LENGTH.unpack_from(view, pos)[0]
+                pos += cls.LENGTH.size
+                raw = bytes(view[pos:pos + length])
+                if len(raw) != length:
+                    raise ProtocolError('消息体被截断')
+                pos += length
+                if tag == b's':
+                    return raw.decode('utf-8'), pos
+                if tag == b'I':
+                    return int(raw.decode('ascii')), pos
+                return raw, pos
+            if tag == b'l':
+                count = cls.LENGTH.unpack_from(view, pos)[0]
+                pos += cls.LENGTH.size
+                items = []
+                for _ in range(count):
+                    item, pos = cls._decode_value(view, pos)
+                    items.append(item)
+                return items, pos
+            if tag == b'm':
+                count = cls.LENGTH.unpack_from(view, pos)[0]
+                pos += cls.LENGTH.size
+                items = {}
+                for _ in range(count):
+                    key, pos = cls._decode_value(view, pos)
+                    items[key], pos = cls._decode_value(view, pos)
+                return items, pos
+        except struct.error:
+            raise ProtocolError('消息体被截断')
+        raise ProtocolError('未知的类型标记：%r' % tag)
+
+
+class MsgpackCodec(object):
+    '''msgpack编码，仅在安装了msgpack时可用'''
+    name = 'msgpack'
+    codec_id = 2
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+# 本端支持的编码方式，按优先级从高到低排列
+CODECS = [codec for codec in (MsgpackCodec, BinaryCodec, JsonCodec)
+          if codec is not MsgpackCodec or msgpack is not None]
+CODECS_BY_NAME = dict((codec.name, codec) for codec in CODECS)
+CODECS_BY_ID = dict((codec.codec_id, codec) for codec in CODECS)
+# 登录成功之前服务端接受的编码方式
+AUTH_CODECS = frozenset([JsonCodec])
+
+
+def supported_codecs():
+    '''返回本端支持的编码名称列表，用于认证时协商'''
+    return [codec.name for codec in CODECS]
+
+
+def choose_codec(offered):
+    '''从对端提供的编码列表中按对端的优先级选出本端也支持的第一个'''
+    for name in offered or []:
+        if name in CODECS_BY_NAME:
+            return name
+    return JsonCodec.name
+
+
+def pack_message(data, codec=JsonCodec):
+    '''把一条消息按codec编码，打包成带帧头的字节串'''
+    payload = codec.encode(data)
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, codec.codec_id, len(payload)) + payload
+
+
+def parse_header(header, max_size=MAX_MESSAGE_SIZE, codecs=None):
+    '''
+    解析帧头，返回(编码方式, 消息体长度)
+    帧头不合法、消息体超过max_size字节或编码方式不在codecs中（None表示本端支持的都可以）时抛出ProtocolError
+    '''
+    magic, version, codec_id, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError('错误的帧头：%r' % magic)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError('不支持的协议版本：%s' % version)
+    if codec_id not in CODECS_BY_ID or (codecs is not None and CODECS_BY_ID[codec_id] not in codecs):
+        raise ProtocolError('不支持的编码方式：%s' % codec_id)
+    if length > max_size:
+        raise ProtocolError('消息过长：%s字节' % length)
+    return CODECS_BY_ID[codec_id], length
+
+
+async def read_message(reader):
+    '''从asyncio的StreamReader读取一条完整的消息，连接在读到任何数据之前关闭时返回None'''
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError('连接在消息中途关闭')
+        return None
+    codec, length = parse_header(header)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('连接在消息中途关闭')
+    return codec.decode(payload)
+
+
+class MessageStream(object):
+    '''
+    对socket的封装：按帧收发控制消息，并带有接收缓冲区
+    一次recv可能读到多条流水线消息或消息后面紧跟的文件数据，
+    多读的部分留在缓冲区里，之后的recv_message/recv会先从缓冲区取
+    '''
+
+    def __init__(self, sock, max_size=MAX_MESSAGE_SIZE, codecs=None):
+        self.sock = sock
+        self.codec = JsonCodec
+        self.buffer = bytearray()
+        # 接收的单条消息的最大长度，服务端在登录之前使用较小的值
+        self.max_size = max_size
+        # 接收时允许的编码方式，None表示本端支持的都可以，服务端在登录之前只允许JSON
+        self.codecs = codecs
+        # 每条消息都用一次sendall发出完整的帧，关闭Nagle算法，
+        # 否则连续发出的小消息遇上对端的延迟确认，每次要多等约40ms
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    def set_codec(self, name):
+        '''切换发送时使用的编码方式'''
+        self.codec = CODECS_BY_NAME[name]
+
+    def has_buffered(self):
+        '''缓冲区中是否还有未处理的数据'''
+        return bool(self.buffer)
+
+    def send_message(self, data):
+        '''编码并发送一条消息'''
+        self.sock.sendall(self.pack_message(data))
+
+    def pack_message(self, data):
+        '''把一条消息打包成带帧头的字节串'''
+        return pack_message(data, self.codec)
+
+    def recv_message(self):
+        '''接收一条完整的消息，连接关闭时返回None'''
+        header = self.recv_exact(HEADER.size)
+        if header is None:
+            return None
+        codec, length = parse_header(header, self.max_size, self.codecs)
+        payload = self.recv_exact(length)
+        if payload is None:
+            raise ProtocolError('连接在消息中途关闭')
+        return codec.decode(payload)
+
+    def recv_exact(self, size):
+        '''精确读取size个字节，连接在读到任何数据之前关闭时返回None'''
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(size - len(self.buffer), 65536))
+            if not chunk:
+                if self.buffer:
+                    raise ProtocolError('连接在消息中途关闭')
+                return None
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def recv(self, size):
+        '''读取最多size个字节的原始数据，优先返回缓冲区中的数据'''
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
@@ -3,6 +3,8 @@ import sys
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(BASE_DIR)
+# 客户端与服务端共用的模块
+sys.path.append(os.path.dirname(BASE_DIR))
 
 if __name__ == "__main__":
     from core import management
@@ -3,13 +3,101 @@ import os
 HOST = '0.0.0.0'    # 主机ip
 PORT = 20000  # 服务端口
 
-# MIN_PASSITVE_PORT = 30000  # 最小被动端口
-# MAX_PASSITVE_PORT = 31000  # 最大被动端口
+MIN_PASSITVE_PORT = 30000  # 最小被动端口
+MAX_PASSITVE_PORT = 31000  # 最大被动端口
+DATA_ACCEPT_TIMEOUT = 30   # 等待客户端连接数据端口的超时时间（秒）
+MAX_TRANSFERS = 256 # 同时进行的数据传输数
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))   # 根目录
 USER_HOME_BASE_DIR = os.path.join(BASE_DIR, 'home') # 用户文件目录
 ACCOUNT_FILE = '%s/conf/accounts.ini' % BASE_DIR    # 用户信息存放目录
 
-MAX_SOCKET_LISTEN = 5   # 最大监听数
+MAX_SOCKET_LISTEN = 128   # 最大监听数
+MAX_SESSIONS_PER_USER = 0   # 每个用户同时登录的最大会话数，超出时拒绝登录，0表示不限制
+MAX_SESSIONS_PER_IP = 0 # 每个客户端地址同时保持的最大控制连接数，超出时拒绝连接，0表示不限制
 
-LOG_FILE = '%s/log/server.log' % BASE_DIR
\ No newline at end of file
+HANDSHAKE_TIMEOUT = 60  # 建立控制连接后多少秒内没有登录成功就断开，0表示不限
+IDLE_TIMEOUT = 600  # 控制连接超过多少秒没有收到指令、也没有进行中的传输时断开，0表示不限
+TRANSFER_STALL_TIMEOUT = 300    # 进行中的传输超过多少秒没有进展时中止，0表示不检查；进度按块更新，应大于最慢的客户端传输一块所需的时间
+TCP_KEEPALIVE = True    # 是否在控制连接和数据连接上开启TCP keepalive，及早发现断电或断网的客户端
+TCP_KEEPIDLE = 60   # 连接空闲多少秒后开始发送keepalive探测
+TCP_KEEPINTVL = 10  # keepalive探测的间隔秒数
+TCP_KEEPCNT = 6 # 连续多少次探测没有回应时内核断开连接
+
+SERVER_MODE = 'threadpool'  # 并发模式：'threadpool'（线程池）或 'asyncio'（事件循环+线程池）
+MAX_WORKERS = 256   # 工作线程池的最大线程数
+PREFORK = False # 是否以多进程模式运行：监督进程启动多个工作进程，每个进程都是完整的服务器，也可以用start prefork [进程数]开启
+WORKER_PROCESSES = 0    # 多进程模式的工作进程数，0表示CPU核数
+REUSEPORT = True    # 工作进程是否用SO_REUSEPORT各自监听PORT，由内核分配连接；关闭或系统不支持时共用监督进程创建的监听socket
+DRAIN_TIMEOUT = 30  # 工作进程停止（SIGTERM或SIGHUP重新加载）时等待进行中的指令和传输结束的最长秒数
+WORKER_RESTART_DELAY = 1    # 工作进程异常退出后重启前等待的秒数，连续很快退出时每次加倍，最多60秒
+
+USE_SENDFILE = True # 下载时是否使用内核零拷贝sendfile，关闭后使用缓冲区循环发送
+TRANSFER_CHUNK_SIZE = 64 * 1024   # 缓冲区循环收发时每块的大小
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024   # 每次调用sendfile发送的最大字节数，块之间更新传输进度
+FILE_CACHE_SIZE = 256    # 下载文件缓存最多保留的文件数，同时下载同一文件的会话共用，0表示关闭缓存
+FILE_CACHE_MEMORY = 256 * 1024 * 1024   # 整个读入内存的小文件合计不超过的字节数
+FILE_CACHE_SMALL_FILE = 1024 * 1024 # 不超过这个大小的文件整个读入内存
+FILE_CACHE_MMAP = True  # 大文件是否用mmap映射，压缩发送和关闭sendfile时直接发送映射的切片；文件可能被其他程序原地截短时关闭
+
+GLOBAL_RATE_LIMIT = 0   # 整个服务器的带宽上限（字节/秒），0表示不限速
+USER_RATE_LIMIT = 0 # 每个用户的默认带宽上限，可在accounts.ini中用rate_limit单独设置，支持K/M/G后缀
+SESSION_RATE_LIMIT = 0  # 每个会话的默认带宽上限，可在accounts.ini中用session_rate_limit单独设置
+RATE_LIMIT_BURST = 1.0  # 令牌桶最多积累多少秒的流量，额度内的小文件不需要等待
+THROTTLE_QUANTUM = 256 * 1024   # 限速时每次sendfile的最大字节数，多个传输按这个粒度轮流发送
+
+COMPRESSION = True  # 是否允许客户端请求压缩传输，已压缩的格式和压缩效果不好的文件总是不压缩
+
+LS_PAGE_SIZE = 500  # ls每页返回的目录项数
+LS_MAX_PAGE_SIZE = 5000 # 客户端可以请求的最大每页目录项数
+LS_CACHE_SIZE = 1024    # 目录列表缓存最多缓存的目录数，0表示关闭缓存
+LS_CACHE_INOTIFY = True # Linux下是否使用inotify使缓存失效，关闭或不可用时比较目录的mtime
+LS_CACHE_STATS_INTERVAL = 1000  # 每查询多少次缓存记录一次命中统计，0表示不记录
+
+META_INDEX = True   # 是否在用户根目录下保存文件元数据索引，避免重复计算大文件的块摘要
+META_INDEX_FILE = '.jmftp-index'    # 元数据索引的文件名，不会出现在ls中，也不能被下载、覆盖或删除
+
+STORAGE_BACKEND = 'local'   # 默认的存储后端：'local'（本地文件系统）、'memory'（内存，重启后丢失）或 'tiered'（分层），可在accounts.ini中用storage单独设置
+TIERED_HOT_DIR = os.path.join(BASE_DIR, 'tiers', 'hot')    # 分层存储的热层目录，放在快速的本地磁盘上，只能由分层存储使用
+TIERED_COLD_DIR = os.path.join(BASE_DIR, 'tiers', 'cold')  # 分层存储的冷层目录，可以是较慢的挂载点
+TIERED_HOT_AGE = 7 * 24 * 3600  # 热层的文件超过多少秒没有访问后移到冷层
+TIERED_HOT_MAX_BYTES = 0    # 热层的容量上限，超出时从最久没有访问的文件开始移到冷层，0表示不限
+TIERED_DEMOTE_INTERVAL = 600    # 每隔多少秒检查一次需要移到冷层的文件，0表示不自动降级
+
+QUOTA = True    # 是否统计用户的空间用量并检查配额
+USER_QUOTA_BYTES = 0    # 每个用户默认的空间配额（字节），可在accounts.ini中用quota_bytes单独设置，支持K/M/G后缀，0表示不限制
+USER_QUOTA_FILES = 0    # 每个用户默认的文件数配额（目录也计为一个文件），可在accounts.ini中用quota_files单独设置，0表示不限制
+QUOTA_DB = None # 用量计数器的数据库文件，None表示用户文件目录下的.jmftp-quota.db
+QUOTA_FLUSH_INTERVAL = 5    # 每隔多少秒把有变化的用量计数写入数据库
+QUOTA_RECONCILE_INTERVAL = 3600 # 每隔多少秒扫描一次用户目录纠正用量计数，启动时也扫描一次，0表示只在第一次使用时扫描
+
+DEDUP = False   # 是否开启内容寻址的去重存储，内容相同的文件只保存一份，客户端上传时可以跳过服务器已有的块
+DEDUP_POOL_DIR = None   # 去重池目录，None表示用户文件目录下的.jmftp-pool，必须与用户目录在同一个文件系统上
+DEDUP_CHUNK_SIZE = 1024 * 1024  # 去重的分块大小
+DEDUP_SCOPE = 'user'    # 'user'只复用同一用户上传过的块；'global'所有用户共享，客户端可能凭摘要取得其他用户的文件
+
+PASSWORD_HASH = 'scrypt'    # 新密码的摘要算法：'scrypt' 或 'pbkdf2_sha256'，不支持scrypt时使用PBKDF2
+SCRYPT_N = 2 ** 14  # scrypt的CPU/内存开销参数
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000  # PBKDF2的迭代次数
+UPGRADE_LEGACY_PASSWORDS = True # 用户用旧版本的MD5密码登录成功后，是否改写为加盐摘要
+ACCOUNT_RELOAD_INTERVAL = 1 # 每隔多少秒检查一次账户文件是否被修改
+AUTH_CACHE_SIZE = 1024  # 认证缓存最多缓存的用户数
+AUTH_CACHE_TTL = 600    # 认证缓存的有效期（秒），过期后再次登录重新计算密码摘要
+
+TOKEN_SECRET = None # 会话令牌的签名密钥，None表示每次启动时随机生成
+TOKEN_TTL = 24 * 3600   # 会话令牌的有效期（秒）
+
+METRICS_HOST = '127.0.0.1'  # 指标HTTP服务的监听地址，默认只允许本机访问
+METRICS_PORT = 20001    # 指标HTTP服务的端口，/metrics为Prometheus格式，/stats为JSON，0表示关闭
+
+LOG_FILE = '%s/log/server.log' % BASE_DIR
+ACCESS_LOG_FILE = '%s/log/access.log' % BASE_DIR    # 访问日志，每条指令一行JSON，None表示不记录
+LOG_LEVEL = 'INFO'  # 日志级别，设为'DEBUG'时记录收到的每条指令的内容
+LOG_CONSOLE = False # 是否同时把日志输出到终端
+LOG_ROTATE = 'size' # 日志轮转方式：'size'（按大小）或 'time'（按时间）
+LOG_MAX_BYTES = 10 * 1024 * 1024    # 按大小轮转时每个日志文件的最大字节数
+LOG_ROTATE_WHEN = 'midnight'    # 按时间轮转时的轮转时刻，取值同TimedRotatingFileHandler的when
+LOG_BACKUP_COUNT = 5    # 保留的历史日志文件数
+LOG_BATCH_SIZE = 256    # 后台线程每批最多写入的日志条数，写完一批flush一次
\ No newline at end of file
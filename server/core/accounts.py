@@ -0,0 +1,209 @@
+import base64
+import collections
+import configparser
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+import time
+from conf import settings
+
+# 旧版本的账户文件中保存的是不加盐的MD5
+LEGACY_MD5_LENGTH = 32
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def b64decode(text):
+    return base64.b64decode(text.encode('ascii'))
+
+
+def hash_password(password, method=None):
+    '''
+    生成加盐的密码摘要，格式为 算法$参数$盐$摘要：
+        scrypt$n$r$p$salt$hash
+        pbkdf2_sha256$iterations$salt$hash
+    当前Python不支持scrypt时使用PBKDF2
+    '''
+    method = method or settings.PASSWORD_HASH
+    salt = os.urandom(16)
+    password = password.encode('utf-8')
+    if method == 'scrypt' and hasattr(hashlib, 'scrypt'):
+        n, r, p = settings.SCRYPT_N, settings.SCRYPT_R, settings.SCRYPT_P
+        digest = hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+        return 'scrypt$%s$%s$%s$%s$%s' % (n, r, p, b64encode(salt), b64encode(digest))
+    iterations = settings.PBKDF2_ITERATIONS
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return 'pbkdf2_sha256$%s$%s$%s' % (iterations, b64encode(salt), b64encode(digest))
+
+
+def verify_password(password, stored):
+    '''校验密码是否与账户文件中保存的摘要一致，兼容旧版本的MD5'''
+    if not stored:
+        return False
+    password = password.encode('utf-8')
+    parts = stored.split('$')
+    try:
+        if parts[0] == 'scrypt' and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            expected = b64decode(parts[5])
+            digest = hashlib.scrypt(password, salt=b64decode(parts[4]), n=n, r=r, p=p,
+                                    maxmem=256 * n * r, dklen=len(expected))
+        elif parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+            expected = b64decode(parts[3])
+            digest = hashlib.pbkdf2_hmac('sha256', password, b64decode(parts[2]), int(parts[1]),
+                                         len(expected))
+        elif len(stored) == LEGACY_MD5_LENGTH:
+            expected = stored.lower().encode('ascii')
+            digest = hashlib.md5(password).hexdigest().encode('ascii')
+        else:
+            return False
+    except (AttributeError, ValueError, TypeError):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def is_legacy(stored):
+    '''是否为旧版本不加盐的MD5摘要'''
+    return '$' not in stored and len(stored) == LEGACY_MD5_LENGTH
+
+
+def read_config(path):
+    '''读取账户文件'''
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def write_config(config, path):
+    '''先写入临时文件再替换，服务端重新加载时不会读到写了一半的账户文件'''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.accounts-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            config.write(f)
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AccountStore(object):
+    '''
+    内存中的账户表：
+    1. 账户文件的mtime、大小或inode变化后重新读取，只替换内容有变化的用户，并通知on_change
+    2. 认证成功后缓存(密码摘要, 密码的HMAC)，同一用户再次用相同密码登录时不必重新计算KDF，
+       账户文件中的密码改变后缓存自动失效
+    3. get返回用户信息的副本，会话可以任意修改自己的用户对象
+    '''
+
+    def __init__(self, path, logger, on_change=None):
+        self.path = path
+        self.logger = logger
+        self.on_change = on_change
+        self.users = {}
+        self.signature = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+        # 认证缓存中的密码只保存以随机密钥计算的HMAC，不保存明文
+        self.cache_key = os.urandom(32)
+        self.cache = collections.OrderedDict()
+        self.reload()
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def refresh(self):
+        '''距上次检查超过ACCOUNT_RELOAD_INTERVAL秒时检查账户文件是否有变化'''
+        now = time.monotonic()
+        if now - self.checked_at < settings.ACCOUNT_RELOAD_INTERVAL:
+            return
+        self.checked_at = now
+        if self.file_signature() != self.signature:
+            self.reload()
+
+    def reload(self):
+        '''重新读取账户文件，返回有变化（新增、修改或删除）的用户名'''
+        with self.lock:
+            signature = self.file_signature()
+            if signature == self.signature and self.users:
+                return set()
+            config = read_config(self.path)
+            users = {}
+            for username in config.sections():
+                user = dict(config[username])
+                old = self.users.get(username)
+                users[username] = old if old == user else user
+            changed = {username for username in set(users) | set(self.users)
+                       if users.get(username) is not self.users.get(username)}
+            self.users = users
+            self.signature = signature
+            for username in changed:
+                self.cache.pop(username, None)
+        if changed:
+            self.logger.info('用户信息加载完成，%s个用户有变化' % len(changed))
+            if self.on_change:
+                self.on_change(changed)
+        return changed
+
+    def __contains__(self, username):
+        self.refresh()
+        return username in self.users
+
+    def get(self, username):
+        '''返回用户信息的副本，用户不存在时返回None'''
+        self.refresh()
+        user = self.users.get(username)
+        return dict(user) if user is not None else None
+
+    def password_mac(self, password):
+        return hmac.new(self.cache_key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def verify(self, username, password):
+        '''校验用户名和密码'''
+        self.refresh()
+        user = self.users.get(username)
+        if user is None:
+            return False
+        stored = user.get('password', '')
+        mac = self.password_mac(password)
+        with self.lock:
+            cached = self.cache.get(username)
+            if cached is not None and cached[0] == stored and cached[2] > time.monotonic():
+                if hmac.compare_digest(cached[1], mac):
+                    self.cache.move_to_end(username)
+                    return True
+        # 失败的认证不缓存，每次都要付出KDF的代价
+        if not verify_password(password, stored):
+            return False
+        if is_legacy(stored) and settings.UPGRADE_LEGACY_PASSWORDS:
+            self.upgrade(username, password)
+        with self.lock:
+            self.cache[username] = (stored, mac, time.monotonic() + settings.AUTH_CACHE_TTL)
+            self.cache.move_to_end(username)
+            while len(self.cache) > settings.AUTH_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return True
+
+    def upgrade(self, username, password):
+        '''把旧版本的MD5密码改写为加盐摘要'''
+        try:
+            config = read_config(self.path)
+            if username not in config or not is_legacy(config[username].get('password', '')):
+                return
+            config.set(username, 'password', hash_password(password))
+            write_config(config, self.path)
+        except OSError as e:
+            self.logger.error('%s: %s' % (username, '升级密码摘要失败，%s' % e))
+            return
+        self.logger.info('%s: %s' % (username, '密码摘要已从MD5升级'))
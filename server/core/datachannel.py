@@ -0,0 +1,157 @@
+import secrets
+import socket
+import threading
+import time
+from conf import settings
+from core import timeouts
+
+
+class PortAllocator(object):
+    '''从被动端口范围中为数据连接分配端口，所有会话共用一个分配器'''
+
+    def __init__(self, host, min_port, max_port):
+        self.host = host
+        self.min_port = min_port
+        self.max_port = max_port
+        self.lock = threading.Lock()
+        # 正在使用的端口
+        self.in_use = set()
+        # 轮转分配，避免刚释放的端口立即被复用
+        self.next_port = min_port
+
+    def open_listener(self):
+        '''绑定一个空闲的被动端口并开始监听，返回(socket, port)'''
+        with self.lock:
+            for _ in range(self.max_port - self.min_port + 1):
+                port = self.next_port
+                self.next_port = self.min_port if port >= self.max_port else port + 1
+                if port in self.in_use:
+                    continue
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    sock.bind((self.host, port))
+                except OSError:
+                    # 端口被其他程序占用，尝试下一个
+                    sock.close()
+                    continue
+                sock.listen(1)
+                self.in_use.add(port)
+                return sock, port
+        raise OSError('没有可用的被动端口')
+
+    def release(self, port):
+        '''归还端口'''
+        with self.lock:
+            self.in_use.discard(port)
+
+
+class Transfer(object):
+    '''
+    一次数据传输：占用一个被动端口，客户端凭票据连接后，在这条独立的数据连接上收发文件
+    控制连接只负责发送指令和响应，传输过程中仍然可以查询状态或中止传输
+    '''
+
+    def __init__(self, allocator, direction, full_path, size, filename):
+        self.allocator = allocator
+        self.transfer_id = secrets.token_hex(4)
+        # 客户端连接数据端口后首先发送票据，防止其他人抢占数据连接
+        self.ticket = secrets.token_hex(16)
+        self.direction = direction
+        self.full_path = full_path
+        # 相对于用户根目录的文件名，返回给客户端时不暴露服务器上的路径
+        self.filename = filename
+        self.size = size
+        self.done = 0
+        self.state = 'waiting'
+        self.start_time = time.time()
+        # 最近一次有进展的time.monotonic()，用于检查停滞的传输
+        self.last_progress = time.monotonic()
+        # 是否已经开始收发数据，还没有开始的传输不算停滞
+        self.started = False
+        self.conn = None
+        # 限速，由会话在创建传输后设置
+        self.throttle = None
+        # 中止时唤醒正在等待限速的线程
+        self.aborted = threading.Event()
+        self.listener, self.port = allocator.open_listener()
+
+    def accept(self):
+        '''等待客户端连接数据端口并校验票据，返回数据连接'''
+        deadline = time.time() + settings.DATA_ACCEPT_TIMEOUT
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.aborted.is_set():
+                    raise socket.timeout('等待数据连接超时')
+                self.listener.settimeout(remaining)
+                conn, _ = self.listener.accept()
+                conn.settimeout(remaining)
+                ticket = b''
+                try:
+                    while len(ticket) < len(self.ticket):
+                        chunk = conn.recv(len(self.ticket) - len(ticket))
+                        if not chunk:
+                            break
+                        ticket += chunk
+                except OSError:
+                    pass
+                if secrets.compare_digest(ticket, self.ticket.encode('ascii')):
+                    conn.settimeout(None)
+                    timeouts.set_keepalive(conn)
+                    self.conn = conn
+                    self.last_progress = time.monotonic()
+                    # 下载连上后服务器立即开始发送；上传要等客户端发来第一个字节，
+                    # 批量上传时客户端会先连接一批数据端口，再逐个发送
+                    self.started = self.direction != 'put'
+                    self.state = 'running'
+                    return conn
+                conn.close()
+        finally:
+            self.listener.close()
+            self.allocator.release(self.port)
+
+    def add_progress(self, size):
+        '''记录传输进度并按限速等待，传输被中止时抛出异常以便尽快停止'''
+        self.done += size
+        self.last_progress = time.monotonic()
+        self.started = True
+        if self.throttle:
+            delay = self.throttle.reserve(size)
+            if delay:
+                # 等待限速的时间不算停滞
+                self.last_progress += delay
+                self.aborted.wait(delay)
+        if self.aborted.is_set():
+            raise ConnectionAbortedError('传输已被中止')
+
+    def chunk_size(self):
+        '''每次sendfile的最大字节数，限速时用较小的粒度，让多个传输轮流发送'''
+        if self.throttle:
+            return settings.THROTTLE_QUANTUM
+        return settings.SENDFILE_CHUNK_SIZE
+
+    def abort(self, state='aborted'):
+        '''中止传输：关闭数据连接，正在阻塞收发的线程会立即返回；因停滞而中止时state为stalled'''
+        self.state = state
+        self.aborted.set()
+        for sock in (self.conn, self.listener):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def info(self):
+        '''返回传输状态，供status指令使用'''
+        return {
+            'transfer_id': self.transfer_id,
+            'direction': self.direction,
+            'filename': self.filename,
+            'size': self.size,
+            'done': self.done,
+            'state': self.state,
+            'elapsed': round(time.time() - self.start_time, 3),
+        }
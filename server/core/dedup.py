@@ -0,0 +1,164 @@
+import json
+import os
+import sqlite3
+import threading
+from common import checksum
+
+
+class DedupStore(object):
+    '''
+    内容寻址的去重存储，用户目录中的文件仍然是普通文件，下载、ls和删除都不需要改变
+    1. 上传的文件按固定大小分块，每块以SHA-256为地址；整个文件以所有块地址的哈希为对象编号
+    2. 池目录的objects/下按对象编号保存文件的一个硬链接，内容相同的文件都链接到同一个inode，只占一份磁盘
+    3. 索引（池目录下的SQLite）记录每个块在哪个对象的什么位置、每个对象属于哪些用户
+       客户端上传前先发送块摘要列表，服务器只要求发送没有的块，已有的块从对象中读取；
+       整个文件都已存在时直接创建硬链接，既不传输也不写入数据
+    4. 用户删除文件后，对象只剩池中的链接时删除对象和索引记录
+    scope为'user'时只复用同一用户上传过的块，客户端不能仅凭摘要取得其他用户的文件内容；
+    为'global'时所有用户共享。硬链接要求池目录与用户目录在同一个文件系统上，链接失败时该文件不去重
+    '''
+
+    def __init__(self, pool_dir, chunk_size, scope, logger):
+        self.pool_dir = pool_dir
+        self.chunk_size = chunk_size
+        self.scope = scope
+        self.logger = logger
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(pool_dir, 'objects'), exist_ok=True)
+        # 所有会话共用一个连接，由锁保证同一时间只有一个线程访问
+        self.conn = sqlite3.connect(os.path.join(pool_dir, 'index.db'), check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'id TEXT PRIMARY KEY, inode INTEGER, size INTEGER, '
+                'algorithm TEXT, block_size INTEGER, blocks TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS objects_inode ON objects (inode)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS chunks ('
+                'hash TEXT, object TEXT, offset INTEGER, length INTEGER, PRIMARY KEY (object, offset))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS owners (object TEXT, owner TEXT, PRIMARY KEY (object, owner))')
+
+    def object_path(self, object_id):
+        return os.path.join(self.pool_dir, 'objects', object_id[:2], object_id)
+
+    def object_id(self, chunks):
+        '''由块摘要列表计算对象编号'''
+        return checksum.object_id(chunks, self.chunk_size)
+
+    def plan(self, owner, chunks):
+        '''
+        上传前查找已有的数据，返回(已有对象的路径, {块序号: (对象路径, 偏移)})
+        整个文件已存在时第一项不为None，否则第二项为可以从已有对象中读取的块
+        '''
+        owner = None if self.scope == 'global' else owner
+        with self.lock:
+            object_id = self.object_id(chunks)
+            if self._owned(object_id, owner) and os.path.isfile(self.object_path(object_id)):
+                return self.object_path(object_id), {}
+            known = {}
+            for index, chunk in enumerate(chunks):
+                if owner is None:
+                    row = self.conn.execute(
+                        'SELECT object, offset FROM chunks WHERE hash=? LIMIT 1', (chunk,)).fetchone()
+                else:
+                    row = self.conn.execute(
+                        'SELECT chunks.object, chunks.offset FROM chunks JOIN owners '
+                        'ON owners.object=chunks.object WHERE chunks.hash=? AND owners.owner=? LIMIT 1',
+                        (chunk, owner)).fetchone()
+                if row is not None:
+                    known[index] = (self.object_path(row[0]), row[1])
+        return None, known
+
+    def object_blocks(self, object_path, algorithm, block_size):
+        '''返回对象入池时记录的块摘要，算法或块大小不同时返回None'''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT algorithm, block_size, blocks FROM objects WHERE id=?',
+                (os.path.basename(object_path),)).fetchone()
+        if row is None or (row[0], row[1]) != (algorithm, block_size):
+            return None
+        return json.loads(row[2])
+
+    def commit(self, owner, full_path, chunks, algorithm, block_size, blocks):
+        '''
+        文件写入完成后加入去重池：池中已有相同内容时把full_path换成指向已有对象的硬链接，
+        否则在池中为它创建一个链接并记录各块的位置
+        '''
+        object_id = self.object_id(chunks)
+        object_path = self.object_path(object_id)
+        size = os.path.getsize(full_path)
+        try:
+            with self.lock:
+                row = self.conn.execute('SELECT inode FROM objects WHERE id=?', (object_id,)).fetchone()
+                if row is not None and os.path.isfile(object_path):
+                    if not os.path.samefile(object_path, full_path):
+                        tmp_path = full_path + '.dedup'
+                        os.link(object_path, tmp_path)
+                        os.replace(tmp_path, full_path)
+                else:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    if os.path.lexists(object_path):
+                        os.remove(object_path)
+                    os.link(full_path, object_path)
+                    with self.conn:
+                        self._forget(object_id)
+                        self.conn.execute('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)', (
+                            object_id, os.stat(object_path).st_ino, size,
+                            algorithm, block_size, json.dumps(blocks)))
+                        self.conn.executemany('INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?)', [
+                            (chunk, object_id, index * self.chunk_size,
+                             min(self.chunk_size, size - index * self.chunk_size))
+                            for index, chunk in enumerate(chunks)])
+                with self.conn:
+                    self.conn.execute('INSERT OR IGNORE INTO owners VALUES (?, ?)', (object_id, owner))
+        except OSError as e:
+            self.logger.error('%s: %s' % (owner, '文件%s加入去重池失败：%s' % (full_path, e)))
+
+    def release(self, st):
+        '''用户的文件被删除后调用，st为删除前的stat结果，对象只剩池中的链接时删除'''
+        with self.lock:
+            row = self.conn.execute('SELECT id FROM objects WHERE inode=?', (st.st_ino,)).fetchone()
+            if row is not None:
+                self._collect(row[0])
+
+    def collect_garbage(self):
+        '''删除所有只剩池中链接的对象，返回删除的对象数'''
+        with self.lock:
+            object_ids = [row[0] for row in self.conn.execute('SELECT id FROM objects')]
+            return sum(self._collect(object_id) for object_id in object_ids)
+
+    def stats(self):
+        with self.lock:
+            objects, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+            return {'objects': objects, 'bytes': size}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _owned(self, object_id, owner):
+        if owner is None:
+            row = self.conn.execute('SELECT 1 FROM owners WHERE object=? LIMIT 1', (object_id,)).fetchone()
+        else:
+            row = self.conn.execute('SELECT 1 FROM owners WHERE object=? AND owner=?',
+                                    (object_id, owner)).fetchone()
+        return row is not None
+
+    def _collect(self, object_id):
+        '''对象已经没有用户文件链接到它时删除，调用方需持有self.lock'''
+        object_path = self.object_path(object_id)
+        try:
+            if os.stat(object_path).st_nlink > 1:
+                return False
+            os.remove(object_path)
+        except FileNotFoundError:
+            pass
+        with self.conn:
+            self._forget(object_id)
+        return True
+
+    def _forget(self, object_id):
+        for table, column in (('objects', 'id'), ('chunks', 'object'), ('owners', 'object')):
+            self.conn.execute('DELETE FROM %s WHERE %s=?' % (table, column), (object_id,))
@@ -0,0 +1,198 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import threading
+from core import listing
+
+
+class DirListingCache(object):
+    '''
+    进程内的目录列表LRU缓存，键为目录路径，值为该目录下所有目录项
+    失效方式：
+    1. Linux下开启inotify时，目录内有任何变化都会由后台线程立即使缓存失效
+    2. 否则每次命中时比较目录的mtime，一次stat即可判断缓存是否仍然有效
+    _put/_rm/_mkdir修改目录后直接调用refresh_entry更新缓存，不必重新扫描
+    '''
+
+    def __init__(self, max_dirs, use_inotify=True, logger=None, stats_interval=0):
+        self.max_dirs = max_dirs
+        self.logger = logger
+        self.stats_interval = stats_interval
+        # path -> [目录mtime, {文件名: 目录项}]
+        self.dirs = collections.OrderedDict()
+        # 每个目录的失效次数，扫描期间发生失效时扫描结果不写入缓存
+        self.generations = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.watcher = None
+        if use_inotify and InotifyWatcher.available():
+            try:
+                self.watcher = InotifyWatcher(self.invalidate)
+            except OSError as e:
+                if self.logger:
+                    self.logger.error('inotify初始化失败，改用mtime判断缓存是否失效：%s' % e)
+
+    def get_entries(self, path):
+        '''返回目录下所有目录项的列表，缓存无效时重新扫描'''
+        with self.lock:
+            cached = self.dirs.get(path)
+            generation = self.generations[path]
+        if cached is not None:
+            # 开启inotify时缓存一直有效，直到收到失效通知
+            if self.watcher or self._dir_mtime(path) == cached[0]:
+                with self.lock:
+                    if path in self.dirs:
+                        self.dirs.move_to_end(path)
+                    self.hits += 1
+                    self._maybe_log_stats()
+                return list(cached[1].values())
+        # 先添加监听再扫描，扫描期间发生的变化也能收到
+        if self.watcher:
+            self.watcher.watch(path)
+        mtime = self._dir_mtime(path)
+        entries = list(listing.iter_dir(path))
+        with self.lock:
+            self.misses += 1
+            # 扫描期间目录没有被修改才写入缓存
+            if generation == self.generations[path]:
+                self.dirs[path] = [mtime, dict((entry['filename'], entry) for entry in entries)]
+                self.dirs.move_to_end(path)
+                self._evict()
+            self._maybe_log_stats()
+        return entries
+
+    def refresh_entry(self, path, name):
+        '''目录中的name被创建、修改或删除后，直接更新缓存中的对应目录项'''
+        with self.lock:
+            cached = self.dirs.get(path)
+            if cached is None:
+                return
+            try:
+                cached[1][name] = listing.make_entry(name, os.stat(os.path.join(path, name)))
+            except FileNotFoundError:
+                cached[1].pop(name, None)
+            # 修改已经反映到缓存中，更新记录的目录mtime
+            cached[0] = self._dir_mtime(path)
+
+    def invalidate(self, path=None):
+        '''使某个目录（path为None时为全部目录）的缓存失效'''
+        with self.lock:
+            paths = list(self.dirs) if path is None else [path]
+            for item in paths:
+                self.generations[item] += 1
+                if self.dirs.pop(item, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        '''返回缓存的命中统计'''
+        with self.lock:
+            return {
+                'dirs': len(self.dirs),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'inotify': self.watcher is not None,
+            }
+
+    def _evict(self):
+        '''超出容量时淘汰最久未使用的目录，调用时需持有锁'''
+        while len(self.dirs) > self.max_dirs:
+            path, _ = self.dirs.popitem(last=False)
+            self.generations.pop(path, None)
+            self.evictions += 1
+            if self.watcher:
+                self.watcher.unwatch(path)
+
+    def _maybe_log_stats(self):
+        '''每stats_interval次查询记录一次命中统计，调用时需持有锁'''
+        lookups = self.hits + self.misses
+        if self.logger and self.stats_interval and lookups % self.stats_interval == 0:
+            self.logger.info('目录缓存统计：目录数%s，命中%s，未命中%s，失效%s，淘汰%s' % (
+                len(self.dirs), self.hits, self.misses, self.invalidations, self.evictions))
+
+    @staticmethod
+    def _dir_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+
+class InotifyWatcher(object):
+    '''通过ctypes调用Linux的inotify接口，目录发生变化时回调on_change(path)'''
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct('iIII')
+
+    @classmethod
+    def available(cls):
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def __init__(self, on_change):
+        self.on_change = on_change
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1失败')
+        # wd <-> path
+        self.paths = {}
+        self.wds = {}
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.read_events, name='dircache_inotify', daemon=True)
+        thread.start()
+
+    def watch(self, path):
+        with self.lock:
+            if path in self.wds:
+                return
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+            if wd >= 0:
+                self.wds[path] = wd
+                self.paths[wd] = path
+
+    def unwatch(self, path):
+        with self.lock:
+            wd = self.wds.pop(path, None)
+            if wd is not None:
+                self.paths.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        '''后台线程：读取inotify事件并使对应目录的缓存失效'''
+        while True:
+            buf = os.read(self.fd, 64 * 1024)
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, name_len = self.EVENT.unpack_from(buf, pos)
+                pos += self.EVENT.size + name_len
+                if mask & self.IN_Q_OVERFLOW:
+                    # 事件队列溢出，无法知道哪些目录变了，全部失效
+                    self.on_change(None)
+                    continue
+                with self.lock:
+                    path = self.paths.get(wd)
+                    if mask & self.IN_IGNORED and path is not None:
+                        # 目录被删除或监听被移除
+                        self.paths.pop(wd, None)
+                        self.wds.pop(path, None)
+                if path is not None:
+                    self.on_change(path)
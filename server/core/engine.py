@@ -0,0 +1,112 @@
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from conf import settings
+
+
+class ThreadPoolEngine(object):
+    '''线程池模式：每个连接占用一个工作线程直到断开，超出线程数的连接排队等待'''
+
+    def __init__(self, server):
+        self.server = server
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.MAX_WORKERS, thread_name_prefix='ftp_session')
+
+    def serve_forever(self):
+        '''循环接收连接，并把会话交给线程池处理，stop之后等待已有的会话结束再返回'''
+        # accept每秒超时一次以便检查是否已经stop；多个进程共用监听socket时，没有取到连接的进程也不会一直阻塞
+        self.server.sock.settimeout(1)
+        while not self.server.stopping:
+            # 等待客户端发起连接请求
+            try:
+                request, addr = self.server.sock.accept()
+            except socket.timeout:
+                continue
+            self.server.logger.info('接收到来自%s:%s的连接' % addr)
+            session = self.server.create_session(request, addr)
+            # 连接数超出限制时已经拒绝
+            if session is not None:
+                self.pool.submit(session.run)
+        self.server.drain()
+
+    def stop(self):
+        '''accept超时后会检查server.stopping，不需要唤醒'''
+
+
+class AsyncioEngine(object):
+    '''asyncio模式：空闲连接挂在事件循环上等待可读，收到指令后才占用一个工作线程'''
+
+    def __init__(self, server):
+        self.server = server
+        self.pool = ThreadPoolExecutor(
+            max_workers=settings.MAX_WORKERS, thread_name_prefix='ftp_worker')
+        self.loop = None
+        self.accepting = None
+
+    def serve_forever(self):
+        '''启动事件循环'''
+        asyncio.run(self.main())
+
+    def stop(self):
+        '''停止接收新连接，可以在信号处理函数中调用'''
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.accepting.cancel)
+
+    async def main(self):
+        '''接收连接直到stop，之后事件循环继续为已有的会话服务，在线程池中等待它们结束'''
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(self.pool)
+        self.accepting = loop.create_task(self.accept_loop())
+        self.loop = loop
+        if self.server.stopping:
+            self.accepting.cancel()
+        await asyncio.wait([self.accepting])
+        if not self.accepting.cancelled():
+            # accept_loop异常退出
+            self.accepting.result()
+        await loop.run_in_executor(None, self.server.drain)
+
+    async def accept_loop(self):
+        '''循环接收连接，每个连接对应一个协程'''
+        loop = asyncio.get_running_loop()
+        self.server.sock.setblocking(False)
+        while True:
+            request, addr = await loop.sock_accept(self.server.sock)
+            self.server.logger.info('接收到来自%s:%s的连接' % addr)
+            session = self.server.create_session(request, addr)
+            if session is not None:
+                loop.create_task(self.serve_session(session))
+
+    async def serve_session(self, session):
+        '''等待连接可读，然后在线程池中处理一条指令'''
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # 流水线发来的指令可能已经在缓冲区中，无需等待可读
+                if not session.has_pending():
+                    await self.wait_readable(loop, session.request)
+                if not await loop.run_in_executor(self.pool, session.handle_once):
+                    break
+        except Exception as e:
+            self.server.logger.error('处理请求出错，错误信息：%s' % e)
+            session.close()
+
+    def wait_readable(self, loop, sock):
+        '''返回一个在socket可读时完成的future'''
+        future = loop.create_future()
+        fd = sock.fileno()
+
+        def on_readable():
+            loop.remove_reader(fd)
+            if not future.done():
+                future.set_result(None)
+
+        loop.add_reader(fd, on_readable)
+        return future
+
+
+# 可选的并发模式
+ENGINES = {
+    'threadpool': ThreadPoolEngine,
+    'asyncio': AsyncioEngine,
+}
@@ -0,0 +1,178 @@
+import collections
+import contextlib
+import mmap
+import os
+import threading
+
+
+class CachedFile(object):
+    '''
+    缓存中的一个打开的文件，键为(路径, inode, mtime, 大小)
+    1. 小文件整个读入内存，data为bytes
+    2. 大文件保持打开，开启mmap时映射到内存，data为mmap，多个会话共享同一个映射和页缓存
+    view是data的memoryview，发送时直接切片，不复制数据；refs为正在使用它的传输数
+    '''
+
+    def __init__(self, key, f, data, in_memory):
+        self.key = key
+        self.path = key[0]
+        self.size = key[3]
+        self.file = f
+        self.data = data
+        self.in_memory = in_memory
+        self.view = memoryview(data) if data is not None else None
+        self.refs = 0
+        # 文件已被修改或被淘汰，最后一个使用者释放后关闭
+        self.stale = False
+
+    def memory(self):
+        '''占用的内存预算，mmap的页由内核按需载入和回收，不计入预算'''
+        return self.size if self.in_memory else 0
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # 异常的回溯中可能还引用着切片，映射在切片被回收后由mmap对象自己解除
+                pass
+        self.data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class FileCache(object):
+    '''
+    下载文件的共享缓存，同时下载同一个文件的会话共用一份打开的文件或内存映射
+    1. 不超过small_file_size的文件整个读入内存，所有小文件合计不超过memory_budget字节
+    2. 更大的文件保持打开（开启mmap时同时映射），缓存中最多保留max_files个文件
+    3. 按LRU淘汰没有被使用的文件；正在被传输使用的文件不淘汰，用完后才关闭
+    4. 每次open时stat一次，文件被替换或修改后inode、mtime或大小变化，自动使用新的缓存项
+    max_files为0时不缓存，每次打开的文件在release时关闭
+    '''
+
+    def __init__(self, max_files, memory_budget, small_file_size, use_mmap=True):
+        self.max_files = max_files
+        self.memory_budget = memory_budget
+        self.small_file_size = small_file_size
+        self.use_mmap = use_mmap
+        # 键 -> CachedFile，按最近使用的顺序排列
+        self.files = collections.OrderedDict()
+        # 路径 -> 该路径当前的键，文件变化后用于淘汰旧的缓存项
+        self.paths = {}
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextlib.contextmanager
+    def open(self, path):
+        '''with cache.open(path) as cached: 取得文件的缓存项，用完自动释放'''
+        cached = self.acquire(path)
+        try:
+            yield cached
+        finally:
+            self.release(cached)
+
+    def acquire(self, path):
+        '''取得文件的缓存项并增加引用计数，文件不存在时抛出OSError'''
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            cached = self.files.get(key)
+            if cached is not None:
+                self.files.move_to_end(key)
+                cached.refs += 1
+                self.hits += 1
+                return cached
+            self.misses += 1
+        cached = self.load(path)
+        with self.lock:
+            # 其他会话可能同时打开了同一个文件，只保留先放入的那一份
+            existing = self.files.get(cached.key)
+            if existing is not None:
+                existing.refs += 1
+                cached.close()
+                return existing
+            cached.refs += 1
+            if self.max_files > 0 and cached.memory() <= self.memory_budget:
+                old_key = self.paths.get(path)
+                if old_key is not None and old_key in self.files:
+                    self.discard(old_key)
+                self.files[cached.key] = cached
+                self.paths[path] = cached.key
+                self.memory_used += cached.memory()
+                self.evict()
+            else:
+                # 不缓存，用完即关闭
+                cached.stale = True
+        return cached
+
+    def load(self, path):
+        '''打开文件，以打开后的fstat生成键，保证键与读到的内容一致'''
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            key = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+            if st.st_size <= self.small_file_size:
+                data = f.read(st.st_size)
+                f.close()
+                return CachedFile(key[:3] + (len(data),), None, data, True)
+            data = None
+            if self.use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return CachedFile(key, f, data, False)
+        except BaseException:
+            f.close()
+            raise
+
+    def release(self, cached):
+        '''传输结束后释放缓存项，已被淘汰的在最后一个使用者释放时关闭'''
+        with self.lock:
+            cached.refs -= 1
+            if cached.refs or not cached.stale:
+                return
+        cached.close()
+
+    def discard(self, key):
+        '''从缓存中移除一项，调用方需持有self.lock'''
+        cached = self.files.pop(key)
+        if self.paths.get(cached.path) == key:
+            del self.paths[cached.path]
+        self.memory_used -= cached.memory()
+        cached.stale = True
+        if not cached.refs:
+            cached.close()
+
+    def evict(self):
+        '''淘汰最久没有使用的空闲项，直到文件数和内存都不超过上限，调用方需持有self.lock'''
+        for key in list(self.files):
+            over_files = len(self.files) > self.max_files
+            if not over_files and self.memory_used <= self.memory_budget:
+                break
+            cached = self.files[key]
+            # 只是内存超出预算时，淘汰不占内存预算的大文件没有帮助
+            if not cached.refs and (over_files or cached.memory()):
+                self.discard(key)
+                self.evictions += 1
+
+    def clear(self):
+        '''关闭所有空闲项，正在使用的在释放时关闭'''
+        with self.lock:
+            for key in list(self.files):
+                self.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'memory': self.memory_used,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
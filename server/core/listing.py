@@ -0,0 +1,56 @@
+import fnmatch
+import os
+import stat
+
+# 服务端支持的排序方式：名称、大小、修改时间，以及不排序（按扫描顺序边扫边发）
+SORT_KEYS = {
+    'name': lambda entry: entry['filename'],
+    'size': lambda entry: entry.get('size', 0),
+    'mtime': lambda entry: entry.get('time', 0),
+}
+
+
+def make_entry(name, st):
+    '''根据一次stat的结果生成目录项，格式与客户端显示的字段一致'''
+    if stat.S_ISDIR(st.st_mode):
+        return {'filename': name, 'is_dir': True}
+    return {'filename': name, 'is_dir': False, 'size': st.st_size, 'time': st.st_mtime}
+
+
+def iter_dir(path):
+    '''用os.scandir遍历目录，每个目录项只做一次stat'''
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except OSError:
+                # 遍历过程中被删除的文件或失效的软链接直接跳过
+                continue
+            yield make_entry(entry.name, st)
+
+
+def filter_entries(entries, pattern=None):
+    '''按glob模式过滤目录项'''
+    if not pattern:
+        return entries
+    return (entry for entry in entries if fnmatch.fnmatchcase(entry['filename'], pattern))
+
+
+def sort_entries(entries, sort='name', reverse=False):
+    '''目录排在文件前面，同类之间按指定字段排序'''
+    key = SORT_KEYS[sort]
+    entries = sorted(entries, key=key, reverse=reverse)
+    # sorted是稳定排序，再按是否目录排一次即可让目录始终在前
+    return sorted(entries, key=lambda entry: not entry['is_dir'])
+
+
+def paginate(entries, page_size):
+    '''把目录项切分成若干页，适用于列表和生成器'''
+    page = []
+    for entry in entries:
+        page.append(entry)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
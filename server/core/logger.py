@@ -0,0 +1,183 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from conf import settings
+
+# 访问日志使用的logger名称，每条指令一行JSON
+ACCESS_LOGGER = 'ftp_access'
+
+_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+class BatchFlushMixin(object):
+    '''写入后不立即flush，由后台线程写完一批日志后统一flush一次'''
+
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+
+class BatchRotatingFileHandler(BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    '''按大小轮转的日志文件'''
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    '''按时间轮转的日志文件'''
+
+
+class JsonFormatter(logging.Formatter):
+    '''把访问日志格式化为一行JSON，字段来自record.access'''
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}
+        entry.update(getattr(record, 'access', None) or {'message': record.getMessage()})
+        # 无法序列化的值转换为字符串，不让一条日志因此丢失
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogListener(object):
+    '''
+    后台写日志的线程：请求处理线程只把日志记录放进队列，
+    这里每次最多取出LOG_BATCH_SIZE条一起写入，写完一批才flush一次
+    '''
+
+    def __init__(self, log_queue, handlers, access_handlers):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.access_handlers = access_handlers
+        self.thread = threading.Thread(target=self.run, name='ftp_log_listener', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < settings.LOG_BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            self.write([record for record in records if record is not None])
+            if stop:
+                return
+
+    def write(self, records):
+        all_handlers = self.handlers + self.access_handlers
+        for handler in all_handlers:
+            handler.batching = True
+        try:
+            for record in records:
+                handlers = self.access_handlers if record.name == ACCESS_LOGGER else self.handlers
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+        finally:
+            for handler in all_handlers:
+                handler.batching = False
+                handler.flush()
+
+    def stop(self):
+        '''写完队列中剩余的日志后退出'''
+        self.queue.put(None)
+        self.thread.join()
+        for handler in self.handlers + self.access_handlers:
+            handler.close()
+
+
+def make_file_handler(filename):
+    '''按配置创建按大小或按时间轮转的日志文件Handler'''
+    if settings.LOG_ROTATE == 'time':
+        return BatchTimedRotatingFileHandler(
+            filename, when=settings.LOG_ROTATE_WHEN, backupCount=settings.LOG_BACKUP_COUNT,
+            encoding='utf-8', delay=True)
+    return BatchRotatingFileHandler(
+        filename, maxBytes=settings.LOG_MAX_BYTES, backupCount=settings.LOG_BACKUP_COUNT,
+        encoding='utf-8', delay=True)
+
+
+def setup(log_queue=None, listen=True):
+    '''
+    配置日志管道，多次调用只生效一次
+    多进程模式下监督进程传入一个multiprocessing.Queue，工作进程以listen=False把日志放进同一个队列，
+    只有监督进程的后台线程写文件，多个进程不会同时轮转同一个日志文件
+    '''
+    global _listener, _queue_handler
+    with _lock:
+        if _queue_handler is not None:
+            return
+        shared = log_queue is not None
+        if log_queue is None:
+            log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        for name in ('ftp_server', 'ftp_management', ACCESS_LOGGER):
+            named_logger = logging.getLogger(name)
+            named_logger.setLevel(settings.LOG_LEVEL)
+            named_logger.addHandler(queue_handler)
+            named_logger.propagate = False
+        _queue_handler = queue_handler
+        if not listen:
+            return
+        # 多个进程写同一个日志文件时记录是哪个进程
+        if shared:
+            formatter = logging.Formatter('%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s')
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler = make_file_handler(settings.LOG_FILE)
+        handler.setFormatter(formatter)
+        handlers = [handler]
+        if settings.LOG_CONSOLE:
+            console = logging.StreamHandler(sys.stdout)
+            console.setFormatter(formatter)
+            handlers.append(console)
+        access_handlers = []
+        if settings.ACCESS_LOG_FILE:
+            access_handler = make_file_handler(settings.ACCESS_LOG_FILE)
+            access_handler.setFormatter(JsonFormatter())
+            access_handlers.append(access_handler)
+        _listener = LogListener(log_queue, handlers, access_handlers)
+        atexit.register(stop)
+
+
+def get_logger(name):
+    '''返回配置好的logger'''
+    setup()
+    return logging.getLogger(name)
+
+
+def stop():
+    '''停止后台线程，保证退出前所有日志都已写入文件'''
+    global _listener, _queue_handler
+    with _lock:
+        listener, _listener = _listener, None
+        queue_handler, _queue_handler = _queue_handler, None
+    if queue_handler is None:
+        return
+    for name in ('ftp_server', 'ftp_management', ACCESS_LOGGER):
+        logging.getLogger(name).removeHandler(queue_handler)
+    if listener is not None:
+        listener.stop()
+
+
+def access(user, addr, action, status_code, started, **fields):
+    '''记录一条访问日志'''
+    access_logger = logging.getLogger(ACCESS_LOGGER)
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    entry = {
+        'user': user,
+        'client': '%s:%s' % addr,
+        'action': action,
+        'status': status_code,
+        'ms': round((time.perf_counter() - started) * 1000, 3),
+    }
+    entry.update(fields)
+    access_logger.info(action, extra={'access': entry})
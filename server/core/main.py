@@ -1,371 +1,380 @@
 import hashlib
+import hmac
 import socket
 from conf import settings
-import json
-import configparser
+from core import accounts
+from core import datachannel
+from core import dedup
+from core import dircache
+from core import engine
+from core import filecache
+from core import logger
+from core import metaindex
+from core import metrics
+from core import quota
+from core import sessionlimit
+from core import storage
+from core import throttle
+from core import timeouts
+from core.session import FTPsession
+from concurrent.futures import ThreadPoolExecutor
 import os
-import re
+import threading
 import time
-import logging
 
 
 class FTPserver():
-    '''处理与客户端所有交互的socket server'''
+    '''负责监听端口、管理共享资源，并把每个连接交给独立的会话对象处理'''
 
-    # 状态码
-    STATUS_CODE = {
-        100: 'Control Socket Build success',
-        200: 'Passed authentication!',
-        201: 'Wrong username or password!',
-        300: 'File or dir not found!',
-        301: 'File already exists, and this msg includes the file size!',
-        350: 'Dir changed successfully!',
-        351: 'Dir not found!',
-        352: 'Permission denied!',
-        400: 'List dir success!',
-        401: 'List dir failed!',
-        500: 'Create dir success!',
-        501: 'Dir is already exist!',
-        502: 'Dirname is illegal!',
-        600: 'Delete file success!',
-        601: 'Delete dir success!',
-    }
-    # 定义消息最长大小
-    MSG_SIZE = 1024
-
-
-    def __init__(self, management_instance):
-        # 创建一个logger
-        self.logger = logging.getLogger('ftp_server')
-        self.logger.setLevel(logging.INFO)
-        # 创建文件Handler
-        self.log = logging.FileHandler(settings.LOG_FILE)
-        self.log.setLevel(logging.DEBUG)
-        # 设置格式
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.log.setFormatter(formatter)
-        # 添加Handler
-        self.logger.addHandler(self.log)
+    def __init__(self, management_instance, worker=None):
+        # 日志由后台线程批量写入，请求处理线程只负责放入队列
+        self.logger = logger.get_logger('ftp_server')
         self.logger.info('FTP服务器初始化完成')
-        # 用户对象
-        self.user_obj = None
-        # 当前目录
-        self.current_dir = None
         self.management_instance = management_instance
-        # 加载用户信息
-        self.accounts = self.load_accounts()
+        # 多进程模式下为监督进程传来的prefork.Worker，单进程运行时为None
+        self.worker = worker
+        # 后台维护（清理去重池、分层存储降级）多进程模式下只由第一个工作进程运行
+        self.maintenance = worker is None or worker.index == 0
+        # 当前所有活动的会话
+        self.sessions = set()
+        self.sessions_lock = threading.Lock()
+        # 每个客户端地址的连接数和每个用户的登录会话数，多进程模式下使用监督进程中计数的代理
+        if worker is not None:
+            self.session_counter = worker.connect_sessions()
+        else:
+            self.session_counter = sessionlimit.SessionCounter()
+        # 检查所有会话的登录、空闲和传输停滞超时，都不限时不创建
+        self.reaper = None
+        if settings.HANDSHAKE_TIMEOUT or settings.IDLE_TIMEOUT or settings.TRANSFER_STALL_TIMEOUT:
+            self.reaper = timeouts.Reaper(self.logger)
+        # 停止接收新连接，等待已有的会话结束后退出
+        self.stopping = False
+        self.engine = None
+        # 数据连接的被动端口分配器和传输线程池，多进程模式下每个工作进程使用端口范围中的一段
+        min_port, max_port = settings.MIN_PASSITVE_PORT, settings.MAX_PASSITVE_PORT
+        if worker is not None:
+            min_port, max_port = worker.passive_ports(min_port, max_port)
+        self.port_allocator = datachannel.PortAllocator(settings.HOST, min_port, max_port)
+        self.transfer_pool = ThreadPoolExecutor(
+            max_workers=settings.MAX_TRANSFERS, thread_name_prefix='ftp_transfer')
+        # 签发会话令牌的密钥，未配置时每次启动随机生成；多进程模式下由监督进程生成，所有工作进程相同
+        if worker is not None:
+            self.token_secret = worker.token_secret.encode('utf-8')
+        else:
+            self.token_secret = (settings.TOKEN_SECRET or os.urandom(32).hex()).encode('utf-8')
+        # 目录列表缓存
+        self.dir_cache = None
+        if settings.LS_CACHE_SIZE > 0:
+            self.dir_cache = dircache.DirListingCache(
+                settings.LS_CACHE_SIZE, settings.LS_CACHE_INOTIFY,
+                self.logger, settings.LS_CACHE_STATS_INTERVAL)
+        # 下载文件的共享缓存，同时下载同一个文件的会话共用一份打开的文件或内存
+        self.file_cache = filecache.FileCache(
+            settings.FILE_CACHE_SIZE, settings.FILE_CACHE_MEMORY,
+            settings.FILE_CACHE_SMALL_FILE, settings.FILE_CACHE_MMAP)
+        # 全局和每个用户的限速令牌桶，多进程模式下全局带宽由各工作进程平分
+        global_rate = throttle.parse_rate(settings.GLOBAL_RATE_LIMIT)
+        if worker is not None and global_rate:
+            global_rate = max(global_rate // worker.count, 1)
+        self.global_bucket = throttle.make_bucket(global_rate, settings.RATE_LIMIT_BURST)
+        self.user_buckets = {}
+        self.buckets_lock = threading.Lock()
+        # 用户信息，账户文件修改后自动重新加载
+        self.accounts = accounts.AccountStore(
+            settings.ACCOUNT_FILE, self.logger, on_change=self.accounts_changed)
+        # 每个用户根目录一个的文件元数据索引，首次使用时打开
+        self.meta_indexes = {}
+        self.meta_lock = threading.Lock()
+        # 内容寻址的去重存储，启动时清理已经没有文件链接的对象
+        self.dedup = None
+        if settings.DEDUP:
+            self.dedup = dedup.DedupStore(
+                settings.DEDUP_POOL_DIR or os.path.join(settings.USER_HOME_BASE_DIR, '.jmftp-pool'),
+                settings.DEDUP_CHUNK_SIZE, settings.DEDUP_SCOPE, self.logger)
+            if self.maintenance:
+                self.logger.info('去重存储已开启，清理了%s个无用的对象' % self.dedup.collect_garbage())
+        # 用户文件的存储后端，按名称在首次使用时创建，所有使用同一后端的用户共用
+        self.storages = {}
+        self.storages_lock = threading.Lock()
+        # 用户空间用量的计数器，按配额拒绝超出的上传和创建目录；多进程模式下使用监督进程中计数器的代理
+        self.quota = None
+        if settings.QUOTA and worker is not None:
+            self.quota = worker.connect_quota()
+        elif settings.QUOTA:
+            self.quota = quota.QuotaManager(
+                settings.QUOTA_DB or os.path.join(settings.USER_HOME_BASE_DIR, '.jmftp-quota.db'),
+                self.scan_usage, self.logger, settings.QUOTA_FLUSH_INTERVAL, settings.QUOTA_RECONCILE_INTERVAL)
+        # 运行指标，开启时通过本地HTTP端口提供给Prometheus和stats管理命令
+        self.metrics = metrics.Metrics(self)
+        self.metrics_server = None
+        if worker is not None:
+            # 工作进程的指标只在本机的随机端口上提供给监督进程，由监督进程合并后对外提供
+            self.metrics_server = metrics.MetricsServer(self.metrics, '127.0.0.1', 0)
+        elif settings.METRICS_PORT:
+            try:
+                self.metrics_server = metrics.MetricsServer(
+                    self.metrics, settings.METRICS_HOST, settings.METRICS_PORT)
+                self.logger.info('指标服务绑定端口%s成功' % settings.METRICS_PORT)
+            except OSError as e:
+                self.logger.error('指标服务绑定端口%s失败：%s' % (settings.METRICS_PORT, e))
+        # 多进程模式下使用监督进程创建的socket，或者用SO_REUSEPORT各自监听同一个端口
+        if worker is not None:
+            self.sock = worker.listen()
+        else:
+            self.sock = self.listen()
+
+    def listen(self):
+        '''创建监听socket，绑定失败时退出'''
         # 实例化socket对象
-        self.sock = socket.socket(
+        sock = socket.socket(
             socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # 端口绑定
         try:
-            self.sock.bind((settings.HOST, settings.PORT))
+            sock.bind((settings.HOST, settings.PORT))
             self.logger.info('FTP服务器绑定端口%s成功' % settings.PORT)
         except:
             self.logger.error('FTP服务器绑定端口%s失败' % settings.PORT)
             print('FTP服务器绑定端口%s失败' % settings.PORT)
             exit()
         # 端口监听
-        self.sock.listen(settings.MAX_SOCKET_LISTEN)
+        sock.listen(settings.MAX_SOCKET_LISTEN)
+        return sock
 
     def run_forever(self):
         '''启动socket server'''
-        # 终端显示
-        print('FTP服务器在端口%s上启动成功，等待客户端连接...'%settings.PORT)
-        while True:
-            # 等待客户端发起连接请求
-            self.request, self.addr = self.sock.accept()
-            self.logger.info('接收到来自%s:%s的连接' % self.addr)
-            # 处理连接的请求
-            try:
-                print('等待新的用户认证...')
-                self.handle()
-            except Exception as e:
-                self.logger.error('处理请求出错，错误信息：%s' % e)
-                self.request.close()
+        if settings.SERVER_MODE not in engine.ENGINES:
+            self.logger.error('未知的并发模式%s' % settings.SERVER_MODE)
+            exit('未知的并发模式%s，可选：%s' % (
+                settings.SERVER_MODE, '/'.join(engine.ENGINES)))
+        self.engine = engine.ENGINES[settings.SERVER_MODE](self)
+        # 终端显示，多进程模式下由监督进程显示
+        if self.worker is None:
+            print('FTP服务器在端口%s上启动成功（%s模式），等待客户端连接...' % (
+                settings.PORT, settings.SERVER_MODE))
+        self.logger.info('FTP服务器以%s模式运行' % settings.SERVER_MODE)
+        try:
+            self.engine.serve_forever()
+        except KeyboardInterrupt:
+            print('FTP服务器已停止')
+        finally:
+            self.shutdown()
 
-    def handle(self):
-        '''处理与用户的所有指令交互'''
+    def stop(self):
+        '''停止接收新连接，已有的会话结束后run_forever返回，可以在信号处理函数中调用'''
+        self.stopping = True
+        if self.engine is not None:
+            self.engine.stop()
+
+    def drain(self):
+        '''stop之后由并发引擎调用：关闭空闲的会话，等待其余会话的指令和传输结束，最多等待DRAIN_TIMEOUT秒'''
+        deadline = time.monotonic() + settings.DRAIN_TIMEOUT
         while True:
-            # 接收用户发来的控制信息
-            raw_data = self.request.recv(self.MSG_SIZE)
-            # 处理收到空消息的情况
-            if not raw_data:
-                # 日志记录
-                self.logger.info('到%s:%s的连接已被客户端中断' % self.addr)
-                # 删除用户
-                self.user_obj = None
-                # 关闭连接
-                self.request.close()
-                self.request.close()
-                self.logger.info('关闭控制连接和数据连接')
+            with self.sessions_lock:
+                sessions = list(self.sessions)
+            for session in sessions:
+                if session.idle():
+                    session.expire('stopping')
+            with self.sessions_lock:
+                remaining = len(self.sessions)
+            if not remaining:
+                break
+            if time.monotonic() >= deadline:
+                self.logger.error('等待%s个会话结束超时' % remaining)
                 break
-            # 处理用户发来的控制信息
-            data = json.loads(raw_data.decode('utf-8'))
-            data['fill'] = None
-            print(data)
-            if self.user_obj:
-                self.logger.info('%s: %s'%(self.user_obj['name'],json.dumps(data)))
-            # 对控制信息进行解析
-            action_type = data.get('action_type')
-            if action_type:
-                if hasattr(self, '_%s' % action_type):
-                    func = getattr(self, '_%s' % action_type)
-                    func(data)
-            else:
-                self.logger.error('控制信息格式错误')
+            time.sleep(0.1)
 
-    def send_response(self, status_code, *args, **kwargs):
-        '''
-        打包发送消息给客户端
-        status_code: 状态码
-        '''
-        # 打包数据
-        data = kwargs
-        data['status_code'] = status_code
-        data['status_msg'] = self.STATUS_CODE.get(status_code)
-        data['fill'] = ''
-        # 发送数据
-        bytes_data = json.dumps(data).encode('utf-8')
-        # 如果数据长度小于规定的消息长度，则对齐进行填充
-        if len(bytes_data) < self.MSG_SIZE:
-            data['fill'] = data['fill'].zfill(self.MSG_SIZE - len(bytes_data))
-            bytes_data = json.dumps(data).encode('utf-8')
-        self.request.send(bytes_data)
+    def shutdown(self):
+        '''关闭监听端口和所有会话，让工作线程能够退出'''
+        self.sock.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.reaper is not None:
+            self.reaper.close()
+        with self.sessions_lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+        with self.meta_lock:
+            for index in self.meta_indexes.values():
+                index.close()
+            self.meta_indexes.clear()
+        self.file_cache.clear()
+        if self.dedup:
+            self.dedup.close()
+        # 多进程模式下计数器属于监督进程，这里不关闭
+        if self.quota and self.worker is None:
+            self.quota.close()
+        with self.storages_lock:
+            for backend in self.storages.values():
+                backend.close()
+        self.logger.info('FTP服务器已关闭')
+        # 写完队列中剩余的日志
+        logger.stop()
 
-    def _auth(self, data):
-        '''处理用户认证请求'''
-        username = data.get('username')
-        password = data.get('password')
-        if self.authenticate(username, password):
-            print('用户%s登录成功' % username)
-            self.logger.info('用户%s登录成功' % username)
-            self.send_response(200)
-        else:
-            print('用户%s登录失败' % username)
-            self.logger.error('用户%s登录失败' % username)
-            self.send_response(201)
+    def create_session(self, request, addr):
+        '''为新连接创建会话对象，同一地址的连接数已达到MAX_SESSIONS_PER_IP时拒绝连接并返回None'''
+        session = FTPsession(self, request, addr)
+        limit = settings.MAX_SESSIONS_PER_IP
+        # 不限制时不计数，省去多进程模式下访问监督进程的往返
+        if limit:
+            if not self.session_counter.acquire('ip', addr[0], limit, os.getpid()):
+                self.logger.error('来自%s的连接数已达到上限%s，拒绝连接' % (addr[0], limit))
+                self.metrics.session_rejected('ip')
+                session.reject()
+                return None
+            session.counted_address = addr[0]
+        with self.sessions_lock:
+            self.sessions.add(session)
+        self.metrics.session_opened()
+        self.watch_session(session)
+        return session
 
-    def load_accounts(self):
-        '''加载用户信息'''
-        config = configparser.ConfigParser()
-        config.read(settings.ACCOUNT_FILE)
-        self.logger.info('用户信息加载完成')
-        return config
+    def remove_session(self, session):
+        '''会话结束后从活动会话中移除'''
+        with self.sessions_lock:
+            if session not in self.sessions:
+                return
+            self.sessions.discard(session)
+        if session.counted_address is not None:
+            self.session_counter.release('ip', session.counted_address, os.getpid())
+        if session.counted_user is not None:
+            self.session_counter.release('user', session.counted_user, os.getpid())
 
-    def authenticate(self, username, password):
-        '''用户认证方法'''
-        if username in self.accounts:
-            _password = self.accounts[username]['password']
-            # 对用户输入的密码进行MD5加密
-            md5_obj = hashlib.md5()
-            md5_obj.update(password.encode('utf-8'))
-            if md5_obj.hexdigest() == _password:
-                # 保存用户对象
-                self.user_obj = self.accounts[username]
-                # 记录用户文件目录
-                self.user_obj['home'] = os.path.join(
-                    settings.USER_HOME_BASE_DIR, username)
-                self.current_dir = self.user_obj['home']
-                return True
-        return False
+    def login_session(self, session, username):
+        '''会话以username登录，计入该用户的会话数，已达到MAX_SESSIONS_PER_USER时返回False'''
+        limit = settings.MAX_SESSIONS_PER_USER
+        if session.counted_user == username:
+            return True
+        if limit and not self.session_counter.acquire('user', username, limit, os.getpid()):
+            self.metrics.session_rejected('user')
+            return False
+        # 同一个连接换了用户重新登录
+        if session.counted_user is not None:
+            self.session_counter.release('user', session.counted_user, os.getpid())
+        session.counted_user = username if limit else None
+        return True
 
-    def _get(self, data):
-        '''处理用户下载请求
-        1. 拿到文件名
-        2. 判断文件是否存在
-            2.1 如果文件存在，返回状态码+文件大小
-                2.1.1 发送文件
-            2.2 如果文件不存在，返回状态码
-        '''
-        filename = data.get('filename')
-        full_path = os.path.join(self.current_dir, filename)
-        if os.path.isfile(full_path):
-            # 返回文件大小
-            file_size = os.path.getsize(full_path)
-            self.send_response(301, file_size=file_size)
-            # 日志记录
-            self.logger.info('%s: %s' % (self.user_obj['name'], '下载文件%s' % full_path))
-            # 发送文件
-            with open(full_path, 'rb') as f:
-                for line in f:
-                    self.request.send(line)
-                else:
-                    # 日志记录
-                    self.logger.info('%s: %s' % (self.user_obj['name'], '文件%s下载完成' % full_path))
-        else:
-            self.send_response(300)
-            # 日志记录
-            self.logger.error('%s: %s' % (self.user_obj['name'], '文件%s不存在' % full_path))
+    def watch_session(self, session):
+        '''开启了超时检查时，让Reaper在会话的下一个检查时刻检查它'''
+        if self.reaper is None:
+            return
+        deadline = session.check_timeouts(time.monotonic())
+        if deadline is not None:
+            self.reaper.watch(session, deadline)
 
-    def _cd(self, data):
-        '''处理用户切换目录请求
-        1. 把target_dir和user_current_dir拼接起来
-        2. 检测要切换的目录是否存在，如果存在，则切换目录
-        3. 如果目录不存在，返回状态码
-        '''
-        path = data.get('target_dir')
-        # 判断是否为返回上一级目录
-        if path == '..':
-            full_path = os.path.dirname(self.current_dir)
-            # 判断是否合法
-            if full_path.startswith(self.user_obj['home']):
-                self.current_dir = full_path
-                relative_path = os.path.relpath(
-                    full_path, self.user_obj['home'])
-                self.send_response(350, relative_dir=relative_path)
-                # 日志记录
-                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
-            else:
-                self.send_response(351)
-                # 日志记录
-                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
-        # 判断是否为进入下一级目录
-        # 如果路径名以'/'开头，则认为是绝对路径，从用户根目录开始
-        elif path.startswith('/'):
-            # 拼接目录
-            full_path = os.path.join(self.user_obj['home'], path[1:])
-            print(full_path)
-            # 判断路径是否存在
-            if os.path.isdir(full_path):
-                self.current_dir = full_path
-                relative_path = os.path.relpath(
-                    full_path, self.user_obj['home'])
-                self.send_response(350, relative_dir=relative_path)
-                # 日志记录
-                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
-            else:
-                self.send_response(351)
-                # 日志记录
-                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
+    def list_dir(self, backend, path):
+        '''返回目录下的所有目录项，本地存储开启缓存时优先从缓存读取，元数据索引文件不显示'''
+        if self.dir_cache and backend.local:
+            entries = self.dir_cache.get_entries(os.path.normpath(path))
         else:
-            # 拼接目录
-            full_path = os.path.join(self.current_dir, path)
-            # 判断目录是否存在
-            if os.path.isdir(full_path):
-                self.current_dir = full_path
-                relative_path = os.path.relpath(
-                    full_path, self.user_obj['home'])
-                self.send_response(350, relative_dir=relative_path)
-                # 日志记录
-                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
-            else:
-                self.send_response(351)
-                # 日志记录
-                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
-        print('current_dir:', self.current_dir)
+            entries = backend.list_dir(path)
+        return (entry for entry in entries if not self.is_reserved(entry['filename']))
 
-    def _ls(self, data):
-        '''处理用户列出目录请求
-        '''
-        # 列出当前目录下的文件
-        files = os.listdir(self.current_dir)
-        res = []
-        for file in files:
-            # 判断是否是目录
-            if os.path.isdir(os.path.join(self.current_dir, file)):
-                dir = {'filename': file, 'is_dir': True}
-            else:
-                dir = {'filename': file, 'is_dir': False, 'size': os.path.getsize(
-                    os.path.join(self.current_dir, file)), 'time': os.path.getmtime(os.path.join(self.current_dir, file))}
-            res.append(dir)
-        self.send_response(400,  res=res)
-        # 日志记录
-        self.logger.info('%s: %s' % (self.user_obj['name'], '列出目录%s' % self.current_dir))
+    @staticmethod
+    def is_reserved(filename):
+        '''是否为服务器自己使用的文件（元数据索引及SQLite的日志文件）'''
+        return os.path.basename(filename).startswith(settings.META_INDEX_FILE)
 
-    def _mkdir(self, data):
-        '''在当前目录下创建文件夹'''
-        # 拼接目录
-        full_path = os.path.join(self.current_dir, data.get('dirname'))
-        # 判断目录是否存在或文件名是否合法
-        if os.path.isdir(full_path):
-            self.send_response(501)
-            # 日志记录
-            self.logger.error('%s: %s' % (self.user_obj['name'], '创建目录%s失败，已经存在' % full_path))
-        elif not re.match(r'^[\w\-]+$', data.get('dirname')):
-            self.send_response(502)
-            # 日志记录
-            self.logger.error('%s: %s' % (self.user_obj['name'], '创建目录%s失败，文件名不合法' % full_path))
-        else:
-            # 创建目录
-            os.mkdir(full_path)
-            self.send_response(500)
-            # 日志记录
-            self.logger.info('%s: %s' % (self.user_obj['name'], '创建目录%s成功' % full_path))
+    def meta_index(self, home):
+        '''返回用户根目录对应的元数据索引，关闭索引时返回None'''
+        if not settings.META_INDEX:
+            return None
+        with self.meta_lock:
+            index = self.meta_indexes.get(home)
+            if index is None:
+                index = metaindex.MetadataIndex(home, settings.META_INDEX_FILE)
+                self.meta_indexes[home] = index
+            return index
 
-    def _rm(self, data):
-        '''在当前目录下删除文件'''
-        # 拼接目录
-        full_path = os.path.join(self.current_dir, data.get('filename'))
-        # 判断文件是否存在
-        if os.path.isfile(full_path):
-            os.remove(full_path)
-            self.send_response(600)
-            # 日志记录
-            self.logger.info('%s: %s' % (self.user_obj['name'], '删除文件%s' % full_path))
-        elif os.path.isdir(full_path):
-            os.rmdir(full_path)
-            self.send_response(601)
-            # 日志记录
-            self.logger.info('%s: %s' % (self.user_obj['name'], '删除目录%s' % full_path))
-        else:
-            self.send_response(300)
-            # 日志记录
-            self.logger.error('%s: %s' % (self.user_obj['name'], '删除文件或目录%s失败，不存在' % full_path))
+    def dir_changed(self, full_path):
+        '''文件或目录full_path被创建、修改或删除后通知目录缓存'''
+        if self.dir_cache:
+            full_path = os.path.normpath(full_path)
+            self.dir_cache.refresh_entry(*os.path.split(full_path))
+            # 被删除的是目录时，它自身的缓存也要失效
+            self.dir_cache.invalidate(full_path)
 
-    def _put(self, data):
-        '''上传文件到服务器
-        1. 拿到local_file的文件名和大小
-        2. 检查本地是否有同名文件
-        '''
-        local_file = data.get('local_file')
-        full_path = os.path.join(self.current_dir, local_file)
-        # 如果文件已存在，则给他打上时间戳
-        if os.path.isfile(full_path):
-            if '.' in full_path:
-                lis = full_path.split('.')
-                filename = lis[0] + '_' + str(int(time.time())) + '.' + lis[1]
-        else:
-            filename = full_path
-        print(filename)
-        with open(filename, 'wb') as f:
-            print('已经打开')
-            file_size = data.get('file_size')
-            recieved_size = 0
-            while recieved_size < file_size:
-                if file_size - recieved_size < 8192:
-                    data = self.request.recv(file_size - recieved_size)
-                else:
-                    data = self.request.recv(8192)
-                f.write(data)
-                recieved_size += len(data)
-            else:
-                # 日志记录
-                self.logger.info('%s: %s' % (self.user_obj['name'], '上传文件%s成功' % filename))
+    def storage(self, name):
+        '''返回名为name的存储后端，不存在时抛出ValueError'''
+        with self.storages_lock:
+            if name not in self.storages:
+                if name not in storage.BACKENDS:
+                    raise ValueError('未知的存储后端%s' % name)
+                self.storages[name] = storage.BACKENDS[name](self.logger, self.maintenance)
+            return self.storages[name]
 
-    def _resend(self, data):
-        # 拼接文件路径
-        full_path = os.path.join(
-            self.user_obj['home'], data.get('abs_filename'))
-        # 判断文件是否存在
-        if os.path.isfile(full_path):
-            # 判断文件大小
-            file_size = os.path.getsize(full_path)
-            if file_size == data.get('file_size'):
-                self.send_response(301)
-                with open(full_path, 'rb') as f:
-                    f.seek(data.get('recieved_size'))
-                    for line in f:
-                        self.request.send(line)
-                    else:
-                        # 日志记录
-                        self.logger.info('%s: %s' % (self.user_obj['name'], '重传完成，文件%s' % full_path))
-            else:
-                self.send_response(300)
-                # 日志记录
-                self.logger.error('%s: %s' % (self.user_obj['name'], '重传失败，大小不一致，文件%s' % full_path))
-        else:
-            self.send_response(300)
-            # 日志记录
-            self.logger.error('%s: %s' % (self.user_obj['name'], '重传失败，文件%s不存在' % full_path))
+    def storage_stats(self):
+        '''返回已经创建的各个存储后端的统计'''
+        with self.storages_lock:
+            backends = list(self.storages.items())
+        return dict((name, backend.stats()) for name, backend in backends if backend.stats())
+
+    def quota_limits(self, username):
+        '''返回用户的(字节数配额, 文件数配额)，0表示不限制'''
+        user = self.accounts.get(username) or {}
+        # 配额与速率的写法相同，支持K/M/G后缀
+        return (throttle.parse_rate(user.get('quota_bytes', settings.USER_QUOTA_BYTES)),
+                int(user.get('quota_files', settings.USER_QUOTA_FILES)))
+
+    def scan_usage(self, username):
+        '''遍历用户目录，返回(已用字节数, 文件数)，目录也计为一个文件，元数据索引不计入'''
+        user_obj = self.make_user_obj(username)
+        if user_obj is None:
+            return 0, 0
+        backend = self.storage(user_obj.get('storage', settings.STORAGE_BACKEND))
+        return quota.scan_home(backend, user_obj['home'], self.quota.active_uploads(), self.is_reserved)
+
+    def user_bucket(self, username):
+        '''返回用户的限速令牌桶，同一用户的所有会话共用，不限速时返回None'''
+        with self.buckets_lock:
+            if username not in self.user_buckets:
+                rate = settings.USER_RATE_LIMIT
+                user = self.accounts.get(username)
+                if user is not None:
+                    rate = user.get('rate_limit', rate)
+                self.user_buckets[username] = throttle.make_bucket(rate, settings.RATE_LIMIT_BURST)
+            return self.user_buckets[username]
+
+    def accounts_changed(self, usernames):
+        '''账户文件重新加载后，丢弃有变化的用户的限速令牌桶，下次使用时按新配置创建'''
+        with self.buckets_lock:
+            for username in usernames:
+                self.user_buckets.pop(username, None)
+
+    def authenticate(self, username, password):
+        '''用户认证方法，认证成功返回该会话专用的用户对象'''
+        if self.accounts.verify(username, password):
+            return self.make_user_obj(username)
+        return None
+
+    def make_user_obj(self, username):
+        '''生成会话专用的用户对象，用户不存在时返回None'''
+        # 账户表返回的是副本，会话修改自己的用户对象不会影响其他会话
+        user_obj = self.accounts.get(username)
+        if user_obj is None:
+            return None
+        # 记录用户文件目录
+        user_obj['home'] = os.path.join(
+            settings.USER_HOME_BASE_DIR, username)
+        return user_obj
+
+    def issue_token(self, username):
+        '''为已认证的用户签发令牌，同一用户的附加连接凭令牌认证，无需再次发送密码'''
+        expires = int(time.time()) + settings.TOKEN_TTL
+        payload = '%s:%s' % (username, expires)
+        signature = hmac.new(self.token_secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+        return '%s:%s' % (expires, signature)
+
+    def authenticate_token(self, username, token):
+        '''校验令牌，通过时返回该会话专用的用户对象'''
+        try:
+            expires, signature = token.split(':')
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            return None
+        payload = '%s:%s' % (username, expires)
+        expected = hmac.new(self.token_secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+        if expires < time.time() or not hmac.compare_digest(signature, expected):
+            return None
+        return self.make_user_obj(username)
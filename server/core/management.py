@@ -1,28 +1,20 @@
+from core import accounts
+from core import logger
 from core import main
-import logging
+from core import prefork
 from conf import settings
-import configparser
 import getpass
-import hashlib
+import json
 import os
 import time
+import urllib.request
 
 class ManagementTool(object):
     '''负责对用户输入的指令进行解析并执行特定的功能'''
 
     def __init__(self, sys_argv):
-        # 创建一个logger
-        self.logger = logging.getLogger('ftp_management')
-        self.logger.setLevel(logging.INFO)
-        # 创建文件Handler
-        self.log = logging.FileHandler(settings.LOG_FILE)
-        self.log.setLevel(logging.DEBUG)
-        # 设置格式
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.log.setFormatter(formatter)
-        # 添加Handler
-        self.logger.addHandler(self.log)
+        # 与FTP服务器共用同一个日志管道，不再单独打开日志文件
+        self.logger = logger.get_logger('ftp_management')
         self.sys_argv = sys_argv    # 记录指令
         self.verify_argv()               # 验证指令
 
@@ -39,10 +31,12 @@ class ManagementTool(object):
         msg = '''
 正确的输入参数为：
 ------------------------------
-start       |   开启FTP服务器
+start       |   开启FTP服务器（start prefork [进程数]以多进程模式运行）
 createuser  |   创建用户   
 deleteuser  |   删除用户 
+passwd      |   修改用户密码
 ls          |   查看用户列表
+stats       |   查看运行中服务器的实时指标（stats once只输出一次）
 ------------------------------
         '''
         exit(msg)   # 退出，并打印指令输入格式
@@ -54,15 +48,19 @@ ls          |   查看用户列表
         func()  # 执行命令对应的函数
 
     def start(self):
-        '''开启FTP服务端'''
+        '''开启FTP服务端，开启PREFORK或指定prefork时由监督进程启动多个工作进程'''
         self.logger.info('准备运行FTP服务器')
+        args = self.sys_argv[2:]
+        if settings.PREFORK or 'prefork' in args:
+            counts = [int(arg) for arg in args if arg.isdigit()]
+            prefork.Supervisor(self, counts[0] if counts else None).run()
+            return
         server = main.FTPserver(self)
         server.run_forever()
 
     def createuser(self):
         '''创建用户'''
-        config = configparser.ConfigParser()
-        config.read(settings.ACCOUNT_FILE)
+        config = accounts.read_config(settings.ACCOUNT_FILE)
         count = 0
         while count < 3:
             username = input('请输入用户名：')
@@ -78,15 +76,10 @@ ls          |   查看用户列表
                 count += 1
                 continue
             config.add_section(username)
-            # 对用户输入的密码进行MD5加密
-            md5_obj = hashlib.md5()
-            md5_obj.update(password.encode('utf-8'))
-            md5_password = md5_obj.hexdigest()
-            # 将用户信息写入文件
+            # 将用户信息写入文件，密码保存为加盐摘要，运行中的服务端会自动加载新用户
             config.set(username, 'name', username)
-            config.set(username, 'password', md5_password)
-            with open(settings.ACCOUNT_FILE, 'w') as f:
-                config.write(f)
+            config.set(username, 'password', accounts.hash_password(password))
+            accounts.write_config(config, settings.ACCOUNT_FILE)
             # 提示用户创建成功
             print('用户%s创建成功'%username)
             # 日志记录
@@ -101,8 +94,7 @@ ls          |   查看用户列表
         '''删除用户'''
         # 列出当前所有用户
         self.ls()
-        config = configparser.ConfigParser()
-        config.read(settings.ACCOUNT_FILE)
+        config = accounts.read_config(settings.ACCOUNT_FILE)
         count = 0
         while count < 3:
             username = input('请输入用户名：')
@@ -112,8 +104,7 @@ ls          |   查看用户列表
                 continue
             if input('确定删除用户%s吗？(y/n)'%username) == 'y':
                 config.remove_section(username)
-                with open(settings.ACCOUNT_FILE, 'w') as f:
-                    config.write(f)
+                accounts.write_config(config, settings.ACCOUNT_FILE)
                 print('用户%s删除成功'%username)
                 # 日志记录
                 self.logger.info('用户%s删除成功' % username)
@@ -126,16 +117,102 @@ ls          |   查看用户列表
                 print('用户删除失败')
                 break
 
+    def passwd(self):
+        '''修改用户密码'''
+        config = accounts.read_config(settings.ACCOUNT_FILE)
+        count = 0
+        while count < 3:
+            username = input('请输入用户名：')
+            if username not in config.sections():
+                print('用户名不存在，请重新输入')
+                count += 1
+                continue
+            password = getpass.getpass('请输入新密码：')
+            password_again = getpass.getpass('请再次输入新密码：')
+            if password != password_again:
+                print('两次密码不一致，请重新输入')
+                count += 1
+                continue
+            config.set(username, 'password', accounts.hash_password(password))
+            accounts.write_config(config, settings.ACCOUNT_FILE)
+            print('用户%s密码修改成功'%username)
+            # 日志记录
+            self.logger.info('用户%s密码修改成功' % username)
+            break
+
     def ls(self):
         '''列出所有用户'''
         print('用户列表'.center(20, '-'))
-        config = configparser.ConfigParser()
-        config.read(settings.ACCOUNT_FILE)
+        config = accounts.read_config(settings.ACCOUNT_FILE)
         for index,username in enumerate(config.sections()):
             print('No.%s\t%s'%(index+1,username))
         print('-'*24)
 
-            
-            
-
+    def stats(self):
+        '''从运行中的服务器的指标端口读取指标，每秒刷新一次，直到Ctrl+C'''
+        if not settings.METRICS_PORT:
+            exit('指标服务未开启，请在settings.py中设置METRICS_PORT')
+        host = settings.METRICS_HOST
+        if host in ('0.0.0.0', ''):
+            host = '127.0.0.1'
+        url = 'http://%s:%s/stats' % (host, settings.METRICS_PORT)
+        once = self.sys_argv[2:3] == ['once']
+        try:
+            while True:
+                try:
+                    with urllib.request.urlopen(url, timeout=5) as response:
+                        snapshot = json.loads(response.read().decode('utf-8'))
+                except OSError as e:
+                    exit('无法连接指标服务%s：%s' % (url, e))
+                if not once:
+                    print('\033[2J\033[H', end='')   # 清屏
+                print(self.format_stats(snapshot))
+                if once:
+                    break
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
 
+    @staticmethod
+    def format_stats(snapshot):
+        '''把指标格式化为便于阅读的表格'''
+        lines = [
+            '运行时间：%ds  活动会话：%s（累计%s）  进行中的传输：%s  未传输字节：%s' % (
+                snapshot['uptime'], snapshot['sessions_active'], snapshot['sessions_total'],
+                snapshot['transfers_active'], snapshot['bytes_in_flight']),
+            '',
+            '%-12s%10s%8s%12s%12s%12s%12s' % ('指令', '次数', '错误', 'avg(ms)', 'p50(ms)', 'p99(ms)', 'max(ms)'),
+        ]
+        for action, item in sorted(snapshot['commands'].items(), key=lambda item: -item[1]['count']):
+            lines.append('%-14s%10s%8s%12.2f%12.2f%12.2f%12.2f' % (
+                action, item['count'], item['errors'], item['avg'] * 1000,
+                item['p50'] * 1000, item['p99'] * 1000, item['max'] * 1000))
+        lines.append('')
+        timeouts, rejected = snapshot.get('timeouts', {}), snapshot.get('sessions_rejected', {})
+        if timeouts or rejected:
+            lines.append('登录超时断开%s次，空闲超时断开%s次，传输停滞中止%s次，超出地址连接数拒绝%s次，超出用户会话数拒绝%s次' % (
+                timeouts.get('handshake', 0), timeouts.get('idle', 0), timeouts.get('stall', 0),
+                rejected.get('ip', 0), rejected.get('user', 0)))
+        for direction in sorted(snapshot['transfer_bytes']):
+            done = snapshot['transfers'].get('%s_done' % direction, 0)
+            failed = snapshot['transfers'].get('%s_failed' % direction, 0)
+            aborted = snapshot['transfers'].get('%s_aborted' % direction, 0)
+            throughput = snapshot['throughput'].get(direction, {'p50': 0, 'max': 0})
+            lines.append('%s：完成%s次，失败%s次，中止%s次，共%.2fMB，单次吞吐量p50 %.2fMB/s，最高%.2fMB/s' % (
+                direction, done, failed, aborted, snapshot['transfer_bytes'][direction] / 1024 / 1024,
+                throughput['p50'] / 1024 / 1024, throughput['max'] / 1024 / 1024))
+        file_cache = snapshot.get('file_cache')
+        if file_cache:
+            lines.append('文件缓存：%s个文件，内存%.2fMB，命中%s次，未命中%s次，淘汰%s次' % (
+                file_cache['files'], file_cache['memory'] / 1024 / 1024,
+                file_cache['hits'], file_cache['misses'], file_cache['evictions']))
+        for backend, stats in sorted(snapshot.get('storage', {}).items()):
+            lines.append('存储后端%s：%s' % (backend, '，'.join('%s %s' % item for item in sorted(stats.items()))))
+        # 多进程模式下每个工作进程一行
+        if snapshot.get('workers'):
+            lines.append('')
+        for worker in snapshot.get('workers', []):
+            lines.append('工作进程%s（pid %s，第%s代，%s）：运行%ds，活动会话%s（累计%s），进行中的传输%s，重启%s次' % (
+                worker['worker'], worker['pid'], worker['generation'], worker['state'], worker['uptime'],
+                worker['sessions_active'], worker['sessions_total'], worker['transfers_active'], worker['restarts']))
+        return '\n'.join(lines)
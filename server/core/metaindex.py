@@ -0,0 +1,86 @@
+import json
+import os
+import sqlite3
+import threading
+from common import checksum
+
+
+class MetadataIndex(object):
+    '''
+    用户的文件元数据索引，保存在用户根目录下的SQLite数据库中
+    每个文件记录大小、mtime、inode和块摘要，首次请求校验和时计算并写入，
+    之后只要stat的结果没有变化就直接读取，不必重新读取整个文件
+    _put收完文件时直接写入上传过程中算出的块摘要，_rm删除文件时删除对应记录
+    '''
+
+    def __init__(self, home, filename):
+        self.home = home
+        self.path = os.path.join(home, filename)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 所有会话共用一个连接，由锁保证同一时间只有一个线程访问
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT, algorithm TEXT, block_size INTEGER, '
+                'size INTEGER, mtime_ns INTEGER, inode INTEGER, blocks TEXT, '
+                'PRIMARY KEY (path, algorithm, block_size))')
+
+    def get_blocks(self, full_path, algorithm, block_size):
+        '''返回(文件大小, 块摘要列表)，索引中的记录失效时重新计算'''
+        st = os.stat(full_path)
+        key = (self._key(full_path), algorithm, block_size)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, inode, blocks FROM files '
+                'WHERE path=? AND algorithm=? AND block_size=?', key).fetchone()
+            if row is not None and tuple(row[:3]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                self.hits += 1
+                return st.st_size, json.loads(row[3])
+            self.misses += 1
+        # 计算摘要时不持有锁，其他会话可以继续查询
+        blocks = checksum.hash_file(full_path, algorithm, block_size)
+        # 计算期间文件被修改过时结果不写入索引
+        if self._same_file(st, os.stat(full_path)):
+            self._save(key, st, blocks)
+        return st.st_size, blocks
+
+    def store_blocks(self, full_path, algorithm, block_size, blocks):
+        '''文件写入完成后直接记录已经算好的块摘要'''
+        path = self._key(full_path)
+        st = os.stat(full_path)
+        with self.lock, self.conn:
+            # 文件内容变了，其他算法或块大小的记录都已失效
+            self.conn.execute('DELETE FROM files WHERE path=?', (path,))
+        self._save((path, algorithm, block_size), st, blocks)
+
+    def remove(self, full_path):
+        '''文件被删除后删除对应记录'''
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM files WHERE path=?', (self._key(full_path),))
+
+    def stats(self):
+        '''返回索引的命中统计'''
+        with self.lock:
+            files = self.conn.execute('SELECT COUNT(DISTINCT path) FROM files').fetchone()[0]
+            return {'files': files, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _save(self, key, st, blocks):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                key + (st.st_size, st.st_mtime_ns, st.st_ino, json.dumps(blocks)))
+
+    def _key(self, full_path):
+        '''索引中使用相对于用户根目录的路径，用户目录整体搬迁后索引仍然有效'''
+        return os.path.relpath(full_path, self.home)
+
+    @staticmethod
+    def _same_file(st1, st2):
+        return (st1.st_size, st1.st_mtime_ns, st1.st_ino) == (st2.st_size, st2.st_mtime_ns, st2.st_ino)
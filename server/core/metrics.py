@@ -0,0 +1,374 @@
+import bisect
+import http.server
+import json
+import threading
+import time
+
+# 指令处理耗时的直方图分桶（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 单次传输吞吐量的直方图分桶（字节/秒）
+THROUGHPUT_BUCKETS = tuple(1024 * 2 ** i for i in range(0, 22, 2))   # 1KB/s ~ 4GB/s
+# 存储后端统计中的字段对应的指标：(字段, 指标名, 类型, 说明)
+STORAGE_METRICS = (
+    ('files', 'jmftp_storage_files', 'gauge', 'Files held by the storage backend.'),
+    ('bytes', 'jmftp_storage_bytes', 'gauge', 'Bytes held by the storage backend.'),
+    ('promotions', 'jmftp_storage_promotions_total', 'counter', 'Files moved from the cold tier to the hot tier.'),
+    ('demotions', 'jmftp_storage_demotions_total', 'counter', 'Files moved from the hot tier to the cold tier.'),
+)
+
+
+class Histogram(object):
+    '''累计分桶直方图，与Prometheus的histogram类型对应'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为+Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        '''按分桶估算分位数，在桶内线性插值'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+    def export(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'max': self.max}
+
+    def merge(self, state):
+        '''加上另一个进程中同样分桶的直方图export()的结果'''
+        self.counts = [a + b for a, b in zip(self.counts, state['counts'])]
+        self.count = sum(self.counts)
+        self.sum += state['sum']
+        self.max = max(self.max, state['max'])
+
+    def render(self, name, labels):
+        '''输出Prometheus文本格式的_bucket、_sum和_count'''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s} %s' % (name, format_labels(labels, le=bound), cumulative))
+        lines.append('%s_sum{%s} %s' % (name, format_labels(labels), self.sum))
+        lines.append('%s_count{%s} %s' % (name, format_labels(labels), self.count))
+        return lines
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in items)
+
+
+class Metrics(object):
+    '''
+    服务器的运行指标：
+    1. 每种指令的次数、错误数和处理耗时直方图，在会话处理指令后记录
+    2. 每次数据传输的字节数、结果和吞吐量直方图，在传输结束后记录
+    3. 活动会话数、进行中的传输数和尚未传输的字节数，在读取指标时从服务器当前状态统计
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.commands = {}  # (指令, 状态码) -> 次数
+        self.errors = {}    # 指令 -> 错误次数
+        self.latency = {}   # 指令 -> Histogram
+        self.transfers = {} # (方向, 结果) -> 次数
+        self.transfer_bytes = {}    # 方向 -> 字节数
+        self.throughput = {}    # 方向 -> Histogram
+        self.sessions_total = 0
+        self.timeouts = {}  # 超时类型（handshake、idle、stall） -> 次数
+        self.rejected = {}  # 拒绝原因（ip、user） -> 次数
+
+    def session_opened(self):
+        with self.lock:
+            self.sessions_total += 1
+
+    def timed_out(self, kind):
+        '''记录一次超时断开的连接或中止的传输'''
+        with self.lock:
+            self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+
+    def session_rejected(self, reason):
+        '''记录一次因同时连接数超出限制而拒绝的连接或登录'''
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def observe_command(self, action, status_code, seconds, error):
+        '''记录一条指令的处理结果和耗时'''
+        with self.lock:
+            key = (action, status_code)
+            self.commands[key] = self.commands.get(key, 0) + 1
+            if error:
+                self.errors[action] = self.errors.get(action, 0) + 1
+            if action not in self.latency:
+                self.latency[action] = Histogram(LATENCY_BUCKETS)
+            self.latency[action].observe(seconds)
+
+    def observe_transfer(self, direction, size, seconds, result):
+        '''记录一次数据传输，result为done、failed或aborted'''
+        with self.lock:
+            key = (direction, result)
+            self.transfers[key] = self.transfers.get(key, 0) + 1
+            self.transfer_bytes[direction] = self.transfer_bytes.get(direction, 0) + size
+            if result == 'done' and size:
+                if direction not in self.throughput:
+                    self.throughput[direction] = Histogram(THROUGHPUT_BUCKETS)
+                self.throughput[direction].observe(size / max(seconds, 1e-6))
+
+    def active(self):
+        '''统计当前的活动会话、进行中的传输和尚未传输的字节数'''
+        with self.server.sessions_lock:
+            sessions = list(self.server.sessions)
+        transfers = []
+        for session in sessions:
+            with session.transfers_lock:
+                transfers.extend(session.transfers.values())
+        in_flight = sum(max(transfer.size - transfer.done, 0) for transfer in transfers
+                        if transfer.state in ('waiting', 'running'))
+        return len(sessions), len(transfers), in_flight
+
+    def gauges(self):
+        '''返回(活动会话数, 进行中的传输数, 未传输字节数, 文件缓存统计, 存储后端统计)'''
+        sessions, transfers, in_flight = self.active()
+        return sessions, transfers, in_flight, self.server.file_cache.stats(), self.server.storage_stats()
+
+    def export(self):
+        '''返回可以JSON序列化、能与其他进程的指标相加的原始计数，多进程模式下由监督进程合并'''
+        sessions, transfers, in_flight, file_cache, storage_stats = self.gauges()
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'gauges': [sessions, transfers, in_flight],
+                'sessions_total': self.sessions_total,
+                'timeouts': dict(self.timeouts),
+                'rejected': dict(self.rejected),
+                'commands': [[action, status_code, count] for (action, status_code), count in self.commands.items()],
+                'errors': dict(self.errors),
+                'latency': dict((action, histogram.export()) for action, histogram in self.latency.items()),
+                'transfers': [[direction, result, count] for (direction, result), count in self.transfers.items()],
+                'transfer_bytes': dict(self.transfer_bytes),
+                'throughput': dict((direction, histogram.export())
+                                   for direction, histogram in self.throughput.items()),
+                'file_cache': file_cache,
+                'storage': storage_stats,
+            }
+
+    def merge(self, state):
+        '''加上另一个进程export()的计数，当前值（活动会话数等）不在这里合并'''
+        with self.lock:
+            self.sessions_total += state['sessions_total']
+            for kind, count in state['timeouts'].items():
+                self.timeouts[kind] = self.timeouts.get(kind, 0) + count
+            for reason, count in state['rejected'].items():
+                self.rejected[reason] = self.rejected.get(reason, 0) + count
+            for action, status_code, count in state['commands']:
+                key = (action, status_code)
+                self.commands[key] = self.commands.get(key, 0) + count
+            for action, count in state['errors'].items():
+                self.errors[action] = self.errors.get(action, 0) + count
+            for action, histogram in state['latency'].items():
+                if action not in self.latency:
+                    self.latency[action] = Histogram(LATENCY_BUCKETS)
+                self.latency[action].merge(histogram)
+            for direction, result, count in state['transfers']:
+                key = (direction, result)
+                self.transfers[key] = self.transfers.get(key, 0) + count
+            for direction, size in state['transfer_bytes'].items():
+                self.transfer_bytes[direction] = self.transfer_bytes.get(direction, 0) + size
+            for direction, histogram in state['throughput'].items():
+                if direction not in self.throughput:
+                    self.throughput[direction] = Histogram(THROUGHPUT_BUCKETS)
+                self.throughput[direction].merge(histogram)
+
+    def snapshot(self):
+        '''返回所有指标的字典，供stats管理命令使用'''
+        sessions, transfers, in_flight, file_cache, storage_stats = self.gauges()
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'sessions_active': sessions,
+                'sessions_total': self.sessions_total,
+                'timeouts': dict(self.timeouts),
+                'sessions_rejected': dict(self.rejected),
+                'transfers_active': transfers,
+                'bytes_in_flight': in_flight,
+                'commands': dict((action, dict(histogram.summary(), errors=self.errors.get(action, 0)))
+                                 for action, histogram in self.latency.items()),
+                'transfers': dict(('%s_%s' % key, count) for key, count in self.transfers.items()),
+                'transfer_bytes': dict(self.transfer_bytes),
+                'throughput': dict((direction, histogram.summary())
+                                   for direction, histogram in self.throughput.items()),
+                'file_cache': file_cache,
+                'storage': storage_stats,
+            }
+
+    def render(self):
+        '''返回Prometheus文本格式的指标'''
+        sessions, transfers, in_flight, file_cache, storage_stats = self.gauges()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            metric('jmftp_uptime_seconds', 'gauge', 'Seconds since the server started.')
+            lines.append('jmftp_uptime_seconds %s' % (time.time() - self.started))
+            metric('jmftp_sessions_active', 'gauge', 'Open control connections.')
+            lines.append('jmftp_sessions_active %s' % sessions)
+            metric('jmftp_sessions_total', 'counter', 'Control connections accepted.')
+            lines.append('jmftp_sessions_total %s' % self.sessions_total)
+            metric('jmftp_timeouts_total', 'counter',
+                   'Connections closed for handshake or idle timeout and transfers aborted as stalled, by kind.')
+            for kind, count in sorted(self.timeouts.items()):
+                lines.append('jmftp_timeouts_total{%s} %s' % (format_labels([('kind', kind)]), count))
+            metric('jmftp_sessions_rejected_total', 'counter',
+                   'Connections or logins refused by the per-address or per-user session limit.')
+            for reason, count in sorted(self.rejected.items()):
+                lines.append('jmftp_sessions_rejected_total{%s} %s' % (format_labels([('reason', reason)]), count))
+            metric('jmftp_transfers_active', 'gauge', 'Data transfers waiting or running.')
+            lines.append('jmftp_transfers_active %s' % transfers)
+            metric('jmftp_bytes_in_flight', 'gauge', 'Bytes still to be sent or received by active transfers.')
+            lines.append('jmftp_bytes_in_flight %s' % in_flight)
+            metric('jmftp_commands_total', 'counter', 'Commands handled, by action and status code.')
+            for (action, status_code), count in sorted(self.commands.items(), key=str):
+                lines.append('jmftp_commands_total{%s} %s' % (
+                    format_labels([('action', action), ('status', status_code)]), count))
+            metric('jmftp_command_errors_total', 'counter', 'Commands that failed, by action.')
+            for action, count in sorted(self.errors.items(), key=str):
+                lines.append('jmftp_command_errors_total{%s} %s' % (format_labels([('action', action)]), count))
+            metric('jmftp_command_duration_seconds', 'histogram', 'Time spent handling a command.')
+            for action, histogram in sorted(self.latency.items(), key=str):
+                lines.extend(histogram.render('jmftp_command_duration_seconds', [('action', action)]))
+            metric('jmftp_transfers_total', 'counter', 'Finished data transfers, by direction and result.')
+            for (direction, result), count in sorted(self.transfers.items()):
+                lines.append('jmftp_transfers_total{%s} %s' % (
+                    format_labels([('direction', direction), ('result', result)]), count))
+            metric('jmftp_transfer_bytes_total', 'counter', 'File bytes moved over data connections.')
+            for direction, size in sorted(self.transfer_bytes.items()):
+                lines.append('jmftp_transfer_bytes_total{%s} %s' % (
+                    format_labels([('direction', direction)]), size))
+            metric('jmftp_transfer_throughput_bytes_per_second', 'histogram', 'Throughput of completed transfers.')
+            for direction, histogram in sorted(self.throughput.items()):
+                lines.extend(histogram.render(
+                    'jmftp_transfer_throughput_bytes_per_second', [('direction', direction)]))
+        metric('jmftp_file_cache_files', 'gauge', 'Files held open or in memory by the download file cache.')
+        lines.append('jmftp_file_cache_files %s' % file_cache['files'])
+        metric('jmftp_file_cache_memory_bytes', 'gauge', 'Bytes of small files held in memory.')
+        lines.append('jmftp_file_cache_memory_bytes %s' % file_cache['memory'])
+        for name in ('hits', 'misses', 'evictions'):
+            metric('jmftp_file_cache_%s_total' % name, 'counter', 'Download file cache %s.' % name)
+            lines.append('jmftp_file_cache_%s_total %s' % (name, file_cache[name]))
+        for key, name, kind, help_text in STORAGE_METRICS:
+            values = [(backend, stats[key]) for backend, stats in sorted(storage_stats.items()) if key in stats]
+            if values:
+                metric(name, kind, help_text)
+            for backend, value in values:
+                lines.append('%s{%s} %s' % (name, format_labels([('backend', backend)]), value))
+        return '\n'.join(lines) + '\n'
+
+
+class MergedMetrics(Metrics):
+    '''
+    多个工作进程的指标之和，由各进程export()的结果相加
+    已经退出的进程的计数由RetiredMetrics累计后一起传入，保证进程重启后累计值不会变小
+    '''
+
+    def __init__(self, started, states):
+        super().__init__(None)
+        self.started = started
+        self.current = [0, 0, 0]
+        self.file_cache = dict.fromkeys(('files', 'memory', 'hits', 'misses', 'evictions'), 0)
+        self.storage = {}
+        for state in states:
+            self.merge(state)
+            self.current = [a + b for a, b in zip(self.current, state['gauges'])]
+            for key, value in state['file_cache'].items():
+                self.file_cache[key] = self.file_cache.get(key, 0) + value
+            for backend, stats in state['storage'].items():
+                totals = self.storage.setdefault(backend, {})
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+
+    def gauges(self):
+        return tuple(self.current) + (self.file_cache, self.storage)
+
+
+class RetiredMetrics(Metrics):
+    '''已经退出的工作进程的计数之和，当前值都为0'''
+
+    def __init__(self):
+        super().__init__(None)
+
+    def gauges(self):
+        return 0, 0, 0, {}, {}
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    '''/metrics返回Prometheus文本格式，/stats返回JSON，/state返回供监督进程合并的原始计数'''
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == '/metrics':
+            body = metrics.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/stats':
+            body = json.dumps(metrics.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        elif self.path == '/state':
+            body = json.dumps(metrics.export()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''不输出每次抓取的访问记录'''
+
+
+class MetricsServer(object):
+    '''在后台线程中运行的指标HTTP服务'''
+
+    def __init__(self, metrics, host, port):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='ftp_metrics', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
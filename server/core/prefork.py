@@ -0,0 +1,519 @@
+import importlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.managers
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib.request
+from conf import settings
+from core import accounts
+from core import logger
+from core import main
+from core import metrics
+from core import quota
+from core import sessionlimit
+from core import storage
+
+# 重新加载时等待新的工作进程就绪的最长秒数，超时后仍然停止旧的工作进程
+READY_TIMEOUT = 30
+# 工作进程运行超过这么多秒后退出不算连续的启动失败，重启等待时间恢复为WORKER_RESTART_DELAY
+STABLE_SECONDS = 10
+# 连续启动失败时重启等待时间的上限
+MAX_RESTART_DELAY = 60
+
+
+def worker_count():
+    '''默认的工作进程数：本进程可以使用的CPU核数'''
+    if settings.WORKER_PROCESSES:
+        return settings.WORKER_PROCESSES
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def make_listener(reuseport):
+    '''创建绑定到HOST:PORT的socket，还没有开始监听'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((settings.HOST, settings.PORT))
+    return sock
+
+
+class SharedService(multiprocessing.managers.BaseManager):
+    '''
+    监督进程中所有工作进程共享的对象：用量计数器和会话计数
+    工作进程连接后取得QuotaManager和SessionCounter的代理，各线程的调用分别转发
+    '''
+
+
+SharedService.register('quota')
+SharedService.register('sessions')
+
+
+class Worker(object):
+    '''
+    在监督进程中创建、随进程启动传给工作进程的参数
+    sock为共用的监听socket，使用SO_REUSEPORT时为None，由工作进程自己监听；
+    conn为只写的管道，工作进程就绪时发送指标端口，退出前发送最后的指标
+    '''
+
+    def __init__(self, index, count, generation, token_secret, sock, log_queue, shared_address, authkey, quota, conn):
+        self.index = index
+        self.count = count
+        self.generation = generation
+        self.token_secret = token_secret
+        self.sock = sock
+        self.log_queue = log_queue
+        self.shared_address = shared_address
+        self.authkey = authkey
+        # 监督进程是否开启了配额
+        self.quota = quota
+        self.conn = conn
+
+    def passive_ports(self, min_port, max_port):
+        '''把被动端口范围平分给各工作进程，不够分时共用整个范围，被占用的端口由PortAllocator跳过'''
+        size = (max_port - min_port + 1) // self.count
+        if size < 1:
+            return min_port, max_port
+        start = min_port + self.index * size
+        if self.index == self.count - 1:
+            return start, max_port
+        return start, start + size - 1
+
+    def listen(self):
+        '''返回开始监听的socket'''
+        if self.sock is not None:
+            return self.sock
+        sock = make_listener(True)
+        sock.listen(settings.MAX_SOCKET_LISTEN)
+        return sock
+
+    def connect_quota(self):
+        '''返回监督进程中用量计数器的代理，监督进程没有开启配额时返回None'''
+        if not self.quota:
+            return None
+        return self.connect().quota()
+
+    def connect_sessions(self):
+        '''返回监督进程中会话计数的代理'''
+        return self.connect().sessions()
+
+    def connect(self):
+        service = SharedService(self.shared_address, self.authkey)
+        service.connect()
+        return service
+
+    def send(self, *message):
+        self.conn.send(message)
+
+
+def run_worker(worker, management_instance):
+    '''工作进程的入口'''
+    # Ctrl+C和终端断开由监督进程处理，工作进程只响应监督进程发来的SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # 日志放进监督进程的队列，由监督进程写入文件
+    logger.setup(worker.log_queue, listen=False)
+    try:
+        server = main.FTPserver(management_instance, worker)
+    except OSError as e:
+        logger.get_logger('ftp_server').error('工作进程%s启动失败：%s' % (worker.index, e))
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    worker.send('ready', server.metrics_server.httpd.server_address[1])
+    server.run_forever()
+    worker.send('exit', server.metrics.export())
+
+
+class WorkerProcess(object):
+    '''监督进程中记录的一个工作进程'''
+
+    def __init__(self, index, generation, process, conn):
+        self.index = index
+        self.generation = generation
+        self.process = process
+        self.conn = conn
+        self.started = time.monotonic()
+        # starting -> running -> stopping
+        self.state = 'starting'
+        # 工作进程的本机指标端口，就绪后才知道
+        self.metrics_port = None
+        # 最近一次读到的指标和退出前发来的指标，退出后计入已退出进程的累计值
+        self.last_state = None
+        self.final_state = None
+
+    def receive(self):
+        '''读取管道中的所有消息，工作进程已退出时关闭管道'''
+        try:
+            while self.conn is not None and self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == 'ready':
+                    self.metrics_port = message[1]
+                    if self.state == 'starting':
+                        self.state = 'running'
+                elif message[0] == 'exit':
+                    self.final_state = message[1]
+        except (EOFError, OSError):
+            self.conn.close()
+            self.conn = None
+
+    def terminate(self):
+        '''通知工作进程停止接收新连接，等待已有的会话结束后退出'''
+        if self.state != 'stopping':
+            self.state = 'stopping'
+            self.process.terminate()
+
+
+class ClusterMetrics(object):
+    '''监督进程对外提供的指标：各工作进程的指标之和，另外给出每个工作进程的状态'''
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.started = time.time()
+
+    def collect(self):
+        '''从各工作进程的本机指标端口读取原始计数，返回(合并后的指标, 每个工作进程的状态)'''
+        supervisor = self.supervisor
+        # 持有锁读取，读取期间退出的工作进程不会同时计入已退出进程的累计值，累计值不会忽大忽小
+        with supervisor.lock:
+            states = [supervisor.retired.export()]
+            workers = []
+            for record in supervisor.processes:
+                if record.metrics_port:
+                    url = 'http://127.0.0.1:%s/state' % record.metrics_port
+                    try:
+                        with urllib.request.urlopen(url, timeout=1) as response:
+                            record.last_state = json.loads(response.read().decode('utf-8'))
+                    except (OSError, ValueError):
+                        # 读取失败时使用上一次的结果
+                        pass
+                state = record.last_state
+                if state is not None:
+                    states.append(state)
+                workers.append({
+                    'worker': record.index,
+                    'generation': record.generation,
+                    'pid': record.process.pid,
+                    'state': record.state,
+                    'restarts': supervisor.restarts[record.index],
+                    'uptime': state['uptime'] if state else 0,
+                    'sessions_active': state['gauges'][0] if state else 0,
+                    'sessions_total': state['sessions_total'] if state else 0,
+                    'transfers_active': state['gauges'][1] if state else 0,
+                })
+        return metrics.MergedMetrics(self.started, states), workers
+
+    def export(self):
+        return self.collect()[0].export()
+
+    def snapshot(self):
+        merged, workers = self.collect()
+        snapshot = merged.snapshot()
+        snapshot['workers'] = workers
+        return snapshot
+
+    def render(self):
+        merged, workers = self.collect()
+        lines = [merged.render().rstrip('\n')]
+        for name, kind, help_text, key in (
+                ('jmftp_worker_up', 'gauge', 'Worker processes that are accepting connections.', None),
+                ('jmftp_worker_sessions_active', 'gauge', 'Open control connections, by worker.', 'sessions_active'),
+                ('jmftp_worker_sessions_total', 'counter', 'Control connections accepted, by worker.',
+                 'sessions_total'),
+                ('jmftp_worker_restarts_total', 'counter', 'Times the worker slot was restarted.', 'restarts')):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for worker in workers:
+                value = int(worker['state'] == 'running') if key is None else worker[key]
+                lines.append('%s{%s} %s' % (name, metrics.format_labels(
+                    [('worker', worker['worker']), ('generation', worker['generation'])]), value))
+        return '\n'.join(lines) + '\n'
+
+
+class Supervisor(object):
+    '''
+    多进程模式的监督进程，每个工作进程都是一个完整的FTPserver，JSON编解码、哈希和压缩不再受同一个GIL限制
+    1. 监听：支持SO_REUSEPORT时每个工作进程各自监听PORT，由内核按连接分配；否则共用这里创建的监听socket
+    2. 工作进程异常退出后自动重启，连续很快退出时重启等待时间加倍
+    3. SIGHUP：重新加载settings，启动新一代工作进程，就绪后让旧的工作进程停止接收连接，处理完已有的会话后退出
+    4. SIGTERM/Ctrl+C：所有工作进程停止接收连接，等待进行中的指令和传输结束（最多DRAIN_TIMEOUT秒）；再次收到时立即结束
+    5. 日志：工作进程的日志经过进程间队列由这里统一写入
+    6. 指标：METRICS_PORT由这里监听，合并各工作进程的指标，并给出每个工作进程的状态
+    7. 配额：用量计数器在这里，工作进程通过代理调用，所有进程看到同一份用量
+    工作进程用spawn方式启动，重新加载时新的工作进程会重新导入代码和配置
+    '''
+
+    def __init__(self, management_instance, count=None):
+        self.management_instance = management_instance
+        # 命令行指定了进程数时重新加载不改变进程数
+        self.fixed_count = count
+        self.count = count or worker_count()
+        self.context = multiprocessing.get_context('spawn')
+        multiprocessing.current_process().name = 'supervisor'
+        # 日志改为经过进程间队列写入，工作进程的日志也由这里的后台线程写入
+        logger.stop()
+        self.log_queue = self.context.Queue()
+        logger.setup(self.log_queue)
+        self.logger = logger.get_logger('ftp_server')
+        # 所有工作进程共用的令牌密钥，一个连接签发的令牌可以在另一个工作进程上使用
+        self.token_secret = settings.TOKEN_SECRET or os.urandom(32).hex()
+        self.reuseport = settings.REUSEPORT and hasattr(socket, 'SO_REUSEPORT')
+        # 每个工作进程各有一份内存存储，上传的文件只有接受了该连接的进程能看到
+        if settings.STORAGE_BACKEND == 'memory':
+            self.logger.error('内存存储的内容在每个工作进程中各不相同，多进程模式下不能使用')
+            logger.stop()
+            exit('多进程模式下不能使用内存存储，请改用local或tiered，或者关闭PREFORK')
+        # 使用SO_REUSEPORT时这里只绑定不监听，占住端口并尽早发现端口被占用
+        try:
+            self.sock = make_listener(self.reuseport)
+        except OSError as e:
+            self.logger.error('FTP服务器绑定端口%s失败：%s' % (settings.PORT, e))
+            logger.stop()
+            exit('FTP服务器绑定端口%s失败' % settings.PORT)
+        if not self.reuseport:
+            self.sock.listen(settings.MAX_SOCKET_LISTEN)
+        self.lock = threading.Lock()
+        self.processes = []
+        self.generation = 1
+        # 每个编号的工作进程重启的次数、连续启动失败的次数和计划重启的时间
+        self.restarts = {}
+        self.failures = {}
+        self.pending = {}
+        self.reload_started = None
+        self.stopping = False
+        self.stop_deadline = None
+        self.signals = []
+        # 已经退出的工作进程的计数之和
+        self.retired = metrics.RetiredMetrics()
+        self.quota = None
+        if settings.QUOTA:
+            self.start_quota()
+        # 所有工作进程共用的会话计数，同时连接数的限制对整个服务器生效
+        self.sessions = sessionlimit.SessionCounter()
+        self.start_shared()
+        self.metrics_server = None
+        if settings.METRICS_PORT:
+            try:
+                self.metrics_server = metrics.MetricsServer(
+                    ClusterMetrics(self), settings.METRICS_HOST, settings.METRICS_PORT)
+                self.logger.info('指标服务绑定端口%s成功' % settings.METRICS_PORT)
+            except OSError as e:
+                self.logger.error('指标服务绑定端口%s失败：%s' % (settings.METRICS_PORT, e))
+
+    def start_quota(self):
+        '''创建共享的用量计数器'''
+        self.accounts = accounts.AccountStore(settings.ACCOUNT_FILE, self.logger)
+        self.storages = {}
+        self.storages_lock = threading.Lock()
+        self.quota = quota.QuotaManager(
+            settings.QUOTA_DB or os.path.join(settings.USER_HOME_BASE_DIR, '.jmftp-quota.db'),
+            self.scan_usage, self.logger, settings.QUOTA_FLUSH_INTERVAL, settings.QUOTA_RECONCILE_INTERVAL)
+
+    def start_shared(self):
+        '''在后台线程中运行共享对象的服务'''
+        self.authkey = os.urandom(32)
+        service = SharedService(authkey=self.authkey)
+        service.register('quota', callable=lambda: self.quota)
+        service.register('sessions', callable=lambda: self.sessions)
+        self.shared_server = service.get_server()
+        self.shared_address = self.shared_server.address
+        threading.Thread(target=self.shared_server.serve_forever, name='shared_service', daemon=True).start()
+
+    def scan_usage(self, username):
+        '''遍历用户目录统计用量，与FTPserver.scan_usage相同，正在上传的文件由计数器自己记录'''
+        user = self.accounts.get(username)
+        if user is None:
+            return 0, 0
+        name = user.get('storage', settings.STORAGE_BACKEND)
+        with self.storages_lock:
+            if name not in self.storages:
+                if name not in storage.BACKENDS:
+                    raise ValueError('未知的存储后端%s' % name)
+                # 分层存储的降级由第一个工作进程运行
+                self.storages[name] = storage.BACKENDS[name](self.logger, False)
+            backend = self.storages[name]
+        home = os.path.join(settings.USER_HOME_BASE_DIR, username)
+        return quota.scan_home(backend, home, self.quota.active_uploads(), main.FTPserver.is_reserved)
+
+    def spawn(self, index):
+        '''启动编号为index的工作进程'''
+        reader, writer = self.context.Pipe(duplex=False)
+        worker = Worker(index, self.count, self.generation, self.token_secret,
+                        None if self.reuseport else self.sock, self.log_queue,
+                        self.shared_address, self.authkey, self.quota is not None, writer)
+        process = self.context.Process(
+            target=run_worker, args=(worker, self.management_instance), name='worker-%s' % index)
+        process.start()
+        # 关闭这一端的写入端，工作进程退出后读取端收到EOF
+        writer.close()
+        self.restarts.setdefault(index, 0)
+        with self.lock:
+            self.processes.append(WorkerProcess(index, self.generation, process, reader))
+        self.logger.info('启动工作进程%s（pid %s，第%s代）' % (index, process.pid, self.generation))
+
+    def run(self):
+        '''启动所有工作进程，处理信号并照看工作进程，直到全部停止'''
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        signal.set_wakeup_fd(wakeup_writer.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.on_signal)
+        for index in range(self.count):
+            self.spawn(index)
+        print('FTP服务器在端口%s上启动成功（多进程模式，%s个%s工作进程，%s），等待客户端连接...' % (
+            settings.PORT, self.count, settings.SERVER_MODE, 'SO_REUSEPORT' if self.reuseport else '共用监听socket'))
+        self.logger.info('FTP服务器以多进程模式运行，%s个工作进程' % self.count)
+        try:
+            while self.processes or not self.stopping:
+                self.handle_signals()
+                self.reap()
+                self.restart_due()
+                self.retire_old()
+                if self.stopping and self.stop_deadline and time.monotonic() > self.stop_deadline:
+                    self.kill_all()
+                waitables = [wakeup_reader]
+                for record in self.processes:
+                    waitables.append(record.process.sentinel)
+                    if record.conn is not None:
+                        waitables.append(record.conn)
+                multiprocessing.connection.wait(waitables, timeout=1)
+                try:
+                    while wakeup_reader.recv(64):
+                        pass
+                except BlockingIOError:
+                    pass
+        finally:
+            signal.set_wakeup_fd(-1)
+            wakeup_reader.close()
+            wakeup_writer.close()
+            self.shutdown()
+        print('FTP服务器已停止')
+
+    def on_signal(self, signum, frame):
+        '''信号处理函数只记录信号，由主循环处理'''
+        self.signals.append(signum)
+
+    def handle_signals(self):
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum == signal.SIGHUP:
+                if not self.stopping:
+                    self.reload()
+            elif self.stopping:
+                # 再次收到停止信号时不再等待
+                self.kill_all()
+            else:
+                self.stop()
+
+    def stop(self):
+        '''所有工作进程停止接收连接，等待已有的会话结束'''
+        self.logger.info('FTP服务器正在停止，等待进行中的指令和传输结束')
+        print('FTP服务器正在停止，等待进行中的指令和传输结束（再次按Ctrl+C立即退出）...')
+        self.stopping = True
+        self.stop_deadline = time.monotonic() + settings.DRAIN_TIMEOUT + READY_TIMEOUT
+        self.pending.clear()
+        for record in self.processes:
+            record.terminate()
+
+    def kill_all(self):
+        for record in self.processes:
+            if record.process.is_alive():
+                record.process.kill()
+
+    def reload(self):
+        '''重新加载settings，启动新一代工作进程，新进程就绪后再停止旧进程'''
+        try:
+            importlib.reload(settings)
+        except Exception as e:
+            self.logger.error('重新加载配置失败，继续使用原来的工作进程：%s' % e)
+            return
+        if not self.reuseport and self.sock.getsockname()[1] != settings.PORT:
+            self.logger.error('共用监听socket时修改PORT需要重新启动服务器，仍然监听端口%s' % self.sock.getsockname()[1])
+        self.count = self.fixed_count or worker_count()
+        self.generation += 1
+        self.reload_started = time.monotonic()
+        self.pending.clear()
+        self.logger.info('重新加载配置，启动第%s代的%s个工作进程' % (self.generation, self.count))
+        for index in range(self.count):
+            self.spawn(index)
+
+    def retire_old(self):
+        '''新一代的工作进程都就绪（或等待超时）后，让旧的工作进程停止'''
+        if self.reload_started is None:
+            return
+        current = [record for record in self.processes if record.generation == self.generation]
+        ready = all(record.state == 'running' for record in current)
+        if not ready and time.monotonic() - self.reload_started < READY_TIMEOUT:
+            return
+        self.reload_started = None
+        for record in self.processes:
+            if record.generation < self.generation:
+                record.terminate()
+
+    def reap(self):
+        '''处理工作进程发来的消息和已经退出的工作进程'''
+        for record in list(self.processes):
+            record.receive()
+            if record.process.is_alive():
+                continue
+            record.process.join()
+            record.receive()
+            with self.lock:
+                self.processes.remove(record)
+                state = record.final_state or record.last_state
+                if state is not None:
+                    self.retired.merge(state)
+            if record.conn is not None:
+                record.conn.close()
+            # 异常退出的工作进程没有结算的预留由计数器释放，并重新统计受影响的用户
+            if self.quota:
+                self.quota.abandon(record.process.pid)
+            self.sessions.abandon(record.process.pid)
+            if record.state == 'stopping':
+                self.logger.info('工作进程%s（pid %s）已退出' % (record.index, record.process.pid))
+                continue
+            self.logger.error('工作进程%s（pid %s）异常退出，退出码%s' % (
+                record.index, record.process.pid, record.process.exitcode))
+            if self.stopping or record.generation < self.generation or record.index >= self.count:
+                continue
+            if time.monotonic() - record.started < STABLE_SECONDS:
+                self.failures[record.index] = self.failures.get(record.index, 0) + 1
+            else:
+                self.failures[record.index] = 0
+            delay = min(settings.WORKER_RESTART_DELAY * 2 ** max(self.failures[record.index] - 1, 0),
+                        MAX_RESTART_DELAY)
+            self.pending[record.index] = time.monotonic() + delay
+
+    def restart_due(self):
+        '''重启到时间的工作进程'''
+        now = time.monotonic()
+        for index, due in list(self.pending.items()):
+            if due <= now:
+                del self.pending[index]
+                self.restarts[index] += 1
+                self.spawn(index)
+
+    def shutdown(self):
+        '''所有工作进程退出后关闭监听端口、指标服务和用量计数器'''
+        self.kill_all()
+        for record in self.processes:
+            record.process.join()
+        self.sock.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.shared_server.stop_event.set()
+        if self.quota is not None:
+            self.quota.close()
+            with self.storages_lock:
+                for backend in self.storages.values():
+                    backend.close()
+        self.logger.info('FTP服务器已关闭')
+        logger.stop()
@@ -0,0 +1,246 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+
+def scan_home(backend, home, uploads, is_reserved):
+    '''
+    遍历用户目录，返回(已用字节数, 文件数)，目录也计为一个文件，is_reserved(文件名)为真的文件不计入
+    uploads为QuotaManager.active_uploads()，正在上传的文件按上传开始前的大小计算，收到的数据在上传结束时结算
+    '''
+    size = files = 0
+    try:
+        for root, dirs, names in backend.walk(home):
+            files += len(dirs)
+            for name in names:
+                path = os.path.normpath(os.path.join(root, name))
+                if is_reserved(name):
+                    continue
+                if path in uploads:
+                    if uploads[path] is not None:
+                        size += uploads[path]
+                        files += 1
+                    continue
+                try:
+                    size += backend.getsize(path)
+                except OSError:
+                    # 扫描过程中被删除的文件
+                    continue
+                files += 1
+    except FileNotFoundError:
+        pass
+    return size, files
+
+
+class QuotaManager(object):
+    '''
+    用户空间用量的计数器与配额检查
+    1. 每个用户的已用字节数和文件数（目录也计为一个文件）保存在内存中，_put、_rm和_mkdir按变化量增减，
+       检查配额是O(1)的，不需要遍历用户目录
+    2. 有变化的计数器每隔flush_interval秒写入SQLite，关闭时全部写入，重启后继续使用
+    3. 上传在put指令时按file_size预留用量，超出配额时在写入任何数据之前拒绝；传输结束后释放预留，按实际变化结算
+    4. 后台线程在启动时和之后每隔reconcile_interval秒用scan(username)重新统计每个用户，
+       纠正外部修改和崩溃时没有写入的计数；扫描期间发生的变化叠加到扫描结果上，与扫描同时发生的误差在下次扫描时纠正
+    没有计数记录的用户在第一次使用时扫描一次
+    5. 多进程模式下由监督进程持有唯一的实例，工作进程通过代理调用；预留记录中的owner为工作进程号，
+       进程异常退出后用abandon释放它的预留，并重新统计受影响的用户
+    '''
+
+    def __init__(self, path, scan, logger, flush_interval=5, reconcile_interval=3600):
+        self.scan = scan
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        # 用户名 -> [字节数, 文件数]
+        self.counters = {}
+        # 进行中的上传预留的用量
+        self.reserved = {}
+        # 预留编号 -> 进行中的上传，扫描时据此识别正在上传的文件
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        # 等待后台线程重新统计的用户
+        self.stale = set()
+        # 正在扫描的用户在扫描期间的变化量
+        self.scanning = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        # 所有线程共用一个连接，由锁保证同一时间只有一个线程访问
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS usage ('
+                'username TEXT PRIMARY KEY, bytes INTEGER, files INTEGER, reconciled REAL)')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.maintain, name='quota', daemon=True)
+        self.thread.start()
+
+    def usage(self, username):
+        '''返回用户的[已用字节数, 文件数]'''
+        with self.lock:
+            if username in self.counters:
+                return list(self.counters[username])
+            row = self.conn.execute('SELECT bytes, files FROM usage WHERE username=?', (username,)).fetchone()
+            if row is not None:
+                self.counters[username] = list(row)
+                return list(row)
+        return self.reconcile(username)
+
+    def allowed(self, username, limits, size, files):
+        '''再使用size字节和files个文件后是否仍在配额之内，limits为(字节数配额, 文件数配额)，0表示不限制'''
+        self.usage(username)
+        with self.lock:
+            return self._allowed(username, limits, size, files)
+
+    def reserve(self, username, limits, size, files, path=None, part_size=None, owner=None):
+        '''
+        为进行中的上传预留用量，超出配额时返回None，否则返回用于settle的预留记录
+        path为正在写入的文件，part_size为它在上传开始前的大小（之前不存在时为None）
+        '''
+        self.usage(username)
+        with self.lock:
+            if not self._allowed(username, limits, size, files):
+                return None
+            held = self.reserved.setdefault(username, [0, 0])
+            held[0] += size
+            held[1] += files
+            upload_id = next(self.upload_ids)
+            self.uploads[upload_id] = {
+                'username': username, 'size': size, 'files': files, 'owner': owner,
+                'paths': [os.path.normpath(path)] if path else [], 'part_size': part_size,
+            }
+        return upload_id, username, size, files
+
+    def moved(self, reservation, path):
+        '''上传的文件将被改名为path，在改名之前调用，结算之前扫描到的path也按上传开始前的大小计算'''
+        with self.lock:
+            upload = self.uploads.get(reservation[0])
+            if upload is not None:
+                upload['paths'].append(os.path.normpath(path))
+
+    def settle(self, reservation, size=0, files=0):
+        '''释放预留，并把实际的变化计入用量'''
+        with self.lock:
+            if self.uploads.pop(reservation[0], None) is None:
+                # 进程异常退出后已经由abandon释放
+                return
+            self._release(*reservation[1:])
+        self.add(reservation[1], size, files)
+
+    def abandon(self, owner):
+        '''释放异常退出的进程持有的所有预留，受影响的用户由后台线程重新统计'''
+        with self.lock:
+            for upload_id, upload in list(self.uploads.items()):
+                if upload['owner'] == owner:
+                    del self.uploads[upload_id]
+                    self._release(upload['username'], upload['size'], upload['files'])
+                    self.stale.add(upload['username'])
+
+    def active_uploads(self):
+        '''返回还没有结算用量的上传文件 -> 上传开始前的大小（之前不存在时为None）'''
+        with self.lock:
+            return dict((path, upload['part_size']) for upload in self.uploads.values()
+                        for path in upload['paths'])
+
+    def add(self, username, size, files):
+        '''用户的用量增加size字节和files个文件，可以为负数'''
+        if not size and not files:
+            return
+        self.usage(username)
+        with self.lock:
+            counter = self.counters[username]
+            counter[0] = max(counter[0] + size, 0)
+            counter[1] = max(counter[1] + files, 0)
+            if username in self.scanning:
+                self.scanning[username][0] += size
+                self.scanning[username][1] += files
+            self.dirty.add(username)
+
+    def reconcile(self, username):
+        '''重新扫描用户的目录，返回纠正后的[已用字节数, 文件数]'''
+        with self.lock:
+            self.scanning[username] = [0, 0]
+        try:
+            size, files = self.scan(username)
+        finally:
+            with self.lock:
+                delta = self.scanning.pop(username)
+        with self.lock:
+            old = self.counters.get(username)
+            counter = [max(size + delta[0], 0), max(files + delta[1], 0)]
+            self.counters[username] = counter
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?)',
+                                  (username, counter[0], counter[1], time.time()))
+            self.dirty.discard(username)
+        if old is not None and old != counter:
+            self.logger.info('%s: %s' % (username, '用量计数从%s字节/%s个文件纠正为%s字节/%s个文件' % (
+                old[0], old[1], counter[0], counter[1])))
+        return list(counter)
+
+    def reconcile_all(self):
+        '''重新扫描所有有计数记录的用户'''
+        with self.lock:
+            usernames = set(self.counters)
+            usernames.update(row[0] for row in self.conn.execute('SELECT username FROM usage'))
+        self.reconcile_users(usernames)
+
+    def reconcile_users(self, usernames):
+        '''逐个重新扫描用户，失败时记录日志后继续'''
+        for username in sorted(usernames):
+            if self.stopped.is_set():
+                return
+            try:
+                self.reconcile(username)
+            except (OSError, ValueError) as e:
+                self.logger.error('%s: %s' % (username, '统计用量失败：%s' % e))
+
+    def flush(self):
+        '''把有变化的计数器写入数据库'''
+        with self.lock:
+            rows = [(self.counters[username][0], self.counters[username][1], username)
+                    for username in self.dirty]
+            self.dirty.clear()
+            if rows:
+                with self.conn:
+                    self.conn.executemany('UPDATE usage SET bytes=?, files=? WHERE username=?', rows)
+
+    def maintain(self):
+        '''后台线程：定期写入计数器，启动时和之后每隔reconcile_interval秒重新统计，abandon影响的用户尽快重新统计'''
+        next_reconcile = time.monotonic() if self.reconcile_interval else None
+        while not self.stopped.is_set():
+            if next_reconcile is not None and time.monotonic() >= next_reconcile:
+                self.reconcile_all()
+                next_reconcile = time.monotonic() + self.reconcile_interval
+            with self.lock:
+                stale, self.stale = self.stale, set()
+            self.reconcile_users(stale)
+            self.stopped.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+    def _release(self, username, size, files):
+        '''调用方需持有self.lock'''
+        held = self.reserved[username]
+        held[0] -= size
+        held[1] -= files
+        if held == [0, 0]:
+            del self.reserved[username]
+
+    def _allowed(self, username, limits, size, files):
+        '''调用方需持有self.lock'''
+        max_size, max_files = limits
+        counter = self.counters[username]
+        held = self.reserved.get(username, (0, 0))
+        if max_size and counter[0] + held[0] + size > max_size:
+            return False
+        if max_files and counter[1] + held[1] + files > max_files:
+            return False
+        return True
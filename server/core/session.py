@@ -0,0 +1,1147 @@
+import hashlib
+import logging
+import os
+import re
+import socket
+import stat
+import tarfile
+import threading
+import time
+from conf import settings
+from common import checksum
+from common import compression
+from common import protocol
+from core import datachannel
+from core import listing
+from core import logger
+from core import throttle
+from core import timeouts
+from core import transfer as transfer_module
+
+
+def is_count(value):
+    '''客户端发来的偏移量或长度是否为非负整数'''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+class FTPsession():
+    '''一个客户端连接对应一个会话对象，保存该连接的所有状态并处理其指令'''
+
+    # 状态码
+    STATUS_CODE = {
+        100: 'Control Socket Build success',
+        200: 'Passed authentication!',
+        201: 'Wrong username or password!',
+        202: 'Too many sessions!',
+        300: 'File or dir not found!',
+        301: 'File already exists, and this msg includes the file size!',
+        302: 'Data channel ready for upload!',
+        303: 'File stat success!',
+        304: 'Transfer status!',
+        305: 'Transfer aborted!',
+        306: 'Transfer not found!',
+        307: 'No data port available!',
+        308: 'Transfer complete!',
+        309: 'Transfer incomplete!',
+        310: 'Checksum success!',
+        311: 'Upload status!',
+        312: 'Bundle ready!',
+        350: 'Dir changed successfully!',
+        351: 'Dir not found!',
+        352: 'Permission denied!',
+        353: 'Quota exceeded!',
+        400: 'List dir success!',
+        401: 'List dir failed!',
+        402: 'List dir page!',
+        500: 'Create dir success!',
+        501: 'Dir is already exist!',
+        502: 'Dirname is illegal!',
+        600: 'Delete file success!',
+        601: 'Delete dir success!',
+    }
+    # 表示指令失败的状态码，计入错误数
+    ERROR_CODES = frozenset([201, 202, 300, 306, 307, 309, 351, 352, 353, 401, 501, 502])
+    # 写入访问日志的参数，只有标量，块摘要列表、批量下载的路径列表、密码和令牌等都不记录
+    ACCESS_LOG_FIELDS = ('filename', 'abs_filename', 'local_file', 'dirname', 'target_dir', 'pattern',
+                         'file_size', 'offset', 'length', 'recieved_size', 'transfer_id')
+    # 访问日志中字符串参数的最大长度
+    ACCESS_LOG_VALUE_LENGTH = 256
+    def __init__(self, server, request, addr):
+        # 所属的FTP服务器，用户信息、日志等共享资源都放在服务器对象上
+        self.server = server
+        self.logger = server.logger
+        # 连接对象与客户端地址
+        self.request = request
+        self.addr = addr
+        # 按帧收发控制消息，登录之前只接受很短的JSON消息
+        self.stream = protocol.MessageStream(request, protocol.MAX_AUTH_MESSAGE_SIZE, protocol.AUTH_CODECS)
+        # 工作线程中统一使用阻塞模式收发
+        self.request.setblocking(True)
+        timeouts.set_keepalive(request)
+        # 用户对象
+        self.user_obj = None
+        # 当前目录
+        self.current_dir = None
+        # 用户文件的存储后端，登录后按用户配置选择
+        self.storage = None
+        # 进行中的数据传输
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+        # 本会话的限速令牌桶，登录后按用户配置创建
+        self.bucket = None
+        # 当前指令的响应状态码，用于访问日志
+        self.status_code = None
+        # 是否正在处理指令，停止服务和检查超时时只断开空闲的会话
+        self.busy = False
+        # 建立连接和最近一次收到指令或传输结束的time.monotonic()，用于检查超时
+        self.connected = self.last_activity = time.monotonic()
+        # 计入同时连接数的地址和计入同时登录数的用户名，由服务器维护，没有限制时不计数
+        self.counted_address = None
+        self.counted_user = None
+        # 超时或停止服务时断开连接的原因
+        self.expired = None
+        self.closed = False
+
+    def run(self):
+        '''在当前线程中处理该连接，直到连接断开'''
+        self.logger.debug('等待%s:%s的用户认证' % self.addr)
+        try:
+            while self.handle_once():
+                pass
+        except Exception as e:
+            self.logger.error('处理请求出错，错误信息：%s' % e)
+            self.close()
+
+    def handle_once(self):
+        '''接收并处理一条指令，连接断开时返回False'''
+        # 接收用户发来的控制信息
+        data = self.stream.recv_message()
+        # 处理连接关闭的情况
+        if data is None:
+            # 日志记录，超时断开的连接已经记录过原因
+            if not self.expired:
+                self.logger.info('到%s:%s的连接已被客户端中断' % self.addr)
+            self.close()
+            return False
+        started = time.perf_counter()
+        self.busy = True
+        self.last_activity = time.monotonic()
+        # 只有开启DEBUG级别时才格式化指令内容，密码和令牌不写入日志
+        if self.logger.isEnabledFor(logging.DEBUG):
+            args = dict((key, value) for key, value in data.items()
+                        if key not in ('action_type', 'password', 'token'))
+            self.logger.debug('收到%s:%s的指令：%s %s' % (self.addr + (data.get('action_type'), args)))
+        # 对控制信息进行解析
+        action_type = data.get('action_type')
+        func = getattr(self, '_%s' % action_type, None) if isinstance(action_type, str) else None
+        self.status_code = None
+        error = True
+        try:
+            if func is not None:
+                func(data)
+            elif not action_type:
+                self.logger.error('控制信息格式错误')
+            # 没有响应（未知指令）或响应失败状态码的指令计为错误
+            error = self.status_code is None or self.status_code in self.ERROR_CODES
+        finally:
+            self.last_activity = time.monotonic()
+            self.busy = False
+            # 指标只按存在的指令分类，其他指令都记为unknown，客户端不能随意增加指标的序列
+            self.server.metrics.observe_command(
+                action_type if func is not None else 'unknown', self.status_code,
+                time.perf_counter() - started, error)
+        # 访问日志：每条指令一行JSON，记录用户、指令、状态码和处理耗时
+        user_obj = self.user_obj
+        args = {}
+        for key in self.ACCESS_LOG_FIELDS:
+            value = self.access_value(data.get(key))
+            if value is not None:
+                args[key] = value
+        logger.access(user_obj['name'] if user_obj else self.access_value(data.get('username')),
+                      self.addr, self.access_value(action_type), self.status_code, started, args=args)
+        return True
+
+    @classmethod
+    def access_value(cls, value):
+        '''客户端发来的参数转换为访问日志中的值：数字原样记录，字符串截断，其他类型不记录'''
+        if isinstance(value, (int, float)):
+            return value
+        if isinstance(value, str):
+            return value[:cls.ACCESS_LOG_VALUE_LENGTH]
+        return None
+
+    def has_pending(self):
+        '''是否还有已经收到但尚未处理的流水线指令'''
+        return self.stream.has_buffered()
+
+    def idle(self):
+        '''没有正在处理或等待处理的指令，也没有进行中的传输'''
+        with self.transfers_lock:
+            transferring = bool(self.transfers)
+        return not (self.busy or transferring or self.has_pending())
+
+    def check_timeouts(self, now):
+        '''
+        由服务器的Reaper在检查时刻调用，返回下一次检查的time.monotonic()，会话已经断开或不再需要检查时返回None
+        1. 中止超过TRANSFER_STALL_TIMEOUT秒没有进展的传输，还在等待数据连接的传输由DATA_ACCEPT_TIMEOUT限制，
+           已经连接但客户端还没有开始发送的上传（批量上传中排队的文件）不检查
+        2. 超过HANDSHAKE_TIMEOUT秒还没有登录成功的连接断开，登录之后超过IDLE_TIMEOUT秒空闲的连接断开
+        正在处理指令或有进行中的传输的会话不会被断开，之后从最近一次活动开始重新计时
+        '''
+        if self.closed or self.expired:
+            return None
+        deadlines = []
+        with self.transfers_lock:
+            transfers = list(self.transfers.values())
+        stall_timeout = settings.TRANSFER_STALL_TIMEOUT
+        for transfer in transfers:
+            if not stall_timeout:
+                break
+            if transfer.state == 'waiting' or (transfer.state == 'running' and not transfer.started):
+                deadlines.append(now + stall_timeout)
+            elif transfer.state == 'running':
+                deadline = transfer.last_progress + stall_timeout
+                if deadline > now:
+                    deadlines.append(deadline)
+                    continue
+                transfer.abort('stalled')
+                self.server.metrics.timed_out('stall')
+                # 日志记录
+                self.logger.error('%s: %s' % (self.display_name(), '传输%s超过%s秒没有进展，已中止，文件%s，已传输%s字节' % (
+                    transfer.transfer_id, stall_timeout, transfer.full_path, transfer.done)))
+        if self.user_obj is None and settings.HANDSHAKE_TIMEOUT:
+            kind, timeout, deadline = 'handshake', settings.HANDSHAKE_TIMEOUT, self.connected + settings.HANDSHAKE_TIMEOUT
+        elif settings.IDLE_TIMEOUT:
+            kind, timeout, deadline = 'idle', settings.IDLE_TIMEOUT, self.last_activity + settings.IDLE_TIMEOUT
+        else:
+            kind = None
+        if kind is not None:
+            if deadline > now:
+                deadlines.append(deadline)
+            elif not self.idle():
+                deadlines.append(now + timeout)
+            else:
+                self.server.metrics.timed_out(kind)
+                # 日志记录
+                if kind == 'handshake':
+                    self.logger.error('%s:%s超过%s秒没有登录，断开连接' % (self.addr + (timeout,)))
+                else:
+                    self.logger.info('%s: %s' % (self.display_name(), '空闲超过%s秒，断开连接' % timeout))
+                self.expire(kind)
+                return None
+        return min(deadlines) if deadlines else None
+
+    def expire(self, reason):
+        '''
+        断开空闲的连接：只shutdown，阻塞在recv上的工作线程（或等待可读的事件循环）随即收到连接结束，由它调用close
+        这样asyncio模式下不会在事件循环还在监听时关闭文件描述符
+        '''
+        self.expired = reason
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def reject(self):
+        '''同一地址的连接数已达到上限：回复202后立即关闭连接，不占用工作线程'''
+        try:
+            self.send_response(202)
+        except OSError:
+            pass
+        self.request.close()
+
+    def display_name(self):
+        '''日志中使用的用户名，还没有登录时为客户端地址'''
+        user_obj = self.user_obj
+        return user_obj['name'] if user_obj else '%s:%s' % self.addr
+
+    def close(self):
+        '''关闭连接并清除会话状态'''
+        if self.closed:
+            return
+        self.closed = True
+        # 中止所有还在进行的传输
+        with self.transfers_lock:
+            transfers = list(self.transfers.values())
+        for transfer in transfers:
+            transfer.abort()
+        # 删除用户
+        self.user_obj = None
+        # 关闭连接，先shutdown以唤醒阻塞在recv上的工作线程
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.request.close()
+        self.server.remove_session(self)
+        self.logger.info('关闭控制连接和数据连接')
+
+    def send_response(self, status_code, *args, **kwargs):
+        '''
+        打包发送消息给客户端
+        status_code: 状态码
+        '''
+        # 打包数据
+        data = kwargs
+        data['status_code'] = status_code
+        data['status_msg'] = self.STATUS_CODE.get(status_code)
+        # 一条指令有多个响应时（如分页的ls），访问日志记录第一个状态码
+        if self.status_code is None:
+            self.status_code = status_code
+        # 发送数据
+        self.stream.send_message(data)
+
+    def _auth(self, data):
+        '''处理用户认证请求'''
+        username = data.get('username')
+        if data.get('token'):
+            # 同一用户的附加连接（如分段下载）使用登录时发放的令牌认证
+            user_obj = self.server.authenticate_token(username, data.get('token'))
+        else:
+            user_obj = self.server.authenticate(username, data.get('password', ''))
+        if user_obj:
+            try:
+                self.storage = self.server.storage(user_obj.get('storage', settings.STORAGE_BACKEND))
+                self.storage.makedirs(user_obj['home'])
+            except (ValueError, OSError) as e:
+                self.logger.error('用户%s登录失败，%s' % (username, e))
+                self.send_response(201)
+                return
+            if not self.server.login_session(self, username):
+                self.logger.error('用户%s登录失败，同时登录的会话数已达到上限%s' % (
+                    username, settings.MAX_SESSIONS_PER_USER))
+                self.send_response(202)
+                return
+            # 保存本会话的用户对象，并记录当前目录
+            self.user_obj = user_obj
+            self.current_dir = self.user_obj['home']
+            self.bucket = throttle.make_bucket(
+                user_obj.get('session_rate_limit', settings.SESSION_RATE_LIMIT), settings.RATE_LIMIT_BURST)
+            self.logger.info('用户%s登录成功' % username)
+            # 协商之后的控制消息使用的编码方式
+            codec = protocol.choose_codec(data.get('codecs'))
+            # 开启去重存储时告诉客户端分块大小，客户端上传前先发送块摘要列表
+            extra = {}
+            if self.server.dedup and self.storage.local:
+                extra['dedup_chunk_size'] = self.server.dedup.chunk_size
+            self.send_response(200, protocol_version=protocol.PROTOCOL_VERSION, codec=codec,
+                               token=self.server.issue_token(username), **extra)
+            self.stream.set_codec(codec)
+            self.stream.max_size = protocol.MAX_MESSAGE_SIZE
+            self.stream.codecs = None
+        else:
+            self.logger.error('用户%s登录失败' % username)
+            self.send_response(201)
+
+    def _get(self, data):
+        '''处理用户下载请求
+        1. 拿到文件名
+        2. 判断文件是否存在
+            2.1 如果文件存在，分配数据端口，返回状态码+文件大小+数据端口
+                2.1.1 在数据连接上发送文件
+            2.2 如果文件不存在，返回状态码
+        '''
+        filename = data.get('filename')
+        full_path = os.path.join(self.current_dir, filename)
+        if self.storage.isfile(full_path) and not self.server.is_reserved(full_path):
+            file_size = self.storage.getsize(full_path)
+            # 日志记录
+            self.logger.info('%s: %s' % (self.user_obj['name'], '下载文件%s' % full_path))
+            # 告诉客户端边接收边计算块摘要时使用的算法和块大小
+            self.start_send(full_path, 0, file_size, '下载', 301,
+                            self.download_compression(data, full_path, 0), file_size=file_size,
+                            algorithm=checksum.choose_algorithm(data.get('algorithms')),
+                            block_size=checksum.choose_block_size(data.get('block_size')))
+        else:
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '文件%s不存在' % full_path))
+
+    def _cd(self, data):
+        '''处理用户切换目录请求
+        1. 把target_dir和user_current_dir拼接起来
+        2. 检测要切换的目录是否存在，如果存在，则切换目录
+        3. 如果目录不存在，返回状态码
+        '''
+        path = data.get('target_dir')
+        # 判断是否为返回上一级目录
+        if path == '..':
+            full_path = os.path.dirname(self.current_dir)
+            # 判断是否合法
+            if full_path.startswith(self.user_obj['home']):
+                self.current_dir = full_path
+                relative_path = os.path.relpath(
+                    full_path, self.user_obj['home'])
+                self.send_response(350, relative_dir=relative_path)
+                # 日志记录
+                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
+            else:
+                self.send_response(351)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
+        # 判断是否为进入下一级目录
+        # 如果路径名以'/'开头，则认为是绝对路径，从用户根目录开始
+        elif path.startswith('/'):
+            # 拼接目录
+            full_path = os.path.join(self.user_obj['home'], path[1:])
+            # 判断路径是否存在
+            if self.storage.isdir(full_path):
+                self.current_dir = full_path
+                relative_path = os.path.relpath(
+                    full_path, self.user_obj['home'])
+                self.send_response(350, relative_dir=relative_path)
+                # 日志记录
+                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
+            else:
+                self.send_response(351)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
+        else:
+            # 拼接目录
+            full_path = os.path.join(self.current_dir, path)
+            # 判断目录是否存在
+            if self.storage.isdir(full_path):
+                self.current_dir = full_path
+                relative_path = os.path.relpath(
+                    full_path, self.user_obj['home'])
+                self.send_response(350, relative_dir=relative_path)
+                # 日志记录
+                self.logger.info('%s: %s' % (self.user_obj['name'], '切换目录%s' % full_path))
+            else:
+                self.send_response(351)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '切换目录%s失败' % full_path))
+        self.logger.debug('%s: %s' % (self.user_obj['name'], '当前目录%s' % self.current_dir))
+
+    def _ls(self, data):
+        '''处理用户列出目录请求
+        1. 用scandir扫描当前目录，每个目录项只做一次stat
+        2. 按glob模式过滤，并在服务端排序（sort为none时不排序，边扫描边发送）
+        3. 先返回400，再以402分页返回目录项，最后一页带有last标记
+        '''
+        pattern = data.get('pattern')
+        sort = data.get('sort') or 'name'
+        page_size = min(int(data.get('page_size') or settings.LS_PAGE_SIZE),
+                        settings.LS_MAX_PAGE_SIZE)
+        if sort != 'none' and sort not in listing.SORT_KEYS:
+            self.send_response(401)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '列出目录%s失败，排序方式%s不合法' % (self.current_dir, sort)))
+            return
+        total = None
+        try:
+            entries = listing.filter_entries(self.server.list_dir(self.storage, self.current_dir), pattern)
+            if sort != 'none':
+                entries = listing.sort_entries(entries, sort, data.get('reverse'))
+                total = len(entries)
+            pages = listing.paginate(entries, page_size)
+            # 先取出第一页，目录无法打开时在发送400之前就能发现
+            page = next(pages, [])
+        except OSError as e:
+            self.send_response(401)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '列出目录%s失败，%s' % (self.current_dir, e)))
+            return
+        self.send_response(400, total=total, sort=sort)
+        # 多取一页，以便在发送时知道当前页是否为最后一页
+        for next_page in pages:
+            self.send_response(402, res=page)
+            page = next_page
+        self.send_response(402, res=page, last=True)
+        # 日志记录
+        self.logger.info('%s: %s' % (self.user_obj['name'], '列出目录%s' % self.current_dir))
+
+    def _mkdir(self, data):
+        '''在当前目录下创建文件夹'''
+        # 拼接目录
+        full_path = os.path.join(self.current_dir, data.get('dirname'))
+        # 判断目录是否存在或文件名是否合法
+        if self.storage.isdir(full_path):
+            self.send_response(501)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '创建目录%s失败，已经存在' % full_path))
+        elif not re.match(r'^[\w\-]+$', data.get('dirname')):
+            self.send_response(502)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '创建目录%s失败，文件名不合法' % full_path))
+        elif self.server.quota and not self.server.quota.allowed(
+                self.user_obj['name'], self.server.quota_limits(self.user_obj['name']), 0, 1):
+            self.send_response(353)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '创建目录%s失败，超出配额' % full_path))
+        else:
+            # 创建目录
+            self.storage.mkdir(full_path)
+            if self.server.quota:
+                self.server.quota.add(self.user_obj['name'], 0, 1)
+            self.server.dir_changed(full_path)
+            self.send_response(500)
+            # 日志记录
+            self.logger.info('%s: %s' % (self.user_obj['name'], '创建目录%s成功' % full_path))
+
+    def _rm(self, data):
+        '''在当前目录下删除文件'''
+        # 拼接目录
+        full_path = os.path.join(self.current_dir, data.get('filename'))
+        # 判断文件是否存在
+        if self.server.is_reserved(full_path):
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '删除文件%s失败，不允许删除元数据索引' % full_path))
+        elif self.storage.isfile(full_path):
+            st = self.storage.stat(full_path)
+            self.storage.remove(full_path)
+            # 去重池中的对象没有其他文件链接时一并删除
+            if self.server.dedup and self.storage.local:
+                self.server.dedup.release(st)
+            if self.server.quota:
+                self.server.quota.add(self.user_obj['name'], -st.st_size, -1)
+            self.server.dir_changed(full_path)
+            index = self.meta_index()
+            if index:
+                index.remove(full_path)
+            self.send_response(600)
+            # 日志记录
+            self.logger.info('%s: %s' % (self.user_obj['name'], '删除文件%s' % full_path))
+        elif self.storage.isdir(full_path):
+            self.storage.rmdir(full_path)
+            if self.server.quota:
+                self.server.quota.add(self.user_obj['name'], 0, -1)
+            self.server.dir_changed(full_path)
+            self.send_response(601)
+            # 日志记录
+            self.logger.info('%s: %s' % (self.user_obj['name'], '删除目录%s' % full_path))
+        else:
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '删除文件或目录%s失败，不存在' % full_path))
+
+    def _put(self, data):
+        '''上传文件到服务器
+        1. 拿到local_file的文件名和大小
+        2. 文件先写到同目录下的.part文件中，offset不为0时在已有的.part文件后面续传
+        3. 分配数据端口，在数据连接上接收文件，完成后把.part文件改名为正式文件名，
+           并在数据连接上返回结果
+        '''
+        full_path = self.upload_path(data)
+        if full_path is None or self.server.is_reserved(full_path):
+            self.send_response(352)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '上传文件%s失败，没有权限' % full_path))
+            return
+        file_size = data.get('file_size')
+        offset = int(data.get('offset') or 0)
+        part_path = full_path + '.part'
+        # 续传时服务器上的.part文件至少要有客户端认为已经上传的字节数
+        if offset and (not self.storage.isfile(part_path) or self.storage.getsize(part_path) < offset
+                       or offset > file_size):
+            self.send_response(309)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '续传文件%s失败，已上传的部分不完整' % full_path))
+            return
+        # 按file_size预留用量，超出配额时在写入任何数据之前拒绝
+        reservation = part_size = None
+        if self.server.quota:
+            if self.storage.isfile(part_path):
+                part_size = self.storage.getsize(part_path)
+            reservation = self.server.quota.reserve(
+                self.user_obj['name'], self.server.quota_limits(self.user_obj['name']),
+                file_size - offset, 0 if part_size is not None else 1, part_path, part_size, os.getpid())
+            if reservation is None:
+                self.send_response(353)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '上传文件%s失败，超出配额' % full_path))
+                return
+        transfer = self.open_transfer('put', full_path, file_size)
+        if transfer is None:
+            if reservation:
+                self.server.quota.settle(reservation)
+            return
+        transfer.reservation = reservation
+        transfer.part_size = part_size
+        transfer.part_path = part_path
+        transfer.offset = transfer.done = offset
+        # 接收时按协商好的算法流式计算块摘要，完成后返回给客户端核对
+        transfer.hasher = checksum.BlockHasher(
+            checksum.choose_algorithm(data.get('algorithms')),
+            checksum.choose_block_size(data.get('block_size')))
+        # 传输在后台进行，会话可能先于传输结束，这里先取出用户的元数据索引
+        transfer.meta_index = self.meta_index()
+        transfer.username = self.user_obj['name']
+        # 客户端已经按采样结果决定是否请求压缩，这里只按扩展名再过滤一次
+        transfer.compression, transfer.compression_level = None, None
+        if settings.COMPRESSION and compression.worth_compressing(full_path):
+            transfer.compression, transfer.compression_level = compression.choose_compression(
+                data.get('compression'), data.get('compression_level'))
+        extra = self.plan_dedup(transfer, data, offset)
+        self.send_response(302, algorithm=transfer.hasher.algorithm, offset=offset,
+                           block_size=transfer.hasher.block_size, compression=transfer.compression,
+                           compression_level=transfer.compression_level, **extra, **self.transfer_args(transfer))
+        self.run_in_background(transfer, self.recv_upload, '上传')
+
+    def plan_dedup(self, transfer, data, offset):
+        '''
+        开启去重存储时准备上传：
+        1. 客户端发送了块摘要列表时查出服务器已有的块，响应中的missing为需要客户端发送的块序号
+        2. 旧版本客户端或续传时照常接收整个文件，从头上传的在接收时顺便计算块摘要，收完后加入去重池
+        '''
+        transfer.dedup_plan = None
+        transfer.chunk_hasher = None
+        dedup = self.server.dedup
+        if not dedup or not self.storage.local:
+            return {}
+        chunks = data.get('chunks')
+        # 块摘要列表不合法时照常接收整个文件
+        if (chunks is not None and not offset and data.get('chunk_size') == dedup.chunk_size
+                and checksum.valid_chunk_hashes(chunks)
+                and len(chunks) == checksum.block_count(transfer.size, dedup.chunk_size)):
+            object_path, known = dedup.plan(self.user_obj['name'], chunks)
+            transfer.dedup_plan = (chunks, object_path, known)
+            missing = [] if object_path else [index for index in range(len(chunks)) if index not in known]
+            return {'missing': missing, 'chunk_size': dedup.chunk_size}
+        if not offset:
+            transfer.chunk_hasher = checksum.BlockHasher(checksum.CHUNK_ALGORITHM, dedup.chunk_size)
+        return {}
+
+    def _put_status(self, data):
+        '''返回服务器上.part文件已经收到的字节数，客户端从这里开始续传'''
+        full_path = self.upload_path(data)
+        if full_path is None or self.server.is_reserved(full_path):
+            self.send_response(352)
+            return
+        try:
+            offset = self.storage.getsize(full_path + '.part')
+        except OSError:
+            offset = 0
+        self.send_response(311, offset=offset)
+
+    def upload_path(self, data):
+        '''上传的目标路径：abs_filename相对于用户根目录，旧版本客户端只发送相对于当前目录的local_file'''
+        if data.get('abs_filename'):
+            return self.home_path(data.get('abs_filename'))
+        return os.path.join(self.current_dir, data.get('local_file'))
+
+    def recv_upload(self, transfer, conn):
+        '''在数据连接上接收上传的文件，收完后改名为正式文件名'''
+        if transfer.dedup_plan:
+            return self.recv_dedup_upload(transfer, conn)
+        digest = transfer.hasher.update
+        if transfer.chunk_hasher:
+            def digest(data):
+                transfer.hasher.update(data)
+                transfer.chunk_hasher.update(data)
+        with transfer.storage.open_write(transfer.part_path, transfer.offset) as f:
+            if transfer.offset:
+                # 续传时先读出已经收到的部分，块摘要要覆盖整个文件
+                self.hash_part(f, transfer.offset, transfer.hasher)
+            if transfer.compression:
+                transfer.method = transfer.compression
+                recieved_size = transfer.offset + transfer_module.recv_file_compressed(
+                    conn, f, transfer.size - transfer.offset, transfer.compression,
+                    transfer.add_progress, digest)
+            else:
+                recieved_size = transfer.offset + transfer_module.recv_file(
+                    conn, f, transfer.size - transfer.offset, transfer.add_progress, digest)
+        # 在数据连接上告诉客户端文件是否完整收到，并附上服务器计算的块摘要
+        stream = protocol.MessageStream(conn)
+        if recieved_size != transfer.size:
+            self.server.dir_changed(transfer.part_path)
+            stream.send_message({'status_code': 309, 'status_msg': self.STATUS_CODE[309],
+                                 'offset': recieved_size})
+            raise ConnectionError('只收到%s/%s字节' % (recieved_size, transfer.size))
+        chunks = None
+        if transfer.chunk_hasher:
+            chunks = transfer.chunk_hasher.finish()
+            chunks = [chunks[index] for index in range(len(chunks))]
+        self.finish_upload(transfer, stream, chunks)
+        return recieved_size - transfer.offset
+
+    def finish_upload(self, transfer, stream, chunks=None, blocks=None):
+        '''
+        .part文件收完后改名为正式文件名，加入去重池并记录块摘要，在数据连接上返回结果
+        chunks为去重存储的块摘要，没有计算时从文件中读取；blocks为已知的块摘要列表
+        '''
+        # 如果文件已存在，则给他打上时间戳
+        full_path = transfer.full_path
+        if transfer.storage.isfile(full_path):
+            root, ext = os.path.splitext(full_path)
+            full_path = '%s_%s%s' % (root, int(time.time()), ext)
+        if getattr(transfer, 'reservation', None):
+            # 改名之前登记正式文件名，结算之前扫描用量时不会重复计算
+            self.server.quota.moved(transfer.reservation, full_path)
+        transfer.storage.replace(transfer.part_path, full_path)
+        transfer.final_path = full_path
+        if blocks is None:
+            blocks = transfer.hasher.finish()
+            blocks = [blocks[index] for index in range(len(blocks))]
+        if self.server.dedup and transfer.storage.local:
+            if chunks is None:
+                with open(full_path, 'rb') as f:
+                    chunks = checksum.chunk_hashes(f, self.server.dedup.chunk_size)
+            # 内容相同的文件会被换成指向池中对象的硬链接，要在写入元数据索引之前完成
+            self.server.dedup.commit(transfer.username, full_path, chunks,
+                                     transfer.hasher.algorithm, transfer.hasher.block_size, blocks)
+        self.server.dir_changed(transfer.part_path)
+        self.server.dir_changed(full_path)
+        # 上传时已经算好了块摘要，直接写入索引，之后的校验不必重新读取文件
+        if transfer.meta_index:
+            transfer.meta_index.store_blocks(full_path, transfer.hasher.algorithm,
+                                             transfer.hasher.block_size, blocks)
+        stream.send_message({'status_code': 308, 'status_msg': self.STATUS_CODE[308],
+                             'filename': os.path.basename(full_path),
+                             'blocks': blocks, 'digest': checksum.file_digest(blocks)})
+
+    def recv_dedup_upload(self, transfer, conn):
+        '''
+        按块摘要列表接收上传：数据连接上只有客户端按顺序发送的缺失块，
+        已有的块从池中的对象读取，收到的块逐块校验SHA-256，与客户端声明的不一致时上传失败
+        整个文件已存在时直接把池中的对象链接为.part文件，不接收也不写入数据
+        返回实际从网络收到的字节数
+        '''
+        chunks, object_path, known = transfer.dedup_plan
+        chunk_size = self.server.dedup.chunk_size
+        stream = protocol.MessageStream(conn)
+        blocks = None
+        received = 0
+        if object_path:
+            transfer.method = 'dedup链接'
+            if os.path.lexists(transfer.part_path):
+                os.remove(transfer.part_path)
+            os.link(object_path, transfer.part_path)
+            blocks = self.server.dedup.object_blocks(
+                object_path, transfer.hasher.algorithm, transfer.hasher.block_size)
+            if blocks is None:
+                blocks = checksum.hash_file(transfer.part_path, transfer.hasher.algorithm,
+                                            transfer.hasher.block_size)
+            # 没有经过网络的数据不计入限速
+            transfer.done = transfer.size
+        else:
+            transfer.method = 'dedup，复用%s/%s块' % (len(known), len(chunks))
+            reader = compression.StreamReader(conn, transfer.compression, limit=transfer.size)
+            sources = {}
+            try:
+                with open(transfer.part_path, 'wb') as f:
+                    for index, chunk in enumerate(chunks):
+                        length = min(chunk_size, transfer.size - index * chunk_size)
+                        if index in known:
+                            path, offset = known[index]
+                            if path not in sources:
+                                sources[path] = os.open(path, os.O_RDONLY)
+                            data = os.pread(sources[path], length, offset)
+                        else:
+                            data = reader.read(length)
+                            received += len(data)
+                        if len(data) != length or hashlib.sha256(data).hexdigest() != chunk:
+                            # 按块摘要上传不能续传，删除写了一半的.part文件
+                            f.close()
+                            os.remove(transfer.part_path)
+                            stream.send_message({'status_code': 309, 'status_msg': self.STATUS_CODE[309],
+                                                 'offset': 0})
+                            raise ValueError('第%s块的内容与摘要不一致' % index)
+                        f.write(data)
+                        transfer.hasher.update(data)
+                        if index in known:
+                            transfer.done += length
+                        else:
+                            transfer.add_progress(length)
+            finally:
+                for fd in sources.values():
+                    os.close(fd)
+            # 读完压缩流的结尾，客户端发送完毕后才能收到结果
+            reader.finish()
+        self.finish_upload(transfer, stream, chunks, blocks)
+        return received
+
+    @staticmethod
+    def hash_part(f, size, hasher):
+        '''从头读取f的size个字节交给hasher，读完后文件位置停在size处'''
+        buf = bytearray(settings.TRANSFER_CHUNK_SIZE)
+        view = memoryview(buf)
+        f.seek(0)
+        remaining = size
+        while remaining:
+            read_size = f.readinto(view[:min(remaining, len(buf))])
+            if not read_size:
+                break
+            hasher.update(view[:read_size])
+            remaining -= read_size
+
+    def _resend(self, data):
+        '''从客户端已经收到的位置开始续传文件'''
+        full_path = self.home_path(data.get('abs_filename'))
+        if self.check_file(full_path, data.get('file_size'), '重传'):
+            recieved_size = data.get('recieved_size')
+            if not is_count(recieved_size) or recieved_size > data.get('file_size'):
+                self.send_response(300)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '重传失败，已接收的大小%s不合法，文件%s' % (
+                    recieved_size, full_path)))
+                return
+            self.start_send(full_path, recieved_size, data.get('file_size') - recieved_size, '重传', 301,
+                            self.download_compression(data, full_path, recieved_size))
+
+    def _range(self, data):
+        '''发送文件的一个字节区间，供客户端多连接分段下载
+        1. 与_resend一样校验文件存在且大小与客户端记录的一致
+        2. 校验区间合法后返回301和区间长度，然后发送区间内的数据
+        '''
+        full_path = self.home_path(data.get('abs_filename'))
+        file_size = data.get('file_size')
+        if self.check_file(full_path, file_size, '分段下载'):
+            offset = data.get('offset')
+            length = data.get('length')
+            if not is_count(offset) or not is_count(length) or offset + length > file_size:
+                self.send_response(300)
+                # 日志记录
+                self.logger.error('%s: %s' % (self.user_obj['name'], '分段下载失败，区间%s+%s不合法，文件%s' % (
+                    offset, length, full_path)))
+                return
+            self.start_send(full_path, offset, length, '分段下载', 301,
+                            self.download_compression(data, full_path, offset), length=length)
+
+    def _bundle(self, data):
+        '''把多个文件打包成一个tar流，在一条数据连接上发送，供mget和get -r批量下载
+        1. paths中每一项相对于当前目录，可以是文件名、通配符，recursive为真时也可以是目录
+        2. 返回312、文件数和文件总字节数，然后在后台边读文件边生成tar流
+        3. 大量小文件只需要一次往返，吞吐量只受带宽限制
+        '''
+        entries = self.bundle_entries(data.get('paths') or [], data.get('recursive'))
+        sizes = [size for _, _, size, _ in entries if size is not None]
+        if not sizes:
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '批量下载%s失败，没有匹配的文件' % data.get('paths')))
+            return
+        # tar流的大小：每一项的文件头和按512字节对齐的内容，最后是两个空块，整个流再补齐到tar的记录大小
+        tar_size = -(-(sum(length for _, _, _, length in entries) + 1024) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+        transfer = self.open_transfer('get', self.current_dir, tar_size)
+        if transfer is None:
+            return
+        transfer.compression, transfer.compression_level = None, None
+        if settings.COMPRESSION and any(compression.worth_compressing(path) for path, _, _, _ in entries):
+            transfer.compression, transfer.compression_level = compression.choose_compression(
+                data.get('compression'), data.get('compression_level'))
+        self.send_response(312, files=len(sizes), total_size=sum(sizes),
+                           compression=transfer.compression, **self.transfer_args(transfer))
+        # 日志记录
+        self.logger.info('%s: %s' % (self.user_obj['name'], '批量下载%s个文件' % len(sizes)))
+        self.run_in_background(
+            transfer, lambda transfer, conn: self.send_bundle(transfer, conn, entries), '批量下载')
+
+    def bundle_entries(self, paths, recursive):
+        '''展开通配符和目录，返回[(完整路径, 包内路径, 文件大小, 在tar流中占用的字节数)]，目录的大小为None'''
+        entries = []
+        for item in paths:
+            if any(char in item for char in '*?['):
+                matches = sorted(self.storage.glob(self.current_dir, item))
+            else:
+                matches = [os.path.join(self.current_dir, item)]
+            for full_path in matches:
+                full_path = os.path.normpath(full_path)
+                arcname = os.path.relpath(full_path, self.current_dir)
+                # 包内路径不能越出当前目录
+                if arcname == '.' or arcname.startswith('..') or self.server.is_reserved(full_path):
+                    continue
+                if self.storage.isfile(full_path):
+                    entries.append(self.bundle_entry(full_path, arcname))
+                elif recursive and self.storage.isdir(full_path):
+                    for root, dirs, names in self.storage.walk(full_path):
+                        dirs.sort()
+                        entries.append(self.bundle_entry(root, os.path.relpath(root, self.current_dir)))
+                        for name in sorted(names):
+                            path = os.path.join(root, name)
+                            if self.storage.isfile(path) and not self.server.is_reserved(path):
+                                entries.append(self.bundle_entry(path, os.path.relpath(path, self.current_dir)))
+        return entries
+
+    def bundle_entry(self, full_path, arcname):
+        '''
+        按send_bundle写入的文件头计算这一项在tar流中占用的字节数：
+        名字过长或含非ASCII字符、mtime带小数时，文件头前面还有PAX扩展头，长度随内容变化
+        '''
+        st = self.storage.stat(full_path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mtime = st.st_mtime
+        if stat.S_ISDIR(st.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+            size = None
+        else:
+            tarinfo.size = size = st.st_size
+        length = len(tarinfo.tobuf(tarfile.PAX_FORMAT)) + -(-tarinfo.size // 512) * 512
+        return full_path, arcname, size, length
+
+    def send_bundle(self, transfer, conn, entries):
+        '''在数据连接上边读文件边生成tar流，需要压缩时整个tar流压缩成一个流'''
+        writer = compression.StreamWriter(
+            conn, transfer.compression, transfer.compression_level, transfer.add_progress)
+        with tarfile.open(fileobj=writer, mode='w|', bufsize=settings.TRANSFER_CHUNK_SIZE,
+                          format=tarfile.PAX_FORMAT) as tar:
+            for full_path, arcname, _, _ in entries:
+                try:
+                    if transfer.storage.local:
+                        tar.add(full_path, arcname, recursive=False, filter=self.bundle_filter)
+                    else:
+                        self.add_to_bundle(tar, transfer.storage, full_path, arcname)
+                except FileNotFoundError:
+                    # 打包过程中被删除的文件直接跳过
+                    continue
+        writer.close()
+        transfer.method = 'tar%s，发送%s字节' % (
+            '+' + transfer.compression if transfer.compression else '', writer.sent)
+        return writer.written
+
+    @staticmethod
+    def add_to_bundle(tar, backend, full_path, arcname):
+        '''把非本地存储中的文件或目录加入tar流，按存储的stat结果生成文件头'''
+        st = backend.stat(full_path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mtime = st.st_mtime
+        tarinfo.mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+            tar.addfile(tarinfo)
+            return
+        with backend.open_read(full_path) as f:
+            # 文件在打包时被截短会导致tar流损坏，按打开时的大小读取
+            f.seek(0, os.SEEK_END)
+            tarinfo.size = f.tell()
+            f.seek(0)
+            tar.addfile(tarinfo, f)
+
+    @staticmethod
+    def bundle_filter(tarinfo):
+        '''不把服务器上的用户和组信息发给客户端'''
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+
+    def _stat(self, data):
+        '''返回文件的大小和修改时间，客户端据此规划分段'''
+        full_path = os.path.join(self.current_dir, data.get('filename'))
+        try:
+            if self.server.is_reserved(full_path):
+                raise FileNotFoundError(full_path)
+            st = self.storage.stat(full_path)
+        except OSError:
+            self.send_response(300)
+            return
+        self.send_response(303, file_size=st.st_size, time=st.st_mtime,
+                           is_dir=stat.S_ISDIR(st.st_mode),
+                           algorithm=checksum.choose_algorithm(data.get('algorithms')),
+                           block_size=checksum.choose_block_size(data.get('block_size')))
+
+    def _checksum(self, data):
+        '''返回文件的块摘要和整个文件的摘要，客户端据此校验下载结果和续传'''
+        full_path = self.home_path(data.get('abs_filename'))
+        if full_path is None or not self.storage.isfile(full_path) or self.server.is_reserved(full_path):
+            self.send_response(300)
+            return
+        algorithm = checksum.choose_algorithm(data.get('algorithms'))
+        block_size = checksum.choose_block_size(data.get('block_size'))
+        # 优先从元数据索引中读取，文件没有变化时不必重新计算
+        index = self.meta_index()
+        if index:
+            file_size, blocks = index.get_blocks(full_path, algorithm, block_size)
+        else:
+            file_size = self.storage.getsize(full_path)
+            blocks = self.storage.hash_file(full_path, algorithm, block_size)
+        self.send_response(310, file_size=file_size, algorithm=algorithm, block_size=block_size,
+                           blocks=blocks, digest=checksum.file_digest(blocks))
+        # 日志记录
+        self.logger.info('%s: %s' % (self.user_obj['name'], '计算文件%s的校验和' % full_path))
+
+    def meta_index(self):
+        '''返回用户的元数据索引，索引保存在用户根目录下，只有本地存储使用'''
+        if not self.storage.local:
+            return None
+        return self.server.meta_index(self.user_obj['home'])
+
+    def home_path(self, abs_filename):
+        '''把相对于用户根目录的路径转换为完整路径，越出用户根目录时返回None'''
+        full_path = os.path.normpath(os.path.join(self.user_obj['home'], abs_filename))
+        if full_path != self.user_obj['home'] and not full_path.startswith(self.user_obj['home'] + os.sep):
+            return None
+        return full_path
+
+    def check_file(self, full_path, file_size, action):
+        '''检查文件存在且大小与客户端记录的一致，不一致时返回300'''
+        if full_path is None or not self.storage.isfile(full_path) or self.server.is_reserved(full_path):
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '%s失败，文件%s不存在' % (action, full_path)))
+            return False
+        if self.storage.getsize(full_path) != file_size:
+            self.send_response(300)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '%s失败，大小不一致，文件%s' % (action, full_path)))
+            return False
+        return True
+
+    def _status(self, data):
+        '''返回本会话所有进行中的传输'''
+        with self.transfers_lock:
+            transfers = [transfer.info() for transfer in self.transfers.values()]
+        self.send_response(304, transfers=transfers)
+
+    def _abort(self, data):
+        '''中止本会话中的一个传输'''
+        with self.transfers_lock:
+            transfer = self.transfers.get(data.get('transfer_id'))
+        if transfer is None:
+            self.send_response(306)
+            return
+        transfer.abort()
+        self.send_response(305, transfer_id=transfer.transfer_id, done=transfer.done)
+        # 日志记录
+        self.logger.info('%s: %s' % (self.user_obj['name'], '中止传输%s，文件%s' % (
+            transfer.transfer_id, transfer.full_path)))
+
+    def open_transfer(self, direction, full_path, size):
+        '''分配一个数据端口，失败时返回307'''
+        try:
+            transfer = datachannel.Transfer(
+                self.server.port_allocator, direction, full_path, size,
+                os.path.relpath(full_path, self.user_obj['home']))
+        except OSError as e:
+            self.send_response(307)
+            # 日志记录
+            self.logger.error('%s: %s' % (self.user_obj['name'], '分配数据端口失败：%s' % e))
+            return None
+        # 同时受全局、用户和本会话的限速
+        transfer.throttle = throttle.Throttle([
+            self.server.global_bucket, self.server.user_bucket(self.user_obj['name']), self.bucket])
+        # 传输在后台进行，会话可能先于传输结束
+        transfer.storage = self.storage
+        with self.transfers_lock:
+            self.transfers[transfer.transfer_id] = transfer
+        # 开始检查传输是否停滞
+        self.server.watch_session(self)
+        return transfer
+
+    def transfer_args(self, transfer):
+        '''响应中告诉客户端如何连接数据端口'''
+        return {'data_port': transfer.port, 'ticket': transfer.ticket,
+                'transfer_id': transfer.transfer_id}
+
+    def download_compression(self, data, full_path, offset):
+        '''
+        客户端请求压缩时决定这次下载是否压缩，返回(算法, 级别)
+        已压缩的格式，或者从offset开始采样试压缩的效果不好时不压缩
+        '''
+        if not settings.COMPRESSION:
+            return None, None
+        algorithm, level = compression.choose_compression(
+            data.get('compression'), data.get('compression_level'))
+        if algorithm is None or not compression.worth_compressing(full_path):
+            return None, None
+        sample = b''.join(self.storage.read_range(full_path, offset, compression.SAMPLE_SIZE))
+        if not compression.worth_compressing(full_path, sample):
+            return None, None
+        return algorithm, level
+
+    def start_send(self, full_path, offset, count, action, status_code, compress=(None, None), **kwargs):
+        '''
+        分配数据端口并返回响应，然后在后台从offset开始发送文件的count个字节
+        compress为(算法, 级别)，算法不为None时压缩发送
+        '''
+        transfer = self.open_transfer('get', full_path, count)
+        if transfer is None:
+            return
+        transfer.compression, transfer.compression_level = compress
+        kwargs['compression'] = transfer.compression
+        kwargs.update(self.transfer_args(transfer))
+        self.send_response(status_code, **kwargs)
+        self.run_in_background(
+            transfer, lambda transfer, conn: self.send_range(transfer, conn, offset, count), action)
+
+    def send_range(self, transfer, conn, offset, count):
+        '''
+        在数据连接上从offset开始发送文件的count个字节
+        文件从服务器共享的文件缓存中取得：内存中的小文件和mmap映射的大文件直接发送切片，不经过读文件的复制；
+        其他大文件用sendfile发送，sendfile指定了偏移，多个传输可以共用缓存中的同一个文件对象
+        不在本地磁盘上的文件（如内存存储中的）从存储后端打开后按块发送
+        '''
+        local_path = transfer.storage.local_path(transfer.full_path)
+        if local_path is not None:
+            with self.server.file_cache.open(local_path) as cached:
+                if cached.view is not None and (cached.in_memory or transfer.compression or not settings.USE_SENDFILE):
+                    with cached.view[offset:offset + count] as view:
+                        if transfer.compression:
+                            sent_size, wire_size = transfer_module.send_view_compressed(
+                                conn, view,
+                                compression.new_compressor(transfer.compression, transfer.compression_level),
+                                transfer.add_progress)
+                            transfer.method = '%s压缩后%s字节' % (transfer.compression, wire_size)
+                        else:
+                            sent_size = transfer_module.send_view(
+                                conn, view, transfer.add_progress, transfer.chunk_size())
+                            transfer.method = 'memory' if cached.in_memory else 'mmap'
+                    return sent_size
+                if settings.USE_SENDFILE and not transfer.compression:
+                    sent_size, transfer.method = transfer_module.send_file(
+                        conn, cached.file, offset, count, transfer.add_progress, transfer.chunk_size())
+                    return sent_size
+        # 关闭mmap时，需要移动读取位置的发送方式不能共用缓存中的文件对象
+        with transfer.storage.open_read(transfer.full_path) as f:
+            if transfer.compression:
+                # 压缩的数据要经过用户态，不能使用sendfile
+                sent_size, wire_size = transfer_module.send_file_compressed(
+                    conn, f, offset, count,
+                    compression.new_compressor(transfer.compression, transfer.compression_level),
+                    transfer.add_progress)
+                transfer.method = '%s压缩后%s字节' % (transfer.compression, wire_size)
+            elif local_path is None:
+                sent_size = transfer_module.send_file_buffered(conn, f, offset, count, transfer.add_progress)
+                transfer.method = 'buffered'
+            else:
+                sent_size, transfer.method = transfer_module.send_file(
+                    conn, f, offset, count, transfer.add_progress, transfer.chunk_size())
+        return sent_size
+
+    def settle_upload(self, transfer):
+        '''上传结束后（无论成败）释放预留的用量，按.part文件或正式文件的实际大小结算'''
+        path = getattr(transfer, 'final_path', None) or transfer.part_path
+        try:
+            size, files = transfer.storage.getsize(path), 1
+        except OSError:
+            size, files = 0, 0
+        if transfer.part_size is not None:
+            size -= transfer.part_size
+            files -= 1
+        self.server.quota.settle(transfer.reservation, size, files)
+        transfer.reservation = None
+
+    def run_in_background(self, transfer, handler, action):
+        '''在传输线程池中等待数据连接并执行handler，控制连接可以继续处理其他指令'''
+        self.server.transfer_pool.submit(
+            self.run_transfer, transfer, handler, action, self.user_obj['name'])
+
+    def run_transfer(self, transfer, handler, action, username):
+        '''执行一次数据传输并记录结果与吞吐量'''
+        timer = transfer_module.TransferTimer()
+        try:
+            conn = transfer.accept()
+            size = handler(transfer, conn)
+            transfer.state = 'done'
+            # 日志记录
+            self.logger.info('%s: %s' % (username, '%s完成，文件%s，传输%s字节，%s，%s' % (
+                action, transfer.full_path, size, getattr(transfer, 'method', 'recv'), timer.rate(size))))
+        except Exception as e:
+            if transfer.state in ('aborted', 'stalled'):
+                # 中止传输时已经记录过日志
+                return
+            transfer.state = 'failed'
+            # 日志记录
+            self.logger.error('%s: %s' % (username, '%s失败，文件%s，已传输%s字节：%s' % (
+                action, transfer.full_path, transfer.done, e)))
+        finally:
+            if transfer.conn is not None:
+                transfer.conn.close()
+            if getattr(transfer, 'reservation', None):
+                self.settle_upload(transfer)
+            with self.transfers_lock:
+                self.transfers.pop(transfer.transfer_id, None)
+            # 空闲时间从传输结束开始计算
+            self.last_activity = time.monotonic()
+            self.server.metrics.observe_transfer(
+                transfer.direction, transfer.done, timer.elapsed(), transfer.state)
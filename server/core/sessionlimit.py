@@ -0,0 +1,53 @@
+import threading
+
+
+class SessionCounter(object):
+    '''
+    每个客户端地址的连接数和每个用户的登录会话数，用于MAX_SESSIONS_PER_IP和MAX_SESSIONS_PER_USER
+    多进程模式下由监督进程持有唯一的实例，工作进程通过代理调用，限制对整个服务器生效；
+    计数记录了所属的工作进程号，进程异常退出后用abandon释放
+    '''
+
+    def __init__(self):
+        # (类型, 地址或用户名) -> 会话数
+        self.counts = {}
+        # 进程号 -> {(类型, 地址或用户名): 会话数}
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, kind, key, limit, owner=None):
+        '''kind为ip或user，key已有limit个会话时返回False，否则计入一个会话并返回True'''
+        item = (kind, key)
+        with self.lock:
+            count = self.counts.get(item, 0)
+            if limit and count >= limit:
+                return False
+            self.counts[item] = count + 1
+            held = self.owners.setdefault(owner, {})
+            held[item] = held.get(item, 0) + 1
+        return True
+
+    def release(self, kind, key, owner=None):
+        '''会话结束，减去acquire计入的会话'''
+        item = (kind, key)
+        with self.lock:
+            held = self.owners.get(owner)
+            if not held or item not in held:
+                # 进程已经被当作异常退出处理过
+                return
+            self._remove(item, 1)
+            held[item] -= 1
+            if not held[item]:
+                del held[item]
+
+    def abandon(self, owner):
+        '''释放已经退出的进程计入的所有会话'''
+        with self.lock:
+            for item, count in self.owners.pop(owner, {}).items():
+                self._remove(item, count)
+
+    def _remove(self, item, count):
+        '''调用方需持有self.lock'''
+        self.counts[item] -= count
+        if not self.counts[item]:
+            del self.counts[item]
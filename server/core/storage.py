@@ -0,0 +1,577 @@
+import errno
+import fnmatch
+import glob
+import io
+import os
+import shutil
+import stat
+import threading
+import time
+from conf import settings
+from common import checksum
+from core import listing
+
+# 分层存储在两层之间移动文件时使用的临时文件后缀，不会出现在ls中
+TIER_TMP_SUFFIX = '.jmftp-tier'
+
+
+class Storage(object):
+    '''
+    存储后端的接口，会话只通过它访问用户文件，路径都是USER_HOME_BASE_DIR下的完整路径
+    1. stat/list_dir/mkdir/remove/rmdir/replace与os模块中的同名函数一致，失败时抛出OSError
+    2. open_read返回可以seek的只读文件对象，open_write返回从offset开始写入的文件对象
+    3. read_range按块返回文件的一个区间，每块的读取时间有限，既可以在传输线程中直接迭代，
+       也可以由事件循环逐块交给线程池，不需要把整个文件读入内存
+    local为真时路径就是本地文件系统上的路径，去重存储、元数据索引和目录缓存只对这种后端开启；
+    local_path返回可以直接sendfile或mmap的本地路径，文件不在本地磁盘上时返回None；
+    background为False时不运行后台维护线程，多进程模式下只由一个工作进程运行
+    '''
+
+    local = False
+
+    def __init__(self, logger=None, background=True):
+        self.logger = logger
+
+    def stat(self, path):
+        raise NotImplementedError
+
+    def list_dir(self, path):
+        '''返回目录项的迭代器，格式同listing.make_entry'''
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        raise NotImplementedError
+
+    def makedirs(self, path):
+        '''创建目录及所有上级目录，已经存在时不报错'''
+        raise NotImplementedError
+
+    def remove(self, path):
+        raise NotImplementedError
+
+    def rmdir(self, path):
+        raise NotImplementedError
+
+    def replace(self, src, dst):
+        raise NotImplementedError
+
+    def open_read(self, path):
+        raise NotImplementedError
+
+    def open_write(self, path, offset=0):
+        '''打开文件用于写入，offset之后的内容被截掉，返回的文件对象可读，位置停在offset处'''
+        raise NotImplementedError
+
+    def local_path(self, path):
+        return None
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isfile(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def getsize(self, path):
+        return self.stat(path).st_size
+
+    def read_range(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+        '''从offset开始按块读取length个字节（None表示读到文件末尾）'''
+        with self.open_read(path) as f:
+            f.seek(offset)
+            while length is None or length > 0:
+                data = f.read(chunk_size if length is None else min(chunk_size, length))
+                if not data:
+                    break
+                if length is not None:
+                    length -= len(data)
+                yield data
+
+    def hash_file(self, path, algorithm, block_size):
+        '''流式读取整个文件，返回按顺序排列的块摘要列表'''
+        hasher = checksum.BlockHasher(algorithm, block_size)
+        for data in self.read_range(path):
+            hasher.update(data)
+        blocks = hasher.finish()
+        return [blocks[index] for index in range(len(blocks))]
+
+    def walk(self, top):
+        '''与os.walk相同，自顶向下返回(目录, 子目录名列表, 文件名列表)，调用方可以修改子目录名列表'''
+        dirs, files = [], []
+        for entry in self.list_dir(top):
+            (dirs if entry['is_dir'] else files).append(entry['filename'])
+        yield top, dirs, files
+        for name in dirs:
+            yield from self.walk(os.path.join(top, name))
+
+    def glob(self, directory, pattern):
+        '''在directory下按相对路径pattern匹配，与glob.glob相同，通配符不匹配以.开头的文件名'''
+        dirs = [directory]
+        for part in pattern.split('/'):
+            if not part:
+                continue
+            matches = []
+            for path in dirs:
+                if not any(char in part for char in '*?['):
+                    matches.append(os.path.join(path, part))
+                    continue
+                try:
+                    names = sorted(entry['filename'] for entry in self.list_dir(path))
+                except OSError:
+                    continue
+                matches.extend(os.path.join(path, name) for name in fnmatch.filter(names, part)
+                               if part.startswith('.') or not name.startswith('.'))
+            dirs = matches
+        return [path for path in dirs if self.exists(path)]
+
+
+class LocalStorage(Storage):
+    '''本地文件系统，路径原样使用，与引入存储后端之前的行为相同'''
+
+    local = True
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def list_dir(self, path):
+        return listing.iter_dir(path)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+    def open_read(self, path):
+        return open(path, 'rb')
+
+    def open_write(self, path, offset=0):
+        if not offset:
+            return open(path, 'w+b')
+        f = open(path, 'r+b')
+        f.truncate(offset)
+        f.seek(offset)
+        return f
+
+    def local_path(self, path):
+        return path
+
+    def walk(self, top):
+        return os.walk(top)
+
+    def glob(self, directory, pattern):
+        return glob.glob(os.path.join(glob.escape(directory), pattern))
+
+
+class MemoryStat(object):
+    '''内存存储的stat结果，只有会话用到的几个字段'''
+
+    def __init__(self, mode, size, mtime):
+        self.st_mode = mode
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_mtime_ns = int(mtime * 1e9)
+
+
+class MemoryWriter(io.BytesIO):
+    '''写入内存存储的文件，写入过程中stat能看到当前大小，关闭时把内容提交到存储中'''
+
+    def __init__(self, storage, path, data):
+        super().__init__(data)
+        self.storage = storage
+        self.path = path
+        self.size = len(data)
+
+    def write(self, data):
+        written = super().write(data)
+        self.size = max(self.size, self.tell())
+        return written
+
+    def close(self):
+        if not self.closed:
+            self.storage.commit(self.path, self)
+        super().close()
+
+
+class MemoryStorage(Storage):
+    '''
+    全部保存在内存中的存储，重启后丢失，用于测试和基准测试，排除磁盘的影响
+    文件内容为不可变的bytes，读取时BytesIO和memoryview切片都不复制数据；写入在MemoryWriter中进行，关闭时替换
+    '''
+
+    def __init__(self, logger=None, background=True):
+        self.logger = logger
+        # 文件路径 -> [内容, mtime]；目录路径 -> [子项名称集合, mtime]
+        self.files = {}
+        self.dirs = {}
+        # 正在写入的文件
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def stat(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            writer = self.writers.get(path)
+            if writer is not None:
+                return MemoryStat(stat.S_IFREG | 0o644, writer.size, time.time())
+            if path in self.files:
+                data, mtime = self.files[path]
+                return MemoryStat(stat.S_IFREG | 0o644, len(data), mtime)
+            if path in self.dirs:
+                return MemoryStat(stat.S_IFDIR | 0o755, 0, self.dirs[path][1])
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def list_dir(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            if path not in self.dirs:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            names = list(self.dirs[path][0])
+        entries = []
+        for name in names:
+            try:
+                entries.append(listing.make_entry(name, self.stat(os.path.join(path, name))))
+            except OSError:
+                continue
+        return iter(entries)
+
+    def mkdir(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            self._add(path)
+            self.dirs[path] = [set(), time.time()]
+
+    def makedirs(self, path):
+        path = os.path.normpath(path)
+        parent = os.path.dirname(path)
+        if parent != path and not self.isdir(parent):
+            self.makedirs(parent)
+        with self.lock:
+            if path in self.dirs:
+                return
+            if parent != path:
+                self._add(path)
+            self.dirs[path] = [set(), time.time()]
+
+    def remove(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            if path not in self.files:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            del self.files[path]
+            self._discard(path)
+
+    def rmdir(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            if path not in self.dirs:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if self.dirs[path][0]:
+                raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+            del self.dirs[path]
+            self._discard(path)
+
+    def replace(self, src, dst):
+        src, dst = os.path.normpath(src), os.path.normpath(dst)
+        with self.lock:
+            if src not in self.files:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+            if dst not in self.files:
+                self._add(dst)
+            self.files[dst] = self.files.pop(src)
+            self._discard(src)
+
+    def open_read(self, path):
+        return io.BytesIO(self._data(path))
+
+    def open_write(self, path, offset=0):
+        path = os.path.normpath(path)
+        with self.lock:
+            if path in self.writers:
+                raise OSError(errno.EBUSY, '文件正在写入', path)
+            data = self.files[path][0][:offset] if offset and path in self.files else b''
+            if len(data) < offset:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if path not in self.files:
+                self._add(path)
+                self.files[path] = [b'', time.time()]
+            writer = MemoryWriter(self, path, data)
+            writer.seek(offset)
+            self.writers[path] = writer
+        return writer
+
+    def commit(self, path, writer):
+        '''MemoryWriter关闭时调用，文件在写入期间被删除时丢弃写入的内容'''
+        with self.lock:
+            self.writers.pop(path, None)
+            if path in self.files:
+                self.files[path] = [writer.getvalue(), time.time()]
+
+    def read_range(self, path, offset=0, length=None, chunk_size=1024 * 1024):
+        '''直接返回内容的memoryview切片，不复制数据'''
+        view = memoryview(self._data(path))
+        end = len(view) if length is None else min(len(view), offset + length)
+        for start in range(offset, end, chunk_size):
+            yield view[start:min(start + chunk_size, end)]
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.files), 'bytes': sum(len(data) for data, _ in self.files.values())}
+
+    def _data(self, path):
+        path = os.path.normpath(path)
+        with self.lock:
+            writer = self.writers.get(path)
+            if writer is not None:
+                return writer.getvalue()
+            if path not in self.files:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            return self.files[path][0]
+
+    def _add(self, path):
+        '''在上级目录中登记新的子项，调用方需持有self.lock'''
+        parent, name = os.path.split(path)
+        if parent not in self.dirs:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), parent)
+        if path in self.files or path in self.dirs:
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        self.dirs[parent][0].add(name)
+        self.dirs[parent][1] = time.time()
+
+    def _discard(self, path):
+        '''从上级目录中删除子项，调用方需持有self.lock'''
+        parent, name = os.path.split(path)
+        if parent in self.dirs:
+            self.dirs[parent][0].discard(name)
+            self.dirs[parent][1] = time.time()
+
+
+class TieredStorage(Storage):
+    '''
+    分层存储：新写入和最近访问的文件在快速的本地磁盘（热层），长时间没有访问的在较慢的挂载点（冷层）
+    1. 用户目录映射到两层下的同一个相对路径，目录项合并显示，同名时以热层为准
+    2. 读取冷层的文件时先复制到热层（提升），之后从热层的本地路径sendfile或mmap
+    3. 后台线程定期把超过TIERED_HOT_AGE秒没有访问的文件移到冷层（降级），
+       热层超出TIERED_HOT_MAX_BYTES时从最久没有访问的文件开始降级；正在上传的.part文件不降级
+    访问时间由每次读取时显式更新，不依赖挂载选项；热层目录只能由分层存储使用
+    '''
+
+    def __init__(self, logger=None, background=True):
+        self.logger = logger
+        self.base_dir = settings.USER_HOME_BASE_DIR
+        self.hot_dir = settings.TIERED_HOT_DIR
+        self.cold_dir = settings.TIERED_COLD_DIR
+        self.hot_age = settings.TIERED_HOT_AGE
+        self.hot_max_bytes = settings.TIERED_HOT_MAX_BYTES
+        # 提升和降级的最后一步（替换和删除）在锁内进行，避免删掉刚上传的新文件
+        self.lock = threading.Lock()
+        self.promotions = 0
+        self.demotions = 0
+        os.makedirs(self.hot_dir, exist_ok=True)
+        os.makedirs(self.cold_dir, exist_ok=True)
+        self.stopped = threading.Event()
+        if background and settings.TIERED_DEMOTE_INTERVAL:
+            thread = threading.Thread(target=self.demote_loop, name='tiered_storage', daemon=True)
+            thread.start()
+
+    def tiers(self, path):
+        '''返回(热层路径, 冷层路径)'''
+        relative_path = os.path.relpath(path, self.base_dir)
+        return os.path.join(self.hot_dir, relative_path), os.path.join(self.cold_dir, relative_path)
+
+    def stat(self, path):
+        for tier_path in self.tiers(path):
+            try:
+                return os.stat(tier_path)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def list_dir(self, path):
+        entries = {}
+        found = False
+        for tier_path in reversed(self.tiers(path)):
+            try:
+                for entry in listing.iter_dir(tier_path):
+                    if not entry['filename'].endswith(TIER_TMP_SUFFIX):
+                        entries[entry['filename']] = entry
+                found = True
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        if not found:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return iter(entries.values())
+
+    def mkdir(self, path):
+        if self.exists(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        hot_path, _ = self.tiers(path)
+        if not self.isdir(os.path.dirname(path)):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        os.makedirs(hot_path)
+
+    def makedirs(self, path):
+        os.makedirs(self.tiers(path)[0], exist_ok=True)
+
+    def remove(self, path):
+        removed = False
+        for tier_path in self.tiers(path):
+            try:
+                os.remove(tier_path)
+                removed = True
+            except FileNotFoundError:
+                continue
+        if not removed:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def rmdir(self, path):
+        if any(True for _ in self.list_dir(path)):
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+        for tier_path in self.tiers(path):
+            if os.path.isdir(tier_path):
+                os.rmdir(tier_path)
+
+    def replace(self, src, dst):
+        src_path = self.local_path(src)
+        hot_path, cold_path = self.tiers(dst)
+        os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+        with self.lock:
+            os.replace(src_path, hot_path)
+            if os.path.exists(cold_path):
+                os.remove(cold_path)
+
+    def open_read(self, path):
+        return open(self.local_path(path), 'rb')
+
+    def open_write(self, path, offset=0):
+        if offset:
+            f = open(self.local_path(path), 'r+b')
+            f.truncate(offset)
+            f.seek(offset)
+            return f
+        hot_path, cold_path = self.tiers(path)
+        if os.path.exists(cold_path):
+            os.remove(cold_path)
+        os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+        return open(hot_path, 'w+b')
+
+    def local_path(self, path):
+        '''返回热层上的路径，文件在冷层时先提升到热层'''
+        hot_path, cold_path = self.tiers(path)
+        try:
+            st = os.stat(hot_path)
+        except FileNotFoundError:
+            if not os.path.isfile(cold_path):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if self.move(cold_path, hot_path):
+                self.promotions += 1
+            st = os.stat(hot_path)
+        # 只更新访问时间，mtime不变，文件缓存的键也不变
+        os.utime(hot_path, ns=(time.time_ns(), st.st_mtime_ns))
+        return hot_path
+
+    def move(self, src, dst):
+        '''把文件复制到另一层后删除原文件，复制期间src被修改或删除时放弃，返回是否移动'''
+        st = os.stat(src)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # 多进程模式下其他工作进程可能同时移动同一个文件，临时文件名包含进程号
+        tmp_path = '%s.%s.%s%s' % (dst, os.getpid(), threading.get_ident(), TIER_TMP_SUFFIX)
+        shutil.copy2(src, tmp_path)
+        with self.lock:
+            try:
+                current = os.stat(src)
+            except FileNotFoundError:
+                current = None
+            if (current is None or os.path.exists(dst) or
+                    (current.st_ino, current.st_mtime_ns, current.st_size) !=
+                    (st.st_ino, st.st_mtime_ns, st.st_size)):
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, dst)
+            try:
+                os.remove(src)
+            except FileNotFoundError:
+                # 另一个进程同时移动了同一个文件，内容相同
+                pass
+        return True
+
+    def demote(self):
+        '''把冷文件从热层移到冷层，返回移动的文件数'''
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.hot_dir):
+            for name in names:
+                if name.endswith('.part') or name.endswith(TIER_TMP_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+        # 从最久没有访问的开始，超过期限的都降级，之后只在超出容量时继续
+        files.sort()
+        expire = time.time() - self.hot_age
+        moved = 0
+        for atime, size, path in files:
+            if atime >= expire and not (self.hot_max_bytes and total > self.hot_max_bytes):
+                break
+            cold_path = os.path.join(self.cold_dir, os.path.relpath(path, self.hot_dir))
+            if self.move(path, cold_path):
+                total -= size
+                moved += 1
+        self.demotions += moved
+        return moved
+
+    def demote_loop(self):
+        while not self.stopped.wait(settings.TIERED_DEMOTE_INTERVAL):
+            try:
+                moved = self.demote()
+            except OSError as e:
+                if self.logger:
+                    self.logger.error('分层存储降级失败：%s' % e)
+                continue
+            if moved and self.logger:
+                self.logger.info('分层存储把%s个文件移到了冷层' % moved)
+
+    def stats(self):
+        return {'promotions': self.promotions, 'demotions': self.demotions}
+
+    def close(self):
+        self.stopped.set()
+
+
+# 可以在accounts.ini中用storage选择的存储后端
+BACKENDS = {
+    'local': LocalStorage,
+    'memory': MemoryStorage,
+    'tiered': TieredStorage,
+}
@@ -0,0 +1,67 @@
+import threading
+import time
+
+# 速率配置中可以使用的单位
+RATE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    '''把配置中的速率转换为每秒字节数，支持K/M/G后缀，0或空表示不限速'''
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip().upper().rstrip('B')
+    if not value:
+        return 0
+    if value[-1] in RATE_UNITS:
+        return int(float(value[:-1]) * RATE_UNITS[value[-1]])
+    return int(value)
+
+
+def make_bucket(rate, burst_seconds):
+    '''按速率创建令牌桶，不限速时返回None'''
+    rate = parse_rate(rate)
+    if rate <= 0:
+        return None
+    return TokenBucket(rate, rate * burst_seconds)
+
+
+class TokenBucket(object):
+    '''
+    令牌桶：以rate字节/秒的速度补充令牌，最多积累burst个
+    令牌不够时允许预支，欠下的令牌由后来者一起等待，
+    多个传输按各自的发送粒度依次排队，带宽在它们之间平均分配
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        '''取走size个令牌，返回需要等待的秒数'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Throttle(object):
+    '''一次传输受到的所有限速（全局、用户、会话），按其中需要等待最久的一个等待'''
+
+    def __init__(self, buckets):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    def reserve(self, size):
+        '''从所有令牌桶中取走size个令牌，返回需要等待的秒数'''
+        return max(bucket.reserve(size) for bucket in self.buckets)
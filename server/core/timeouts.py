@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+from conf import settings
+
+
+def set_keepalive(sock):
+    '''按配置开启TCP keepalive，对端主机断电或网络中断时内核在几分钟内发现，不必等到超时'''
+    if not settings.TCP_KEEPALIVE:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # 各平台支持的选项不同，没有的选项使用系统默认值
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, settings.TCP_KEEPIDLE)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            # macOS上与TCP_KEEPIDLE含义相同
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, settings.TCP_KEEPIDLE)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, settings.TCP_KEEPINTVL)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, settings.TCP_KEEPCNT)
+    except OSError:
+        # 连接已经被对端关闭
+        pass
+
+
+class Reaper(object):
+    '''
+    在一个后台线程中检查所有会话的超时，会话数很多时也不需要每个计时器一个线程
+    1. 最小堆中保存(检查时刻, 序号, 会话)，线程睡眠到最早的检查时刻
+    2. 会话收到指令或传输有进展时只更新自己的时间戳，不调整堆；到期时调用session.check_timeouts(now)，
+       由会话按最新的时间戳判断是否真的超时，返回下一次检查的时刻，None表示不再检查
+    3. 每个会话只保留最早的一次检查，watch传入更晚的时刻时忽略，更早时旧的堆项在弹出时丢弃
+    会话数为n时，每次watch和每次检查都是O(log n)
+    '''
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.heap = []
+        # 会话 -> 有效的检查时刻
+        self.scheduled = {}
+        # 检查时刻相同时按放入顺序弹出，也避免比较会话对象
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='ftp_reaper', daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.scheduled)
+
+    def watch(self, session, deadline):
+        '''在time.monotonic()到达deadline时检查会话，已经安排了更早的检查时不变'''
+        with self.cond:
+            scheduled = self.scheduled.get(session)
+            if scheduled is not None and scheduled <= deadline:
+                return
+            self.scheduled[session] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), session))
+            # 新的检查时刻比线程正在等待的更早时唤醒它
+            if self.heap[0][2] is session:
+                self.cond.notify()
+
+    def run(self):
+        '''后台线程：取出所有到期的会话逐个检查，没有超时的按返回的时刻重新放入堆中'''
+        while True:
+            due = []
+            with self.cond:
+                while not self.stopped:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+                if self.stopped:
+                    return
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, _, session = heapq.heappop(self.heap)
+                    # 之后又安排了更早的检查，这一项已经作废
+                    if self.scheduled.get(session) == deadline:
+                        del self.scheduled[session]
+                        due.append(session)
+            # 检查时会关闭连接、写日志，不持有锁
+            for session in due:
+                try:
+                    deadline = session.check_timeouts(now)
+                except Exception as e:
+                    self.logger.error('检查会话超时出错，错误信息：%s' % e)
+                    continue
+                if deadline is not None:
+                    self.watch(session, deadline)
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.heap.clear()
+            self.scheduled.clear()
+            self.cond.notify()
+        self.thread.join()
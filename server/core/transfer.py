@@ -0,0 +1,159 @@
+import os
+import time
+from conf import settings
+from common import compression
+
+
+def send_file(sock, f, offset=0, count=None, progress=None, chunk_size=None):
+    '''
+    把文件f从offset开始的count个字节发送到sock，返回(发送字节数, 发送方式)
+    优先使用内核零拷贝的sendfile，不可用时退回到固定大小缓冲区的循环发送
+    每发送一块调用一次progress(本块字节数)，用于进度统计、限速和中止传输
+    '''
+    if count is None:
+        count = os.fstat(f.fileno()).st_size - offset
+    if settings.USE_SENDFILE and hasattr(os, 'sendfile'):
+        total_sent = 0
+        while total_sent < count:
+            # 分块调用sendfile，以便在块之间更新进度
+            # socket.sendfile在文件不支持零拷贝时会自行退回到普通发送
+            sent = sock.sendfile(f, offset + total_sent,
+                                 min(chunk_size or settings.SENDFILE_CHUNK_SIZE, count - total_sent))
+            if not sent:
+                break
+            total_sent += sent
+            if progress:
+                progress(sent)
+        return total_sent, 'sendfile'
+    return send_file_buffered(sock, f, offset, count, progress), 'buffered'
+
+
+def send_file_buffered(sock, f, offset, count, progress=None):
+    '''以固定大小的块循环读取并发送文件，保证每一块都完整发出'''
+    f.seek(offset)
+    buf = bytearray(settings.TRANSFER_CHUNK_SIZE)
+    view = memoryview(buf)
+    total_sent = 0
+    while total_sent < count:
+        size = f.readinto(view[:min(len(buf), count - total_sent)])
+        if not size:
+            break
+        sock.sendall(view[:size])
+        total_sent += size
+        if progress:
+            progress(size)
+    return total_sent
+
+
+def send_view(sock, view, progress=None, chunk_size=None):
+    '''
+    把内存中的数据（bytes或mmap的memoryview切片）分块发送到sock，返回发送字节数
+    切片不复制数据，多个传输可以同时发送同一份缓存
+    '''
+    chunk_size = chunk_size or settings.SENDFILE_CHUNK_SIZE
+    total_sent = 0
+    while total_sent < len(view):
+        # 切片用完立即释放，缓存关闭mmap时不会有残留的引用
+        with view[total_sent:total_sent + chunk_size] as chunk:
+            sock.sendall(chunk)
+            size = len(chunk)
+        total_sent += size
+        if progress:
+            progress(size)
+    return total_sent
+
+
+def send_view_compressed(sock, view, compressor, progress=None):
+    '''send_file_compressed的内存版本：直接压缩memoryview的切片，省去读文件的复制'''
+    total_read = 0
+    total_sent = 0
+    while total_read < len(view):
+        with view[total_read:total_read + settings.TRANSFER_CHUNK_SIZE] as chunk:
+            compressed = compressor.compress(chunk)
+            size = len(chunk)
+        if compressed:
+            sock.sendall(compressed)
+            total_sent += len(compressed)
+        total_read += size
+        if progress:
+            progress(size)
+    compressed = compressor.flush()
+    sock.sendall(compressed)
+    return total_read, total_sent + len(compressed)
+
+
+def recv_file(sock, f, count, progress=None, digest=None):
+    '''从sock接收count个字节写入文件f，返回实际收到的字节数，digest用于边收边计算摘要'''
+    buf = bytearray(settings.TRANSFER_CHUNK_SIZE)
+    view = memoryview(buf)
+    total_recv = 0
+    while total_recv < count:
+        size = sock.recv_into(view[:min(len(buf), count - total_recv)])
+        if not size:
+            break
+        f.write(view[:size])
+        if digest:
+            digest(view[:size])
+        total_recv += size
+        if progress:
+            progress(size)
+    return total_recv
+
+
+def send_file_compressed(sock, f, offset, count, compressor, progress=None):
+    '''
+    读取文件f从offset开始的count个字节，压缩成一个流发送到sock
+    progress按压缩前的字节数统计，返回(压缩前字节数, 实际发送的字节数)
+    '''
+    f.seek(offset)
+    total_read = 0
+    total_sent = 0
+    while total_read < count:
+        data = f.read(min(settings.TRANSFER_CHUNK_SIZE, count - total_read))
+        if not data:
+            break
+        compressed = compressor.compress(data)
+        if compressed:
+            sock.sendall(compressed)
+            total_sent += len(compressed)
+        total_read += len(data)
+        if progress:
+            progress(len(data))
+    compressed = compressor.flush()
+    sock.sendall(compressed)
+    return total_read, total_sent + len(compressed)
+
+
+def recv_file_compressed(sock, f, count, algorithm, progress=None, digest=None):
+    '''
+    从sock接收algorithm压缩的流，解压后写入文件f，直到压缩流结束或对端关闭连接
+    按块解压，解压后超过count字节时抛出ValueError，不会先把整段解压结果放进内存
+    progress和digest都按解压后的数据计算，返回解压后的字节数
+    '''
+    decompressor = compression.Decompressor(algorithm, count)
+    while not decompressor.eof:
+        data = sock.recv(settings.TRANSFER_CHUNK_SIZE)
+        if not data:
+            break
+        for chunk in decompressor.decompress(data):
+            f.write(chunk)
+            if digest:
+                digest(chunk)
+            if progress:
+                progress(len(chunk))
+    return decompressor.total
+
+
+class TransferTimer(object):
+    '''记录一次传输的耗时，用于计算吞吐量'''
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+
+    def elapsed(self):
+        '''返回已经过的秒数'''
+        return max(time.perf_counter() - self.start_time, 1e-6)
+
+    def rate(self, size):
+        '''返回可读的传输速率字符串'''
+        return '%.2fMB/s' % (size / self.elapsed() / 1024 / 1024)